@@ -0,0 +1,141 @@
+"""
+Admission control of the api.
+
+Workers record how many works they finished and how long they were busy/idle in per-second buckets in redis.
+From the last `ADMISSION_WINDOW` seconds, the api estimates the capacity (works per second) of all workers,
+and how long it takes to drain the works ahead of a new request (the works in its lane and the higher lanes).
+If they can't be drained before the new works are timed out, the request is rejected at once,
+and the client is asked to retry after the excess time.
+
+Every api process reloads the queue lengths and the capacity every `ADMISSION_REFRESH_INTERVAL` seconds,
+so the check doesn't cost a round trip for most requests.
+
+The same snapshot paces the batches (see `Snapshot.room`):
+a batch only pushes the works which can be started before they are timed out,
+and pushes the rest when the workers catch up.
+"""
+import logging
+import math
+from dataclasses import dataclass
+from time import time
+
+import app.config as app_config
+from app.libs.redis_queue import RedisQueue
+import app.work_queue as work_queue
+from app.model import WorkPriority
+
+
+logger = logging.getLogger(__name__)
+
+
+def _bucket_key(second: int) -> str:
+    # use a hash tag to make sure all buckets are in the same slot in redis cluster
+    return f'{{{app_config.REDIS_CAPACITY_PREFIX}}}{second}'
+
+
+def record(pp, works: int, busy_ms: int, idle_ms: int):
+    """Called by workers (sync mode) to add the capacity stats to the pipeline of publishing"""
+    if not (works or busy_ms or idle_ms):
+        return
+    key = _bucket_key(int(time()))
+    for field, amount in (('works', works), ('busy_ms', busy_ms), ('idle_ms', idle_ms)):
+        if amount:
+            pp.hincrby(key, field, amount)
+    pp.expire(key, app_config.ADMISSION_WINDOW * 2)
+
+
+# only fill the estimated room partly, as the estimation lags behind
+_ROOM_HEADROOM = 0.8
+
+
+@dataclass
+class Snapshot:
+    loaded_at: float
+    lengths: dict[WorkPriority, int]
+    capacity: float | None = None  # works per second, None if unknown
+    free_executors: float = 0  # average idle executors
+
+    def ahead(self, priority: WorkPriority) -> int:
+        """The queued works which are taken before a new work of `priority`"""
+        priorities = list(WorkPriority)
+        return sum(
+            length for p, length in self.lengths.items()
+            if priorities.index(p) <= priorities.index(priority)
+        )
+
+    def room(self, priority: WorkPriority) -> int | None:
+        """How many more works of `priority` can be queued now and started before they are timed out"""
+        if self.capacity is None:
+            return None
+        # the idle executors start works at once, and the others start capacity * budget works in the budget
+        startable = self.free_executors + self.capacity * _budget(priority) * _ROOM_HEADROOM
+        return max(math.floor(startable) - self.ahead(priority), 0)
+
+
+_snapshot: Snapshot | None = None
+
+
+def _estimate_capacity(buckets: list[dict[bytes, bytes]]) -> tuple[float | None, float]:
+    """Return (works per second, average idle executors)"""
+    works = sum(int(b.get(b'works', 0)) for b in buckets)
+    busy = sum(int(b.get(b'busy_ms', 0)) for b in buckets) / 1000
+    idle = sum(int(b.get(b'idle_ms', 0)) for b in buckets) / 1000
+    if not works or busy <= 0:
+        # no works are finished recently, so nothing is known
+        return None, 0
+    # only count the seconds since the first record, in case the workers are just started
+    seconds = len(buckets) - next(i for i, b in enumerate(buckets) if b)
+    # (busy + idle) / seconds is the average number of running executors,
+    # and every executor finishes works / busy works per second.
+    return works / busy * (busy + idle) / seconds, idle / seconds
+
+
+async def _load_snapshot(redis_queue: RedisQueue) -> Snapshot:
+    now = int(time())
+    pp = redis_queue.redis.pipeline(transaction=False)
+    for second in range(now - app_config.ADMISSION_WINDOW + 1, now + 1):
+        pp.hgetall(_bucket_key(second))
+    buckets = await pp.execute()
+    capacity, free_executors = _estimate_capacity(buckets)
+    return Snapshot(
+        loaded_at=time(),
+        lengths=await work_queue.lengths(redis_queue),
+        capacity=capacity,
+        free_executors=free_executors,
+    )
+
+
+async def snapshot(redis_queue: RedisQueue) -> Snapshot | None:
+    """The capacity of the workers and the queue lengths, reloaded every `ADMISSION_REFRESH_INTERVAL` seconds"""
+    global _snapshot
+    try:
+        if _snapshot is None or time() - _snapshot.loaded_at >= app_config.ADMISSION_REFRESH_INTERVAL:
+            _snapshot = await _load_snapshot(redis_queue)
+    except Exception:
+        logger.exception('Failed to load the capacity of the workers')
+        return None
+    return _snapshot
+
+
+def _budget(priority: WorkPriority) -> float:
+    """How long the works of `priority` can wait in the queue"""
+    if priority == WorkPriority.LONG_BATCH:
+        return app_config.LONG_BATCH_MAX_QUEUE_WAIT_TIME - app_config.MAX_PROCESS_TIME
+    # the workers drop the works which are in the queue for longer than it
+    return app_config.MAX_QUEUE_WORK_LIFE_TIME
+
+
+async def check(redis_queue: RedisQueue, priority: WorkPriority) -> int | None:
+    """Return the seconds to retry after if the request should be rejected, otherwise None"""
+    if not app_config.ADMISSION_CONTROL:
+        return None
+    current = await snapshot(redis_queue)
+    # never reject if the capacity is unknown (or failed to load)
+    if current is None or current.capacity is None:
+        return None
+
+    drain_time = current.ahead(priority) / current.capacity
+    excess_time = drain_time - _budget(priority)
+    if excess_time <= 0:
+        return None
+    return max(math.ceil(excess_time), 1)
@@ -0,0 +1,161 @@
+"""
+Content-addressed blobs of the large strings in work payloads.
+
+A solution is often copied into many payloads (for example, one per test case),
+and inputs can be megabytes. So the strings longer than `BLOB_MIN_SIZE` are stored once in redis,
+zlib compressed and keyed by their sha256, and the payloads only carry the hashes (`WorkPayload.blobs`).
+A blob which is already in redis is not uploaded again, and its expiry is renewed instead.
+Workers load the blobs back to the submission before running it,
+with a per-process LRU cache, so a blob is usually downloaded once by a worker.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+from typing import Any, Iterator
+import zlib
+
+import app.config as app_config
+from app.libs.redis_queue import RedisQueue
+from app.model import MultiCaseSubmission, Submission, WorkPayload
+
+
+def enabled() -> bool:
+    return app_config.BLOB_MIN_SIZE > 0
+
+
+def _blob_key(digest: str) -> str:
+    return f'{app_config.REDIS_BLOB_PREFIX}{digest}'
+
+
+def _iter_paths(submission) -> Iterator[str]:
+    """The paths of the fields which can be stored as blobs"""
+    if isinstance(submission, MultiCaseSubmission):
+        yield 'solution'
+        for i in range(len(submission.cases)):
+            yield f'cases.{i}.input'
+            yield f'cases.{i}.expected_output'
+    elif isinstance(submission, Submission):
+        yield from ('solution', 'input', 'expected_output')
+
+
+def _locate(obj: Any, path: str) -> tuple[Any, str]:
+    """Return (the model or dict owning the field, the field name)"""
+    *parents, name = path.split('.')
+    for part in parents:
+        if isinstance(obj, list):
+            obj = obj[int(part)]
+        elif isinstance(obj, dict):
+            obj = obj[part]
+        else:
+            obj = getattr(obj, part)
+    return obj, name
+
+
+async def dump_payloads(redis_queue: RedisQueue, payloads: list[WorkPayload]) -> list[str]:
+    """Serialize the payloads (without changing them), and store their large strings as blobs"""
+    if not enabled():
+        return [payload.model_dump_json() for payload in payloads]
+
+    blobs: dict[str, str] = {}
+    payload_jsons = []
+    for payload in payloads:
+        refs = {}
+        for path in _iter_paths(payload.submission):
+            owner, name = _locate(payload.submission, path)
+            text = getattr(owner, name)
+            if text is not None and len(text) >= app_config.BLOB_MIN_SIZE:
+                digest = hashlib.sha256(text.encode()).hexdigest()
+                blobs[digest] = text
+                refs[path] = digest
+        if not refs:
+            payload_jsons.append(payload.model_dump_json())
+            continue
+        data = payload.model_dump(mode='json')
+        for path in refs:
+            owner, name = _locate(data['submission'], path)
+            owner[name] = ''
+        data['blobs'] = refs
+        payload_jsons.append(json.dumps(data))
+
+    if blobs:
+        await _store(redis_queue, blobs)
+    return payload_jsons
+
+
+async def _store(redis_queue: RedisQueue, blobs: dict[str, str]):
+    digests = list(blobs)
+    pp = redis_queue.redis.pipeline(transaction=False)
+    for digest in digests:
+        # renew the existing blobs, so they are not uploaded again
+        pp.expire(_blob_key(digest), app_config.BLOB_EXPIRE)
+    exists = await pp.execute()
+    missing = [digest for digest, ok in zip(digests, exists) if not ok]
+    if not missing:
+        return
+    pp = redis_queue.redis.pipeline(transaction=False)
+    for digest in missing:
+        pp.set(_blob_key(digest), zlib.compress(blobs[digest].encode()), ex=app_config.BLOB_EXPIRE)
+    await pp.execute()
+
+
+class _LruCache:
+    """Thread-safe LRU cache of blobs, bounded by the total length of the strings"""
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._size = 0
+        self._items: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: str):
+        if len(value) > self.max_size:
+            return
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = value
+            self._size += len(value)
+            while self._size > self.max_size:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+
+_cache: _LruCache | None = None
+
+
+def resolve(redis_queue: RedisQueue, payload: WorkPayload):
+    """Called by workers (sync mode) to load the blobs back into the submission of the payload"""
+    global _cache
+    if not payload.blobs:
+        return
+    if _cache is None:
+        _cache = _LruCache(app_config.BLOB_CACHE_MAX_MEMORY)
+
+    texts = {}
+    missing = []
+    for digest in set(payload.blobs.values()):
+        if (text := _cache.get(digest)) is not None:
+            texts[digest] = text
+        else:
+            missing.append(digest)
+    if missing:
+        pp = redis_queue.redis.pipeline(transaction=False)
+        for digest in missing:
+            pp.get(_blob_key(digest))
+        for digest, value in zip(missing, pp.execute()):
+            if value is None:
+                raise ValueError(f'Blob {digest} of work {payload.work_id} is not found. Expired?')
+            texts[digest] = zlib.decompress(value).decode()
+            _cache.put(digest, texts[digest])
+
+    for path, digest in payload.blobs.items():
+        owner, name = _locate(payload.submission, path)
+        setattr(owner, name, texts[digest])
+    payload.blobs = {}
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from app.version import __version__ as version
 
 
@@ -7,6 +8,8 @@ env = os.environ.get
 ERROR_CASE_SAVE_PATH = env('ERROR_CASE_SAVE_PATH', '')  # default empty, which means not save error case
 
 MAX_STDOUT_ERROR_LENGTH = int(env('MAX_STDOUT_ERROR_LENGTH', 1000))
+# the max total size of stdout and stderr of a process, which is killed if it prints more
+MAX_OUTPUT_SIZE = int(env('MAX_OUTPUT_SIZE', 64))  # default 64 MB, 0 means no limit
 
 # timeline:
 # |-----------------MAX_QUEUE_WAIT_TIME-------------------------------|
@@ -27,12 +30,40 @@ if LONG_BATCH_MAX_QUEUE_WAIT_TIME < 60 * 60 + MAX_PROCESS_TIME:
     raise ValueError('LONG_BATCH_MAX_QUEUE_WAIT_TIME must be bigger than 1 hour plus MAX_PROCESS_TIME')
 
 MAX_MEMORY = int(env('MAX_MEMORY', 256))  # default 256 MB
+# a delegated cgroup v2 directory, every execution runs in its own cgroup under it (see CgroupBackend).
+# default empty, which means the limits are set by rlimits. It falls back to rlimits if the cgroups can't be used.
+CGROUP_ROOT = env('CGROUP_ROOT', '')
+CGROUP_CPUS = float(env('CGROUP_CPUS', 1))  # the max cpus of an execution (cpu.max), 0 means no limit
+CGROUP_PIDS_MAX = int(env('CGROUP_PIDS_MAX', 64))  # the max processes/threads of an execution, 0 means no limit
 MAX_WORKERS = int(env('MAX_WORKERS', os.cpu_count())) or os.cpu_count()  # default os.cpu_count()
+# the worker processes are scaled between MIN_WORKERS and MAX_WORKERS by the queue length and the host load.
+MIN_WORKERS = int(env('MIN_WORKERS', MAX_WORKERS))  # default MAX_WORKERS, which means no autoscaling
+if not 1 <= MIN_WORKERS <= MAX_WORKERS:
+    raise ValueError('MIN_WORKERS must be between 1 and MAX_WORKERS')
+AUTOSCALE_INTERVAL = int(env('AUTOSCALE_INTERVAL', 5))  # default 5 seconds
+# the host is under pressure (so the workers are not scaled up, but scaled down) when
+# the 1-minute load average per cpu (excluding the running works of the workers) is above AUTOSCALE_MAX_LOAD,
+# or the available memory is below AUTOSCALE_MIN_AVAILABLE_MEMORY of the total memory.
+AUTOSCALE_MAX_LOAD = float(env('AUTOSCALE_MAX_LOAD', 1.0))
+AUTOSCALE_MIN_AVAILABLE_MEMORY = float(env('AUTOSCALE_MIN_AVAILABLE_MEMORY', 0.1))
+# pin every worker process (and its sandboxes) to a dedicated set of CPUS_PER_WORKER cpus in WORKER_CPUS (see CpuAllocator).
+# The cpu list is in the kernel format, like `2-15`. Default empty, which means the workers are not pinned.
+WORKER_CPUS = env('WORKER_CPUS', '')
+CPUS_PER_WORKER = int(env('CPUS_PER_WORKER', 1))
+if CPUS_PER_WORKER < 1:
+    raise ValueError('CPUS_PER_WORKER must be at least 1')
+# pin the api process to these cpus, like `0-1`, so it doesn't compete with the workers. Default empty, which means not pinned.
+API_CPUS = env('API_CPUS', '')
 
 RUN_WORKERS = int(env('RUN_WORKERS', 0))  # default 0, which means run workers in a separate process
 
+# the max works pushed to the queue in one round trip
 MAX_BATCH_CHUNK_SIZE = int(env('MAX_BATCH_CHUNK_SIZE', 2))  # 0 means no limit
 MAX_LONG_BATCH_CHUNK_SIZE = int(env('MAX_LONG_BATCH_CHUNK_SIZE', 100))
+# pace the batches by the capacity of the workers (see ADMISSION_WINDOW):
+# only the works which can be started before they are timed out are pushed to the queue,
+# and the rest are pushed when the workers catch up.
+BATCH_PACING = int(env('BATCH_PACING', 1))  # default 1, 0 means all works are pushed at once
 
 PYTHON_EXECUTOR_PATH = env('PYTHON_EXECUTOR_PATH', 'python3')
 CPP_COMPILER_PATH = env('CPP_COMPILER_PATH', 'g++')
@@ -41,6 +72,43 @@ PYTHON_EXECUTE_COMMAND = env('PYTHON_EXECUTE_COMMAND', f'{PYTHON_EXECUTOR_PATH}
 CPP_COMPILE_COMMAND = env('CPP_COMPILE_COMMAND', f'{CPP_COMPILER_PATH} -O2 -o {{exe}} {{source}}')
 CPP_EXECUTE_COMMAND = env('CPP_EXECUTE_COMMAND', '{exe}')
 
+# run python scripts by forking from a pre-warmed interpreter (zygote) in every worker,
+# instead of starting a new interpreter with PYTHON_EXECUTE_COMMAND.
+# Please note PYTHON_EXECUTE_COMMAND is ignored in this mode, so it can't be used with sandboxes.
+PYTHON_ZYGOTE = int(env('PYTHON_ZYGOTE', 0))  # default 0, which means disabled
+# modules imported by the zygote in advance (comma separated)
+PYTHON_ZYGOTE_PRELOAD_MODULES = [
+    m.strip() for m in env(
+        'PYTHON_ZYGOTE_PRELOAD_MODULES',
+        'sys,os,io,re,math,string,random,itertools,functools,collections,heapq,bisect,decimal,fractions'
+    ).split(',') if m.strip()
+]
+
+# node-local cache of compiled executables (and compile errors), shared by all workers in the node
+# set it to empty to disable the cache
+CPP_COMPILE_CACHE_DIR = env('CPP_COMPILE_CACHE_DIR', os.path.join(tempfile.gettempdir(), f'code-judge-{version}-compile-cache'))
+CPP_COMPILE_CACHE_MAX_SIZE = int(env('CPP_COMPILE_CACHE_MAX_SIZE', 1024))  # default 1024 MB
+# precompiled header of the common headers (comma separated), empty means disabled
+CPP_PCH_HEADERS = [h.strip() for h in env('CPP_PCH_HEADERS', 'bits/stdc++.h').split(',') if h.strip()]
+CPP_PCH_DIR = env('CPP_PCH_DIR', os.path.join(tempfile.gettempdir(), f'code-judge-{version}-pch'))
+
+# reusable workdirs on a memory-backed filesystem like /dev/shm (see WorkdirPool),
+# empty (default) means a new temp directory for every submission
+WORKDIR_POOL_DIR = env('WORKDIR_POOL_DIR', '')
+# every file written by a submission in a pooled workdir is limited to this size,
+# and workdirs using more than this are removed instead of being reused
+WORKDIR_QUOTA = int(env('WORKDIR_QUOTA', 64))  # default 64 MB
+
+# concurrent executions (threads) in every worker process,
+# which helps when the submissions are mostly blocked (sleep, io, compiling...)
+WORKER_CONCURRENCY = int(env('WORKER_CONCURRENCY', 1))
+if WORKER_CONCURRENCY < 1:
+    raise ValueError('WORKER_CONCURRENCY must be at least 1')
+# max running sandboxes in the node, shared by all workers (default MAX_WORKERS)
+# it is only enforced when MAX_WORKERS * WORKER_CONCURRENCY is bigger than it.
+MAX_SANDBOXES = int(env('MAX_SANDBOXES', MAX_WORKERS)) or MAX_WORKERS
+SANDBOX_SLOTS_DIR = env('SANDBOX_SLOTS_DIR', os.path.join(tempfile.gettempdir(), f'code-judge-{version}-sandbox-slots'))
+
 # TODO: support fakeredis for testing.
 REDIS_URI = env('REDIS_URI', '')
 if not REDIS_URI:
@@ -49,7 +117,75 @@ REDIS_KEY_PREFIX = env('REDIS_KEY_PREFIX', 'js')
 REDIS_RESULT_PREFIX = env('REDIS_RESULT_QUEUE_PREFIX', f'{REDIS_KEY_PREFIX}:{version}:result-queue:')
 REDIS_RESULT_EXPIRE = int(env('REDIS_RESULT_EXPIRE', 60))  # default 1 minute
 REDIS_RESULT_LONG_BATCH_EXPIRE = int(env('REDIS_RESULT_LONG_BATCH_EXPIRE', LONG_BATCH_MAX_QUEUE_WAIT_TIME))  # default 1 hour
+
+# async jobs (/jobs): the works of a job can wait in the queue for JOB_MAX_WAIT_TIME,
+# and the job (its state and results) is kept in redis for JOB_EXPIRE after it is submitted.
+JOB_MAX_WAIT_TIME = int(env('JOB_MAX_WAIT_TIME', LONG_BATCH_MAX_QUEUE_WAIT_TIME))  # default 1 hour
+JOB_EXPIRE = int(env('JOB_EXPIRE', JOB_MAX_WAIT_TIME + 24 * 60 * 60))  # default 1 day after the works are timed out
+if JOB_EXPIRE <= JOB_MAX_WAIT_TIME + MAX_PROCESS_TIME:
+    raise ValueError('JOB_EXPIRE must be bigger than JOB_MAX_WAIT_TIME plus MAX_PROCESS_TIME')
+JOB_MAX_PAGE_SIZE = int(env('JOB_MAX_PAGE_SIZE', 1000))  # max results returned by one `GET /jobs/{job_id}`
+REDIS_JOB_PREFIX = env('REDIS_JOB_PREFIX', f'{REDIS_KEY_PREFIX}:{version}:job:')
+# cache of deterministic results (keyed by the content hash of the submission and execution limits)
+# it also collapses the duplicated submissions in a batch
+# it's opt-in, as the results of nondeterministic solutions (random, time, hash ordering...) would be reused
+VERDICT_CACHE_EXPIRE = int(env('VERDICT_CACHE_EXPIRE', 0))  # default 0, which means disabled. 3600 for 1 hour for example
+VERDICT_CACHE_MAX_MEMORY = int(env('VERDICT_CACHE_MAX_MEMORY', 256)) * 1024 * 1024  # default 256 MB
+VERDICT_CACHE_MAX_ITEM_SIZE = int(env('VERDICT_CACHE_MAX_ITEM_SIZE', 16 * 1024))  # default 16 KB
+REDIS_VERDICT_CACHE_PREFIX = env('REDIS_VERDICT_CACHE_PREFIX', f'{REDIS_KEY_PREFIX}:{version}:verdict:')
+REDIS_VERDICT_CACHE_INDEX = f'{REDIS_VERDICT_CACHE_PREFIX}{{index}}'
+REDIS_VERDICT_CACHE_SIZE = f'{REDIS_VERDICT_CACHE_PREFIX}{{index}}:size'
+# the strings (solution, input, expected output) longer than BLOB_MIN_SIZE are stored once in redis
+# as compressed blobs keyed by their content hash, and the work payloads only carry the hashes.
+BLOB_MIN_SIZE = int(env('BLOB_MIN_SIZE', 1024))  # default 1 KB, 0 means disabled
+# the blobs must live longer than the works referring to them
+BLOB_EXPIRE = int(env('BLOB_EXPIRE', max(LONG_BATCH_MAX_QUEUE_WAIT_TIME, JOB_MAX_WAIT_TIME) + MAX_PROCESS_TIME))
+if BLOB_EXPIRE < max(LONG_BATCH_MAX_QUEUE_WAIT_TIME, JOB_MAX_WAIT_TIME) + MAX_PROCESS_TIME:
+    raise ValueError('BLOB_EXPIRE must be bigger than LONG_BATCH_MAX_QUEUE_WAIT_TIME/JOB_MAX_WAIT_TIME plus MAX_PROCESS_TIME')
+# every worker process caches the recently used blobs in memory
+BLOB_CACHE_MAX_MEMORY = int(env('BLOB_CACHE_MAX_MEMORY', 64)) * 1024 * 1024  # default 64 MB
+REDIS_BLOB_PREFIX = env('REDIS_BLOB_PREFIX', f'{REDIS_KEY_PREFIX}:{version}:blob:')
+
+REDIS_STATS_KEY = env('REDIS_STATS_KEY', f'{REDIS_KEY_PREFIX}:{version}:stats')
+REDIS_METRICS_KEY = env('REDIS_METRICS_KEY', f'{REDIS_KEY_PREFIX}:{version}:metrics')
+# the states of workers are reported by the worker manager of every host
+REDIS_WORKER_STATES_PREFIX = env('REDIS_WORKER_STATES_PREFIX', f'{REDIS_KEY_PREFIX}:{version}:worker-states:')
+REDIS_WORKER_STATES_EXPIRE = int(env('REDIS_WORKER_STATES_EXPIRE', 120))  # default 2 minutes
+
+# admission control: the api rejects a request at once with 429 (and Retry-After)
+# if the works ahead of it in the queue can't be finished before they are timed out.
+# The capacity of the workers is measured in the last ADMISSION_WINDOW seconds.
+ADMISSION_CONTROL = int(env('ADMISSION_CONTROL', 1))  # default 1, 0 means disabled
+ADMISSION_WINDOW = int(env('ADMISSION_WINDOW', 30))  # default 30 seconds
+# how often every api process reloads the queue lengths and the capacity from redis
+ADMISSION_REFRESH_INTERVAL = float(env('ADMISSION_REFRESH_INTERVAL', 1))  # default 1 second
+REDIS_CAPACITY_PREFIX = env('REDIS_CAPACITY_PREFIX', f'{REDIS_KEY_PREFIX}:{version}:capacity:')
+
 REDIS_WORK_QUEUE_NAME = env('WORK_QUEUE_NAME', f'{REDIS_KEY_PREFIX}:{version}:work-queue')
+# zset: works are popped from a sorted set, and lost if the worker dies while processing them.
+# stream: works are leased from a stream (consumer group), and redelivered to other workers
+#   if the lease is not renewed in WORK_QUEUE_LEASE_TIME (for example, the worker is killed).
+WORK_QUEUE_BACKEND = env('WORK_QUEUE_BACKEND', 'zset')
+if WORK_QUEUE_BACKEND not in ('zset', 'stream'):
+    raise ValueError('WORK_QUEUE_BACKEND must be zset or stream')
+REDIS_WORK_STREAM_NAME = env('WORK_STREAM_NAME', f'{REDIS_KEY_PREFIX}:{version}:work-stream')
+REDIS_WORK_STREAM_GROUP = env('WORK_STREAM_GROUP', 'workers')
+WORK_QUEUE_LEASE_TIME = int(env('WORK_QUEUE_LEASE_TIME', 30))  # default 30 seconds
+# a work is failed with internal error after it is delivered so many times (it may crash the workers)
+WORK_QUEUE_MAX_DELIVERIES = int(env('WORK_QUEUE_MAX_DELIVERIES', 3))
+
+# the work queue has a lane for every priority (see `WorkPriority`),
+# and workers always take works from the higher lanes first.
+# In a lane, tenants (the `X-Tenant` header of the requests) share the workers in proportion to their weights
+# (zset backend only, works are taken in the order they are submitted in stream mode).
+# for example `team-a:3,team-b:1`. The weight of the tenants not listed is 1.
+TENANT_WEIGHTS = {
+    tenant.strip(): float(weight)
+    for tenant, weight in (item.rsplit(':', 1) for item in env('TENANT_WEIGHTS', '').split(',') if item.strip())
+}
+if any(weight <= 0 for weight in TENANT_WEIGHTS.values()):
+    raise ValueError('TENANT_WEIGHTS must be positive')
+DEFAULT_TENANT = 'default'
 
 REDIS_WORK_QUEUE_BLOCK_TIMEOUT = int(env('REDIS_WORK_QUEUE_BLOCK_TIMEOUT', 30))  # default 30 seconds
 REDIS_WORKER_ID_PREFIX = env('REDIS_WORKER_ID_PREFIX', f'{REDIS_KEY_PREFIX}:{version}:work-ids:')
@@ -59,5 +195,13 @@ REDIS_WORKER_REGISTER_EXPIRE = int(env('REDIS_WORKER_REGISTER_TIMEOUT', 120 + RE
 if REDIS_WORKER_REGISTER_EXPIRE < REDIS_WORK_QUEUE_BLOCK_TIMEOUT + MAX_PROCESS_TIME:
     raise ValueError('REDIS_WORKER_REGISTER_EXPIRE must be bigger than REDIS_WORK_QUEUE_BLOCK_TIMEOUT + MAX_PROCESS_TIME')
 
+# pipelined worker: prefetch works and publish results in background threads,
+# so the worker doesn't wait for redis between works.
+WORKER_PIPELINE = int(env('WORKER_PIPELINE', 0))
+# how many works are prefetched besides the running one
+WORKER_PREFETCH_COUNT = int(env('WORKER_PREFETCH_COUNT', 1))
+if WORKER_PIPELINE and WORKER_PREFETCH_COUNT < 1:
+    raise ValueError('WORKER_PREFETCH_COUNT must be at least 1')
+
 # we use socket timeout to avoid blocking forever if a bad connection is used
 REDIS_SOCKET_TIMEOUT = int(env('REDIS_SOCKET_TIMEOUT', 60)) # default 1 minute
@@ -0,0 +1,185 @@
+"""
+Async jobs: a batch of submissions is submitted with `POST /jobs`, and its results are fetched later.
+
+Everything of a job is kept in redis, so any api process can serve any job
+(and the jobs survive api restarts and client disconnections):
+- `meta`: a hash of the job info (sub_id, total, created_at, status).
+- `sub-ids`: the sub_ids of the submissions, only used to fill the results of unfinished submissions.
+- `results`: a hash from the index of a submission to its `WorkResult`.
+  Workers store the results into it directly, so no api process waits for them.
+  Results are stored with HSETNX, so the first result of a submission wins
+  (a work may be redelivered in stream mode, or finished after the job is timed out/cancelled).
+Cancelled works are not removed from the work queue, but skipped by the workers.
+"""
+import json
+import uuid
+from time import time
+
+import app.config as app_config
+from app.libs.redis_queue import RedisQueue
+from app.libs.utils import chunkify
+import app.blobs as blobs
+import app.verdict_cache as verdict_cache
+import app.work_queue as work_queue
+from app.judge import from_work_result, with_sub_id
+from app.model import (
+    BatchSubmission,
+    BatchStreamResult,
+    JobInfo,
+    JobStatus,
+    ResultReason,
+    SubmissionResult,
+    WorkPayload,
+    WorkPriority,
+    WorkResult,
+)
+
+
+def _key(job_id: str, name: str) -> str:
+    # use a hash tag to make sure all keys of a job are in the same slot in redis cluster
+    return f'{app_config.REDIS_JOB_PREFIX}{{{job_id}}}:{name}'
+
+
+def meta_key(job_id: str) -> str:
+    return _key(job_id, 'meta')
+
+
+def results_key(job_id: str) -> str:
+    return _key(job_id, 'results')
+
+
+def _sub_ids_key(job_id: str) -> str:
+    return _key(job_id, 'sub-ids')
+
+
+def _deadline(created_at: float) -> float:
+    # the works taken by workers before JOB_MAX_WAIT_TIME can still be finished after it
+    return created_at + app_config.JOB_MAX_WAIT_TIME + work_queue.in_progress_grace_time()
+
+
+def is_skipped(redis_queue: RedisQueue, payload: WorkPayload) -> bool:
+    """Called by workers (sync mode) before running a work of a job"""
+    if time() - payload.timestamp > app_config.JOB_MAX_WAIT_TIME:
+        return True
+    status = redis_queue.redis.hget(meta_key(payload.job_id), 'status')
+    # the job is cancelled or expired
+    return status is None or status.decode() != JobStatus.RUNNING.value
+
+
+async def submit(
+    redis_queue: RedisQueue, batch_sub: BatchSubmission, endpoint: str = '', tenant: str = app_config.DEFAULT_TENANT
+) -> JobInfo:
+    job_id = str(uuid.uuid4())
+    subs = batch_sub.submissions
+    created_at = time()
+    pp = redis_queue.redis.pipeline(transaction=False)
+    pp.hset(meta_key(job_id), mapping={
+        'sub_id': batch_sub.sub_id,
+        'total': len(subs),
+        'created_at': created_at,
+        'status': JobStatus.RUNNING.value,
+    })
+    pp.set(_sub_ids_key(job_id), json.dumps([sub.sub_id for sub in subs]))
+    for key in (meta_key(job_id), _sub_ids_key(job_id)):
+        pp.expire(key, app_config.JOB_EXPIRE)
+    await pp.execute()
+
+    run_indexes = list(range(len(subs)))
+    if verdict_cache.enabled():
+        keys = [verdict_cache.verdict_key(sub) for sub in subs]
+        key_results = await verdict_cache.get_many(redis_queue, list(set(keys)))
+        run_indexes = [index for index, key in enumerate(keys) if key not in key_results]
+        await verdict_cache.record_stats(redis_queue, len(subs) - len(run_indexes), len(run_indexes))
+        await _store_results(redis_queue, job_id, {
+            index: with_sub_id(key_results[key], subs[index])
+            for index, key in enumerate(keys) if key in key_results
+        })
+
+    payloads = [
+        WorkPayload(
+            work_id=f'{job_id}:{index}', submission=subs[index], long_running=True,
+            endpoint=endpoint, job_id=job_id, job_index=index,
+        )
+        for index in run_indexes
+    ]
+    for payload_chunk in chunkify(payloads, app_config.MAX_LONG_BATCH_CHUNK_SIZE or max(len(payloads), 1)):
+        payload_jsons = await blobs.dump_payloads(redis_queue, payload_chunk)
+        await work_queue.push(
+            redis_queue, dict(zip(payload_jsons, (payload.timestamp for payload in payload_chunk))),
+            WorkPriority.LONG_BATCH, tenant,
+        )
+
+    return JobInfo(
+        job_id=job_id, sub_id=batch_sub.sub_id, status=JobStatus.RUNNING,
+        total=len(subs), finished=len(subs) - len(run_indexes), created_at=created_at,
+    )
+
+
+async def _store_results(redis_queue: RedisQueue, job_id: str, results: dict[int, SubmissionResult]):
+    if not results:
+        return
+    pp = redis_queue.redis.pipeline(transaction=False)
+    for index, result in results.items():
+        work_result = WorkResult(work_id=f'{job_id}:{index}', result=result.model_dump(mode='json'))
+        pp.hsetnx(results_key(job_id), str(index), work_result.model_dump_json())
+    pp.expire(results_key(job_id), app_config.JOB_EXPIRE)
+    await pp.execute()
+
+
+async def _fill_unfinished(redis_queue: RedisQueue, job_id: str, total: int, reason: ResultReason, cost: float):
+    """Store `reason` as the results of the unfinished submissions"""
+    finished = {int(index) for index in await redis_queue.redis.hkeys(results_key(job_id))}
+    sub_ids = json.loads(await redis_queue.redis.get(_sub_ids_key(job_id)) or '[]')
+    for indexes in chunkify([index for index in range(total) if index not in finished], 1000):
+        await _store_results(redis_queue, job_id, {
+            index: SubmissionResult(
+                sub_id=sub_ids[index] if index < len(sub_ids) else '',
+                run_success=False, success=False, cost=cost, reason=reason,
+            )
+            for index in indexes
+        })
+
+
+async def get(redis_queue: RedisQueue, job_id: str, offset: int = 0, limit: int = 0) -> JobInfo | None:
+    """Get the job info with the available results of the submissions in [offset, offset + limit)"""
+    meta = await redis_queue.get_fields(meta_key(job_id))
+    if not meta:
+        return None
+    meta = {k.decode(): v.decode() for k, v in meta.items()}
+    total = int(meta['total'])
+    created_at = float(meta['created_at'])
+    status = JobStatus(meta['status'])
+
+    finished = await redis_queue.redis.hlen(results_key(job_id))
+    if status == JobStatus.RUNNING and finished < total and time() > _deadline(created_at):
+        # the remaining works are timed out, or lost (for example, the workers are killed in zset mode)
+        await _fill_unfinished(redis_queue, job_id, total, ResultReason.QUEUE_TIMEOUT, time() - created_at)
+        finished = await redis_queue.redis.hlen(results_key(job_id))
+    if status == JobStatus.RUNNING and finished >= total:
+        status = JobStatus.DONE
+
+    indexes = list(range(offset, min(offset + limit, total)))
+    results = []
+    if indexes:
+        values = await redis_queue.redis.hmget(results_key(job_id), [str(index) for index in indexes])
+        for index, value in zip(indexes, values):
+            if value is None:
+                continue
+            result = from_work_result(WorkResult.model_validate_json(value))
+            results.append(BatchStreamResult(index=index, sub_id=result.sub_id, result=result))
+
+    return JobInfo(
+        job_id=job_id, sub_id=meta['sub_id'], status=status, total=total, finished=finished,
+        created_at=created_at, results=results,
+        next_offset=offset + limit if indexes and offset + limit < total else None,
+    )
+
+
+async def cancel(redis_queue: RedisQueue, job_id: str) -> JobInfo | None:
+    """Cancel the job. The unfinished submissions are skipped. It is a no-op if the job is done."""
+    job = await get(redis_queue, job_id)
+    if job is None or job.status != JobStatus.RUNNING:
+        return job
+    await redis_queue.redis.hset(meta_key(job_id), 'status', JobStatus.CANCELLED.value)
+    await _fill_unfinished(redis_queue, job_id, job.total, ResultReason.SKIPPED, 0)
+    return await get(redis_queue, job_id)
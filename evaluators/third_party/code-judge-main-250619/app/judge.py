@@ -1,15 +1,25 @@
 import logging
 from time import time
+from typing import AsyncIterator
 import asyncio
 import uuid
 
 import app.config as app_config
 from app.libs.redis_queue import RedisQueue
 from app.libs.utils import chunkify
+import app.verdict_cache as verdict_cache
+import app.work_queue as work_queue
+import app.admission as admission
+import app.blobs as blobs
+import app.metrics as metrics
 from app.model import (
     Submission,
     SubmissionResult,
+    MultiCaseSubmission,
+    MultiCaseSubmissionResult,
     WorkPayload,
+    WorkResult,
+    WorkPriority,
     BatchSubmission,
     BatchSubmissionResult,
     ResultReason,
@@ -19,157 +29,358 @@ from app.model import (
 logger = logging.getLogger(__name__)
 
 
-def _to_result(submission: Submission, start_time: float, result_json: tuple[str, bytes] | None):
-    if result_json is None: # timeout
+def _set_publish_time(result: SubmissionResult | MultiCaseSubmissionResult, work_result: WorkResult):
+    if result.timings is not None:
+        # the clocks of the api and the worker may be skewed
+        result.timings.publish = max(time() - work_result.finished_at, 0)
+
+
+def _set_collect_time(result: SubmissionResult | MultiCaseSubmissionResult, received_time: float):
+    if result.timings is not None:
+        result.timings.collect = time() - received_time
+
+
+def from_work_result(work_result: WorkResult) -> SubmissionResult:
+    result = SubmissionResult.model_validate(work_result.result)
+    if result.reason == ResultReason.UNSPECIFIED and not result.run_success and result.cost >= app_config.MAX_EXECUTION_TIME:
+        result.reason = ResultReason.WORKER_TIMEOUT
+    _set_publish_time(result, work_result)
+    return result
+
+
+def _to_result(submission: Submission, start_time: float, work_result: WorkResult | None):
+    if work_result is None: # timeout
         return SubmissionResult(sub_id=submission.sub_id, run_success=False, success=False, cost=time() - start_time, reason=ResultReason.QUEUE_TIMEOUT)
     else:
-        result = SubmissionResult.model_validate_json(result_json[1])
-        if not result.run_success and result.cost >= app_config.MAX_EXECUTION_TIME:
-            result.reason = ResultReason.WORKER_TIMEOUT
-        return result
+        return from_work_result(work_result)
+
+
+def _to_multi_case_result(submission: MultiCaseSubmission, start_time: float, work_result: WorkResult | None):
+    if work_result is None: # timeout
+        result = MultiCaseSubmissionResult(sub_id=submission.sub_id, run_success=False, success=False, cost=time() - start_time, reason=ResultReason.QUEUE_TIMEOUT)
+    else:
+        result = MultiCaseSubmissionResult.model_validate(work_result.result)
+        _set_publish_time(result, work_result)
+    return _fill_case_results(submission, result)
+
+
+def _fill_case_results(submission: MultiCaseSubmission, result: MultiCaseSubmissionResult):
+    if len(result.results) != len(submission.cases):
+        # the submission failed as a whole
+        result.results = [
+            SubmissionResult(sub_id=submission.case_sub_id(i), run_success=False, success=False, cost=0, reason=result.reason)
+            for i in range(len(submission.cases))
+        ]
+    for case_result in result.results:
+        if not case_result.run_success and case_result.cost >= app_config.MAX_EXECUTION_TIME:
+            case_result.reason = ResultReason.WORKER_TIMEOUT
+    if result.reason == ResultReason.UNSPECIFIED:
+        result.reason = next((r.reason for r in result.results if not r.success), ResultReason.UNSPECIFIED)
+    return result
 
 
-async def judge(redis_queue: RedisQueue, submission: Submission):
+async def _run_work(
+    redis_queue: RedisQueue, submission: Submission | MultiCaseSubmission, max_wait_time: int, endpoint: str, tenant: str,
+    verdict_only: bool,
+):
+    payload = WorkPayload(submission=submission, endpoint=endpoint, verdict_only=verdict_only)
+    payload_json, = await blobs.dump_payloads(redis_queue, [payload])
+    await work_queue.push(redis_queue, {payload_json: time()}, WorkPriority.INTERACTIVE, tenant)
+    result_queue_name = f'{app_config.REDIS_RESULT_PREFIX}{payload.work_id}'
+    result_json = await redis_queue.queue.block_pop(result_queue_name, timeout=max_wait_time)
+    await redis_queue.delete(result_queue_name)
+    if result_json is None:
+        return None
+    return WorkResult.model_validate_json(result_json[1])
+
+
+async def _record_metrics(
+    redis_queue: RedisQueue, endpoint: str, start_time: float,
+    results: list[tuple[str, SubmissionResult | MultiCaseSubmissionResult]]
+):
+    """`results` are (language, result) of the submissions in a request"""
+    latency = time() - start_time
+    m = metrics.Metrics()
+    for language, result in results:
+        m.observe('request_seconds', latency, language=language, endpoint=endpoint)
+        m.inc('results_total', language=language, endpoint=endpoint,
+              success=str(result.success).lower(), reason=result.reason.value or 'none')
+    try:
+        await metrics.flush(redis_queue, m)
+    except Exception:
+        logger.exception('Failed to record metrics')
+
+
+async def judge(
+    redis_queue: RedisQueue, submission: Submission, endpoint: str = '', tenant: str = app_config.DEFAULT_TENANT,
+    verdict_only: bool = False,
+):
     start_time = time()
+    result = await _judge(redis_queue, submission, start_time, endpoint, tenant, verdict_only)
+    await _record_metrics(redis_queue, endpoint, start_time, [(submission.type, result)])
+    return result
+
+
+async def _judge(
+    redis_queue: RedisQueue, submission: Submission, start_time: float, endpoint: str, tenant: str, verdict_only: bool
+):
     try:
-        payload = WorkPayload(submission=submission)
-        payload_json = payload.model_dump_json()
-        await redis_queue.pqueue.push(app_config.REDIS_WORK_QUEUE_NAME, {payload_json: time()})
-        result_queue_name = f'{app_config.REDIS_RESULT_PREFIX}{payload.work_id}'
-        result_json = await redis_queue.queue.block_pop(result_queue_name, timeout=app_config.MAX_QUEUE_WAIT_TIME)
-        await redis_queue.delete(result_queue_name)
-        return _to_result(submission, start_time, result_json)
+        if verdict_cache.enabled():
+            key = verdict_cache.verdict_key(submission, verdict_only)
+            cached = (await verdict_cache.get_many(redis_queue, [key])).get(key)
+            await verdict_cache.record_stats(redis_queue, int(cached is not None), int(cached is None))
+            if cached is not None:
+                return cached.model_copy(update={'sub_id': submission.sub_id})
+        work_result = await _run_work(
+            redis_queue, submission, app_config.MAX_QUEUE_WAIT_TIME, endpoint, tenant, verdict_only
+        )
+        received_time = time()
+        result = _to_result(submission, start_time, work_result)
+        if verdict_cache.enabled():
+            await verdict_cache.put_many(redis_queue, {key: result})
+        _set_collect_time(result, received_time)
+        return result
     except Exception:
         logger.exception(f'Failed to judge submission {submission.sub_id}')
         return SubmissionResult(sub_id=submission.sub_id, run_success=False, success=False, cost=time() - start_time, reason=ResultReason.INTERNAL_ERROR)
 
 
-async def _judge_batch_impl(redis_queue: RedisQueue, subs: list[Submission], long_batch=False):
+async def judge_multi_case(
+    redis_queue: RedisQueue, submission: MultiCaseSubmission, endpoint: str = '', tenant: str = app_config.DEFAULT_TENANT,
+    verdict_only: bool = False,
+):
+    start_time = time()
+    result = await _judge_multi_case(redis_queue, submission, start_time, endpoint, tenant, verdict_only)
+    await _record_metrics(redis_queue, endpoint, start_time, [(submission.language, result)])
+    return result
+
+
+async def _judge_multi_case(
+    redis_queue: RedisQueue, submission: MultiCaseSubmission, start_time: float, endpoint: str, tenant: str,
+    verdict_only: bool,
+):
+    # all cases are run one by one in the same worker
+    max_wait_time = app_config.MAX_QUEUE_WORK_LIFE_TIME + app_config.MAX_PROCESS_TIME * len(submission.cases)
+    try:
+        work_result = await _run_work(redis_queue, submission, max_wait_time, endpoint, tenant, verdict_only)
+        received_time = time()
+        result = _to_multi_case_result(submission, start_time, work_result)
+        _set_collect_time(result, received_time)
+        return result
+    except Exception:
+        logger.exception(f'Failed to judge submission {submission.sub_id}')
+        return _fill_case_results(submission, MultiCaseSubmissionResult(
+            sub_id=submission.sub_id, run_success=False, success=False, cost=time() - start_time, reason=ResultReason.INTERNAL_ERROR
+        ))
+
+
+def with_sub_id(result: SubmissionResult, sub: Submission):
+    return result if result.sub_id == sub.sub_id else result.model_copy(update={'sub_id': sub.sub_id})
+
+
+async def _iter_judge_batch(
+    redis_queue: RedisQueue, subs: list[Submission], long_batch=False, endpoint: str = '',
+    tenant: str = app_config.DEFAULT_TENANT, verdict_only: bool = False,
+) -> AsyncIterator[tuple[int, SubmissionResult]]:
+    """Yield (index, result) of the submissions in the order they are finished"""
+    if not verdict_cache.enabled():
+        async for index, result in _iter_run_batch(redis_queue, subs, long_batch, endpoint, tenant, verdict_only):
+            yield index, result
+        return
+
+    # collapse duplicated submissions, and only run the ones not in the cache
+    key_indexes: dict[str, list[int]] = {}
+    for index, sub in enumerate(subs):
+        key_indexes.setdefault(verdict_cache.verdict_key(sub, verdict_only), []).append(index)
+    key_results = await verdict_cache.get_many(redis_queue, list(key_indexes))
+    run_keys = [key for key in key_indexes if key not in key_results]
+    await verdict_cache.record_stats(redis_queue, len(subs) - len(run_keys), len(run_keys))
+
+    # cached results are available right away
+    for key, result in key_results.items():
+        for index in key_indexes[key]:
+            yield index, with_sub_id(result, subs[index])
+
+    if not run_keys:
+        return
+    run_key_results = {}
+    run_subs = [subs[key_indexes[key][0]] for key in run_keys]
+    async for run_index, result in _iter_run_batch(redis_queue, run_subs, long_batch, endpoint, tenant, verdict_only):
+        key = run_keys[run_index]
+        run_key_results[key] = result
+        # fan out the result to the duplicated submissions
+        for index in key_indexes[key]:
+            yield index, with_sub_id(result, subs[index])
+    await verdict_cache.put_many(redis_queue, run_key_results)
+
+
+async def _iter_run_batch(
+    redis_queue: RedisQueue, subs: list[Submission], long_batch=False, endpoint: str = '',
+    tenant: str = app_config.DEFAULT_TENANT, verdict_only: bool = False,
+) -> AsyncIterator[tuple[int, SubmissionResult]]:
     start_time = time()
     max_wait_time = app_config.LONG_BATCH_MAX_QUEUE_WAIT_TIME \
         if long_batch else app_config.MAX_QUEUE_WAIT_TIME
     batch_chunk_size = app_config.MAX_LONG_BATCH_CHUNK_SIZE \
         if long_batch else app_config.MAX_BATCH_CHUNK_SIZE
+    priority = WorkPriority.LONG_BATCH if long_batch else WorkPriority.BATCH
     # use a hash tag to make sure all payloads are in the same slot in redis cluster
     hash_tag = '{' + str(uuid.uuid4()) + '}'
-    sub_chunks = chunkify(subs, batch_chunk_size)
-
-    async def _submit(payloads: list[WorkPayload]):
-        # payload.work_id is different, so we can safely use dict
-        payload_jsons = {payload.model_dump_json(): payload.timestamp for payload in payloads}
-        await redis_queue.pqueue.push(app_config.REDIS_WORK_QUEUE_NAME, payload_jsons)
-
-    async def _sync_pop(queue_names: list[str]):
-        step_results = await redis_queue.queue.pop_multi(*queue_names)
-        name_results = [(k, v) for k, v in zip(queue_names, step_results) if v is not None]
-        return name_results
-
-    async def _async_pop(queue_names: list[str], timeout: int):
-        name_result = await redis_queue.queue.block_pop(*queue_names, timeout=timeout)
-        if name_result is not None:
-            return [(name_result[0].decode(), name_result[1])]
-        return []
-
-    async def _pop_results(queue_names: list[str], timeout: int):
-        name_results = await _sync_pop(queue_names)
-        if not name_results and timeout > 0:
-            name_results = await _async_pop(queue_names, min(timeout, app_config.MAX_PROCESS_TIME))
-        return name_results
-
-    async def _get_result(payloads: list[WorkPayload], max_chunk_wait_time):
-        """max_chunk_wait_time <= 0 means no wait (which is different from block_pop)"""
-        result_queue_names = {
-            f'{app_config.REDIS_RESULT_PREFIX}{payload.work_id}': payload
-            for payload in payloads
-        }
-        results = {}
-        result_start_time = time()
-        left_time = max_chunk_wait_time
-        start_working_time = 0
-        left_result_queue_names = list(result_queue_names.keys())
-
-        while left_result_queue_names:
-            max_timestamp = max(
-                result_queue_names[result_queue_name].timestamp
-                for result_queue_name in left_result_queue_names
+    # all workers push the results of this batch to the same queue,
+    # so results are collected in the order they are finished, no matter which chunk they belong to.
+    result_queue_name = f'{app_config.REDIS_RESULT_PREFIX}{hash_tag}'
+    payloads = {}
+    indexes = {}
+    scores = {}
+    # the submissions from next_index are not pushed yet
+    next_index = 0
+    # (push time, count), to know the works which are not counted in the capacity snapshot
+    push_history: list[tuple[float, int]] = []
+
+    async def _push_more():
+        """Push the works which can be started before they are timed out"""
+        nonlocal next_index
+        count = len(subs) - next_index
+        if app_config.BATCH_PACING and count > 0:
+            snapshot = await admission.snapshot(redis_queue)
+            room = snapshot.room(priority) if snapshot is not None else None
+            if room is not None:
+                room -= sum(n for pushed_at, n in push_history if pushed_at >= snapshot.loaded_at)
+                # always keep at least one work in flight, so the batch makes progress
+                count = min(count, max(room, 0 if pending else 1))
+        for sub_chunk in chunkify(list(range(next_index, next_index + count)), batch_chunk_size or max(count, 1)):
+            payload_chunk = []
+            for idx in sub_chunk:
+                # the timestamp (and the queue life time) starts when the work is pushed
+                payload = WorkPayload(
+                    work_id=f'{hash_tag}:{idx}', submission=subs[idx], long_running=long_batch,
+                    result_queue_name=result_queue_name, endpoint=endpoint, verdict_only=verdict_only,
+                )
+                payloads[payload.work_id] = payload
+                indexes[payload.work_id] = idx
+                payload_chunk.append(payload)
+            # payload.work_id is different, so we can safely use dict
+            payload_jsons = dict(zip(
+                await blobs.dump_payloads(redis_queue, payload_chunk),
+                (payload.timestamp for payload in payload_chunk),
+            ))
+            chunk_scores = await work_queue.push(redis_queue, payload_jsons, priority, tenant)
+            scores.update(zip((payload.work_id for payload in payload_chunk), chunk_scores))
+            pending.update(payload.work_id for payload in payload_chunk)
+        if count > 0:
+            push_history.append((time(), count))
+        next_index += count
+
+    async def _pop_results(count: int, timeout: int) -> list[bytes]:
+        result_jsons = await redis_queue.queue.pop_many(result_queue_name, count)
+        if not result_jsons and timeout > 0:
+            name_result = await redis_queue.queue.block_pop(
+                result_queue_name, timeout=min(timeout, app_config.MAX_PROCESS_TIME)
             )
-            name_results = await _pop_results(left_result_queue_names, left_time)
-            if not name_results: # if no result, check if timeout
+            result_jsons = [name_result[1]] if name_result is not None else []
+        return result_jsons or []
+
+    pending = set()
+    left_time = max_wait_time
+    start_working_time = 0
+    try:
+        while pending or next_index < len(subs):
+            await _push_more()
+            all_pushed = next_index == len(subs)
+            max_score = max(scores[work_id] for work_id in pending) if pending else 0
+            # check the capacity again in a second if some works are held back
+            result_jsons = await _pop_results(len(pending), left_time if all_pushed else min(left_time, 1))
+            if not result_jsons and all_pushed: # if no result, check if timeout
                 if start_working_time == 0:
-                    # the queue is ordered by timestamp
-                    next_payload_info = await redis_queue.pqueue.peak(app_config.REDIS_WORK_QUEUE_NAME)
+                    # the lane is ordered by score
+                    next_payload_info = await work_queue.peak(redis_queue, priority)
                     if not next_payload_info:
                         start_working_time = time()
                     else:
-                        # before next_work_timestamp, all work is done or processing.
-                        # so if it is bigger than max_timestamp, we can assume all work is done or in progress.
-                        next_work_timestamp = next_payload_info[1]
-                        if next_work_timestamp > max_timestamp:
+                        # before next_work_score, all work is done or processing.
+                        # so if it is bigger than max_score, we can assume all work is done or in progress.
+                        next_work_score = next_payload_info[1]
+                        if next_work_score > max_score:
                             start_working_time = time()
                 else:
                     # if start_working_time is set, it means all work is done or in progress.
-                    # so we only wait for app_config.MAX_PROCESS_TIME for them to finish.
+                    # so we only wait for app_config.MAX_PROCESS_TIME (plus the lease time in stream mode) for them to finish.
                     # if it is still not finished, we assume some error happened.
                     # and we can break the loop.
-                    if time() - start_working_time > app_config.MAX_PROCESS_TIME:
-                        logger.warning(f'No result for {len(left_result_queue_names)} submissions. '
+                    if time() - start_working_time > work_queue.in_progress_grace_time():
+                        logger.warning(f'No result for {len(pending)} submissions. '
                                        f'Assuming all submissions are timed out.')
                         logger.warning('This is mostly caused by redis OOM or workers killed or potential bug. ')
                         break
             else:
                 start_working_time = 0
 
-            for name_result in name_results:
-                result_queue_name, _ = name_result
-                payload = result_queue_names[result_queue_name]
-                results[result_queue_name] = _to_result(payload.submission, start_time, name_result)
-                left_result_queue_names.remove(result_queue_name)
+            for result_json in result_jsons:
+                work_result = WorkResult.model_validate_json(result_json)
+                if work_result.work_id not in pending:
+                    # a work can be processed twice if it is redelivered in stream mode
+                    logger.warning(f'Unexpected result for work {work_result.work_id}. Ignored.')
+                    continue
+                pending.remove(work_result.work_id)
+                yield indexes[work_result.work_id], _to_result(payloads[work_result.work_id].submission, start_time, work_result)
 
-            left_time = max_chunk_wait_time - int(time() - result_start_time)
+            left_time = max_wait_time - int(time() - start_time)
             if left_time <= 0:
                 break
+    finally:
+        await redis_queue.delete(result_queue_name)
 
-        # fill non-ready work as timeout
-        for result_queue_name in left_result_queue_names:
-            results[result_queue_name] = _to_result(result_queue_names[result_queue_name].submission, start_time, None)
-
-        await redis_queue.delete(*result_queue_names)
-        return [results[result_queue_name] for result_queue_name in result_queue_names]
-
-    # submit all submissions to the queue
-    payload_chunks = []
-    for sub_chunk_id, sub_chunk in enumerate(sub_chunks):
-        payload_chunk = [
-            WorkPayload(work_id=f'{hash_tag}:{sub_chunk_id}-{idx}', submission=sub, long_running=long_batch)
-            for idx, sub in enumerate(sub_chunk)
-        ]
-        payload_chunks.append(payload_chunk)
-        await _submit(payload_chunk)
-
-    results = []
-    wait_start_time = time()
-    for chunk in payload_chunks:
-        # get all results from the queue
-        left_time = max_wait_time - int(time() - wait_start_time)
-        chunk_results = await _get_result(chunk, left_time)
-        results.extend(chunk_results)
-    return results
+    # fill non-ready work (and the works never pushed) as timeout
+    for work_id in sorted(pending, key=indexes.get):
+        yield indexes[work_id], _to_result(payloads[work_id].submission, start_time, None)
+    for idx in range(next_index, len(subs)):
+        yield idx, _to_result(subs[idx], start_time, None)
 
 
-async def judge_batch(redis_queue: RedisQueue, batch_sub: BatchSubmission, long_batch=False):
+async def iter_judge_batch(
+    redis_queue: RedisQueue, batch_sub: BatchSubmission, long_batch=False, endpoint: str = '',
+    tenant: str = app_config.DEFAULT_TENANT, verdict_only: bool = False,
+) -> AsyncIterator[tuple[int, SubmissionResult]]:
+    """
+    Yield (index, result) of the submissions in the batch as soon as they are finished.
+    Every submission is yielded exactly once, even if the batch fails.
+    """
+    start_time = time()
+    results: dict[int, SubmissionResult] = {}
     try:
-        results = await _judge_batch_impl(redis_queue, batch_sub.submissions, long_batch)
+        async for index, result in _iter_judge_batch(
+            redis_queue, batch_sub.submissions, long_batch, endpoint, tenant, verdict_only
+        ):
+            results[index] = result
+            yield index, result
     except Exception:
         logger.exception(f'Failed to judge batch submission {batch_sub.sub_id}')
-        results=[
-            SubmissionResult(
-                sub_id=sub.sub_id,
-                run_success=False,
-                success=False,
-                cost=0,
-                reason=ResultReason.INTERNAL_ERROR
-            ) for sub in batch_sub.submissions
-        ]
+        for index, sub in enumerate(batch_sub.submissions):
+            if index not in results:
+                results[index] = SubmissionResult(
+                    sub_id=sub.sub_id,
+                    run_success=False,
+                    success=False,
+                    cost=0,
+                    reason=ResultReason.INTERNAL_ERROR
+                )
+                yield index, results[index]
+    await _record_metrics(redis_queue, endpoint, start_time, [
+        (sub.type, results[index]) for index, sub in enumerate(batch_sub.submissions)
+    ])
+
+
+async def judge_batch(
+    redis_queue: RedisQueue, batch_sub: BatchSubmission, long_batch=False, endpoint: str = '',
+    tenant: str = app_config.DEFAULT_TENANT, verdict_only: bool = False,
+):
+    results: list[SubmissionResult | None] = [None] * len(batch_sub.submissions)
+    received_times = {}
+    async for index, result in iter_judge_batch(redis_queue, batch_sub, long_batch, endpoint, tenant, verdict_only):
+        results[index] = result
+        received_times[index] = time()
+    for index, received_time in received_times.items():
+        _set_collect_time(results[index], received_time)
     return BatchSubmissionResult(
         sub_id=batch_sub.sub_id,
         results=results
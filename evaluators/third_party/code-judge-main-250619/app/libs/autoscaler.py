@@ -0,0 +1,68 @@
+import math
+import os
+
+
+def _available_memory_ratio() -> float | None:
+    """MemAvailable / MemTotal of /proc/meminfo, None if it can't be read"""
+    values = {}
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('MemTotal', 'MemAvailable'):
+                    values[name] = int(value.split()[0])
+    except (OSError, ValueError):
+        return None
+    if not values.get('MemTotal') or 'MemAvailable' not in values:
+        return None
+    return values['MemAvailable'] / values['MemTotal']
+
+
+class Autoscaler:
+    """
+    Decide the number of worker processes between `min_workers` and `max_workers`.
+
+    The workers are scaled up at once to run all the running and queued works,
+    and scaled down one by one (every decision) when they are more than needed,
+    so a short gap between batches doesn't drain all the workers.
+    When the host is under pressure (cpu load or memory, see `under_pressure`),
+    the workers are scaled down one by one regardless of the queue, to leave the host to other jobs.
+    """
+    def __init__(
+        self, min_workers: int, max_workers: int, concurrency: int = 1,
+        max_load: float = 1.0, min_available_memory: float = 0.1,
+    ):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.concurrency = concurrency
+        self.max_load = max_load
+        self.min_available_memory = min_available_memory
+
+    @property
+    def enabled(self) -> bool:
+        return self.min_workers < self.max_workers
+
+    def under_pressure(self, busy: int = 0) -> bool:
+        """
+        True if the 1-minute load average per cpu or the available memory of the host passes the limits.
+        The `busy` running works are excluded from the load average, as they are the load of the workers themselves,
+        otherwise a full pool would be scaled down by its own load.
+        """
+        if self.max_load and max(os.getloadavg()[0] - busy, 0) / (os.cpu_count() or 1) > self.max_load:
+            return True
+        available = _available_memory_ratio()
+        return available is not None and available < self.min_available_memory
+
+    def target(self, workers: int, busy: int, queue_length: int, under_pressure: bool = False) -> int:
+        """
+        The number of workers to run.
+        `workers` is the number of workers (not draining), `busy` is the number of running works.
+        """
+        needed = math.ceil((busy + queue_length) / self.concurrency)
+        if needed > workers and not under_pressure:
+            target = needed
+        elif needed < workers or under_pressure:
+            target = workers - 1
+        else:
+            target = workers
+        return max(self.min_workers, min(self.max_workers, target))
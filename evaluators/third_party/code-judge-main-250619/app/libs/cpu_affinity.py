@@ -0,0 +1,90 @@
+import os
+
+
+SYSFS_CPU_ROOT = '/sys/devices/system'
+
+
+def parse_cpu_list(cpu_list: str) -> list[int]:
+    """Parse a cpu list in the kernel format, like `0-3,8,10-11`"""
+    cpus = []
+    for part in cpu_list.replace(' ', '').split(','):
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return sorted(set(cpus))
+
+
+def _read_cpu_list(path: str) -> list[int] | None:
+    try:
+        with open(path) as f:
+            return parse_cpu_list(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def numa_nodes(cpus: list[int], sysfs_root: str = SYSFS_CPU_ROOT) -> list[list[int]]:
+    """
+    Group the cpus by numa node. In every node, the SMT siblings (hyperthreads of a physical core) are adjacent.
+    All the cpus are in one node if the topology can't be read.
+    """
+    remaining = set(cpus)
+    nodes = []
+    node_root = os.path.join(sysfs_root, 'node')
+    node_names = []
+    if os.path.isdir(node_root):
+        node_names = sorted(
+            (name for name in os.listdir(node_root) if name.startswith('node') and name[4:].isdigit()),
+            key=lambda name: int(name[4:]),
+        )
+    for name in node_names:
+        node_cpus = [cpu for cpu in _read_cpu_list(os.path.join(node_root, name, 'cpulist')) or [] if cpu in remaining]
+        if node_cpus:
+            nodes.append(node_cpus)
+            remaining.difference_update(node_cpus)
+    if remaining:
+        nodes.append(sorted(remaining))
+
+    def _siblings_first(node_cpus: list[int]) -> list[int]:
+        ordered = []
+        for cpu in node_cpus:
+            if cpu in ordered:
+                continue
+            siblings = _read_cpu_list(
+                os.path.join(sysfs_root, 'cpu', f'cpu{cpu}', 'topology', 'thread_siblings_list')
+            ) or [cpu]
+            ordered.extend(sibling for sibling in siblings if sibling in node_cpus and sibling not in ordered)
+        return ordered
+
+    return [_siblings_first(node_cpus) for node_cpus in nodes]
+
+
+class CpuAllocator:
+    """
+    Allocate a dedicated set of `cpus_per_worker` cpus to every worker process, which is inherited by its sandboxes.
+
+    The cpus are split into sets in every numa node (a set never spans two nodes, and the SMT siblings stay together),
+    so with `cpus_per_worker` set to the threads per core, every worker owns whole physical cores.
+    If there are more workers than sets, the least used set is shared.
+    Not thread-safe, it is only used by the worker manager.
+    """
+    def __init__(self, cpus: list[int], cpus_per_worker: int = 1, sysfs_root: str = SYSFS_CPU_ROOT):
+        self.cpu_sets: list[list[int]] = []
+        for node_cpus in numa_nodes(cpus, sysfs_root):
+            node_sets = [node_cpus[i:i + cpus_per_worker] for i in range(0, len(node_cpus), cpus_per_worker)]
+            # the cpus left in the node are not used, unless the node has no full set
+            if len(node_sets) > 1 and len(node_sets[-1]) < cpus_per_worker:
+                node_sets.pop()
+            self.cpu_sets.extend(node_sets)
+        if not self.cpu_sets:
+            raise ValueError('No cpu to allocate')
+        self._usages = [0] * len(self.cpu_sets)
+
+    def allocate(self) -> list[int]:
+        index = self._usages.index(min(self._usages))
+        self._usages[index] += 1
+        return self.cpu_sets[index]
+
+    def release(self, cpu_set: list[int]):
+        index = self.cpu_sets.index(cpu_set)
+        self._usages[index] -= 1
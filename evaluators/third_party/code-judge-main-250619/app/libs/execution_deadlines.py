@@ -0,0 +1,53 @@
+from contextlib import contextmanager
+import multiprocessing
+import threading
+import time
+
+
+class ExecutionDeadlines:
+    """
+    Deadlines of the running executions of a worker process, in shared memory,
+    so the worker manager can kill an execution as soon as it expires, without scanning the processes.
+
+    It is created by the manager before the worker process is forked.
+    The worker registers every execution (its process group and deadline) in a free slot,
+    and the manager reads the slots. The slots are only written by the worker, so no lock is shared between processes:
+    the deadline is written before the process group, and a slot is free when its process group is 0.
+    """
+    def __init__(self, slots: int, max_time: float):
+        self.max_time = max_time
+        self._pgids = multiprocessing.RawArray('q', slots)
+        self._deadlines = multiprocessing.RawArray('d', slots)
+        # only used by the threads of the worker
+        self._lock = threading.Lock()
+
+    def _start(self, pgid: int) -> int | None:
+        with self._lock:
+            for slot, value in enumerate(self._pgids):
+                if value == 0:
+                    self._deadlines[slot] = time.monotonic() + self.max_time
+                    self._pgids[slot] = pgid
+                    return slot
+        # more executions than the slots (not expected), then it is not watched
+        return None
+
+    @contextmanager
+    def watch(self, pgid: int):
+        """Called by the worker: the process group is watched until exit"""
+        slot = self._start(pgid)
+        try:
+            yield
+        finally:
+            if slot is not None:
+                self._pgids[slot] = 0
+
+    def running(self) -> list[tuple[int, float]]:
+        """Called by the manager: (process group, deadline) of the running executions"""
+        running = []
+        for slot in range(len(self._pgids)):
+            # read the deadline after the process group, as they are written in the reversed order
+            pgid = self._pgids[slot]
+            deadline = self._deadlines[slot]
+            if pgid:
+                running.append((pgid, deadline))
+        return running
@@ -0,0 +1,141 @@
+from contextlib import contextmanager
+import itertools
+import logging
+import os
+import signal
+import time
+from typing import Generator
+
+
+logger = logging.getLogger(__name__)
+
+CONTROLLERS = ('memory', 'cpu', 'pids')
+_CGROUP_PREFIX = 'code-judge-'
+# how long to wait for the killed processes to leave the cgroup before removing it
+_REMOVE_TIMEOUT = 1
+
+
+def _read(path: str) -> str | None:
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write(path: str, value: str):
+    with open(path, 'w') as f:
+        f.write(value)
+
+
+class Cgroup:
+    """The cgroup of one execution (see `CgroupBackend`)"""
+    def __init__(self, path: str):
+        self.path = path
+
+    def wrap(self, command_args: list[str]) -> list[str]:
+        """The command which moves itself into the cgroup, then executes `command_args`"""
+        return ['/bin/sh', '-c', 'echo $$ > "$0" && exec "$@"', os.path.join(self.path, 'cgroup.procs'), *command_args]
+
+    def kill(self):
+        """Kill all the processes in the cgroup, including the ones which leave the process group"""
+        try:
+            _write(os.path.join(self.path, 'cgroup.kill'), '1')
+            return
+        except OSError:
+            pass  # cgroup.kill is only supported since linux 5.14
+        for pid in (_read(os.path.join(self.path, 'cgroup.procs')) or '').split():
+            try:
+                os.kill(int(pid), signal.SIGKILL)
+            except (ValueError, OSError):
+                pass
+
+    def peak_memory(self) -> int | None:
+        """The peak memory usage in bytes (memory.peak is only supported since linux 5.19)"""
+        value = _read(os.path.join(self.path, 'memory.peak'))
+        return int(value) if value and value.strip().isdigit() else None
+
+    def cpu_time(self) -> float | None:
+        """The total cpu time (user and system) in seconds"""
+        for line in (_read(os.path.join(self.path, 'cpu.stat')) or '').splitlines():
+            name, _, value = line.partition(' ')
+            if name == 'usage_usec':
+                return int(value) / 1e6
+        return None
+
+    def _populated(self) -> bool:
+        for line in (_read(os.path.join(self.path, 'cgroup.events')) or '').splitlines():
+            if line.startswith('populated '):
+                return line.split()[1] != '0'
+        return False
+
+    def remove(self):
+        self.kill()
+        deadline = time.monotonic() + _REMOVE_TIMEOUT
+        while self._populated() and time.monotonic() < deadline:
+            time.sleep(0.005)
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            # it will be removed by the next worker process (see `CgroupBackend`)
+            logger.warning(f'Failed to remove cgroup {self.path}')
+
+
+class CgroupBackend:
+    """
+    Run every execution in its own cgroup v2 under `root`, which must be delegated to the workers
+    (i.e. writable, with the memory, cpu and pids controllers available).
+
+    Compared with rlimits:
+    - memory.max limits the real memory instead of the virtual memory (RLIMIT_AS),
+      so programs reserving large virtual memory (for example, the go/java runtimes, or sanitizers) are not rejected.
+    - the whole cgroup is killed in one step (cgroup.kill), including the grandchildren which leave the process group.
+    - the peak memory and the cpu time of the execution are reported.
+
+    The constructor raises OSError if the cgroups are not delegated, then rlimits should be used instead.
+    """
+    def __init__(self, root: str, cpus: float = 1, pids_max: int = 64):
+        self.root = root
+        self.cpus = cpus
+        self.pids_max = pids_max
+        available = (_read(os.path.join(root, 'cgroup.controllers')) or '').split()
+        missing = [c for c in CONTROLLERS if c not in available]
+        if missing:
+            raise OSError(f'Controllers {missing} are not available in cgroup {root}')
+        # raises OSError if the root is not delegated, or it has processes itself
+        _write(os.path.join(root, 'cgroup.subtree_control'), ' '.join(f'+{c}' for c in CONTROLLERS))
+        self._remove_stale_cgroups()
+        self._counter = itertools.count()
+
+    def _remove_stale_cgroups(self):
+        """Remove the cgroups of the dead processes (workers may be killed without removing their cgroups)"""
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.name.startswith(_CGROUP_PREFIX) or not entry.is_dir():
+                    continue
+                try:
+                    os.kill(int(entry.name[len(_CGROUP_PREFIX):].split('-')[0]), 0)
+                except ProcessLookupError:
+                    Cgroup(entry.path).remove()
+                except (ValueError, OSError):
+                    pass
+
+    @contextmanager
+    def create(self, memory_limit: int | None = None) -> Generator[Cgroup, None, None]:
+        """A new cgroup with the limits, which is removed (with all its processes killed) at exit"""
+        # itertools.count is thread-safe in CPython
+        path = os.path.join(self.root, f'{_CGROUP_PREFIX}{os.getpid()}-{next(self._counter)}')
+        os.mkdir(path)
+        cgroup = Cgroup(path)
+        try:
+            if memory_limit:
+                _write(os.path.join(path, 'memory.max'), str(memory_limit))
+                if os.path.exists(os.path.join(path, 'memory.swap.max')):
+                    _write(os.path.join(path, 'memory.swap.max'), '0')
+            if self.cpus:
+                _write(os.path.join(path, 'cpu.max'), f'{int(self.cpus * 100000)} 100000')
+            if self.pids_max:
+                _write(os.path.join(path, 'pids.max'), str(self.pids_max))
+            yield cgroup
+        finally:
+            cgroup.remove()
@@ -0,0 +1,158 @@
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import uuid
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+class CompileCache:
+    """
+    Node-local, content-addressed store of compile outputs.
+
+    Every entry is a single file named by the cache key:
+    `<key>.exe` for a successful compile and `<key>.err` for a compile error.
+    Entries are written to a temp file and renamed into place,
+    so concurrent workers never see a partial entry.
+    The mtime of an entry is bumped on every hit, and the least recently used entries
+    are evicted when the total size exceeds `max_size`.
+    """
+    EXE_SUFFIX = '.exe'
+    ERROR_SUFFIX = '.err'
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock_path = self.cache_dir / '.lock'
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        h = hashlib.sha256()
+        for part in parts:
+            data = part.encode()
+            # length prefix to avoid ambiguity between parts
+            h.update(len(data).to_bytes(8, 'little'))
+            h.update(data)
+        return h.hexdigest()
+
+    def _count(self, hit: bool):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def pop_stats(self) -> dict[str, int]:
+        """Return the hit/miss counts since the last call and reset them."""
+        with self._stats_lock:
+            stats = {'compile_cache_hit': self.hits, 'compile_cache_miss': self.misses}
+            self.hits = 0
+            self.misses = 0
+        return stats
+
+    def _touch(self, path: Path) -> bool:
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:  # evicted by another worker
+            return False
+
+    def get_executable(self, key: str, dest: str) -> bool:
+        """Place the cached executable at `dest`. Return False if it is not cached."""
+        path = self.cache_dir / f'{key}{self.EXE_SUFFIX}'
+        if not self._touch(path):
+            return False
+        try:
+            # always a copy: a hard link would let the submission (running as the same user)
+            # chmod and rewrite the shared inode, and poison the entry for all later hits.
+            shutil.copy2(path, dest)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def get_error(self, key: str) -> str | None:
+        path = self.cache_dir / f'{key}{self.ERROR_SUFFIX}'
+        if not self._touch(path):
+            return None
+        try:
+            return path.read_text()
+        except FileNotFoundError:
+            return None
+
+    def lookup(self, key: str, dest: str) -> tuple[bool, str | None]:
+        """
+        Look up a compile result.
+        Return (True, None) if the executable is placed at `dest`,
+        (True, error) for a cached compile error, and (False, None) on a miss.
+        """
+        if self.get_executable(key, dest):
+            self._count(True)
+            return True, None
+        error = self.get_error(key)
+        self._count(error is not None)
+        return error is not None, error
+
+    def _put_file(self, key: str, suffix: str, write) -> None:
+        tmp_path = self.cache_dir / f'.tmp-{uuid.uuid4().hex}'
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, self.cache_dir / f'{key}{suffix}')
+        except Exception:
+            logger.exception(f'Failed to save compile cache entry {key}')
+            tmp_path.unlink(missing_ok=True)
+            return
+        self._evict()
+
+    def put_executable(self, key: str, exe_path: str) -> None:
+        def _write(tmp_path: Path):
+            shutil.copy2(exe_path, tmp_path)
+            # cached executables are shared by all workers, so make them read-only
+            os.chmod(tmp_path, 0o555)
+        self._put_file(key, self.EXE_SUFFIX, _write)
+
+    def put_error(self, key: str, error: str) -> None:
+        self._put_file(key, self.ERROR_SUFFIX, lambda tmp_path: tmp_path.write_text(error))
+
+    def _evict(self) -> None:
+        if self.max_size <= 0:
+            return
+        with open(self._lock_path, 'w') as lock_file:
+            try:
+                # only one worker evicts at a time, the others just skip
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            entries = []
+            total_size = 0
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_size += stat.st_size
+            if total_size <= self.max_size:
+                return
+            entries.sort()
+            # evict down to 90% to avoid evicting on every put
+            target_size = self.max_size * 0.9
+            for _, size, path in entries:
+                if total_size <= target_size:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
@@ -4,8 +4,13 @@ import shlex
 from typing import Any, Generator
 from app.libs.executors.executor import (
     COMPILE_ERROR_EXIT_CODE, TIMEOUT_EXIT_CODE,
-    ProcessExecuteResult, ScriptExecutor, CompileError
+    OutputLimit, ProcessExecuteResult, ScriptExecutor, CompileError
 )
+from app.libs.execution_deadlines import ExecutionDeadlines
+from app.libs.executors.cgroup import CgroupBackend
+from app.libs.executors.compile_cache import CompileCache
+from app.libs.executors.precompiled_header import PrecompiledHeader
+from app.libs.executors.workdir_pool import WorkdirPool
 
 
 RESOURCE_LIMIT_TEMPLATE = """
@@ -25,7 +30,7 @@ static void handler(int sig) {{
 
 class ResourceLimit {{
 public:
-    ResourceLimit(int timeout, int memory_limit) {{
+    ResourceLimit(int timeout, int memory_limit, long file_size_limit) {{
         struct rlimit rlim;
         if (timeout > 0) {{
             getrlimit(RLIMIT_CPU, &rlim);
@@ -37,6 +42,13 @@ public:
             rlim.rlim_cur = memory_limit;
             setrlimit(RLIMIT_AS, &rlim);
         }}
+        if (file_size_limit > 0) {{
+            getrlimit(RLIMIT_FSIZE, &rlim);
+            rlim.rlim_cur = file_size_limit;
+            setrlimit(RLIMIT_FSIZE, &rlim);
+            // writing more fails with EFBIG, instead of killing the process
+            signal(SIGXFSZ, SIG_IGN);
+        }}
         getrlimit(RLIMIT_CORE, &rlim);
         rlim.rlim_cur = 0;
         setrlimit(RLIMIT_CORE, &rlim);
@@ -46,45 +58,85 @@ public:
     }}
 }};
 
-ResourceLimit _exec_resource_limit = ResourceLimit({timeout}, {memory_limit});
+ResourceLimit _exec_resource_limit = ResourceLimit({timeout}, {memory_limit}, {file_size_limit}L);
 """.strip()
 
 
 class CppExecutor(ScriptExecutor):
-    def __init__(self, compiler_cl: str, run_cl:str, timeout: int = None, memory_limit: int = None):
+    def __init__(self, compiler_cl: str, run_cl:str, timeout: int = None, memory_limit: int = None,
+                 compile_cache: CompileCache | None = None, output_limit: OutputLimit | None = None,
+                 workdir_pool: WorkdirPool | None = None, precompiled_header: PrecompiledHeader | None = None,
+                 cgroups: CgroupBackend | None = None, deadlines: ExecutionDeadlines | None = None):
         self.compiler_cl = compiler_cl
         self.run_cl = run_cl
         self.timeout = timeout
         self.memory_limit = memory_limit
+        self.compile_cache = compile_cache
+        self.output_limit = output_limit
+        self.workdir_pool = workdir_pool
+        self.precompiled_header = precompiled_header
+        self.cgroups = cgroups
+        self.deadlines = deadlines
 
-    def setup_command(self, tmp_path: str, script: str) -> Generator[list[str], ProcessExecuteResult, None]:
+    def setup_command(self, tmp_path: str, script: str) -> Generator[list[str], ProcessExecuteResult, list[str]]:
         source_path = f"{tmp_path}/source.cpp"
         resource_limit_path = f"{tmp_path}/resource_limit.h"
         exec_path = f"{tmp_path}/run"
+        resource_limit = RESOURCE_LIMIT_TEMPLATE.format(
+            timeout=self.timeout or 0,
+            # the memory is limited by the cgroup instead of RLIMIT_AS if possible
+            memory_limit=(self.memory_limit or 0) if self.cgroups is None else 0,
+            file_size_limit=self.file_size_limit,
+            TIMEOUT_EXIT_CODE=TIMEOUT_EXIT_CODE
+        )
+        source = '#include "resource_limit.h"\n' + script
+        use_pch = self.precompiled_header is not None and self.precompiled_header.applies(script)
+        if use_pch:
+            # it must be the first include to be used
+            source = f'#include "{PrecompiledHeader.NAME}"\n' + source
         with open(resource_limit_path, "w") as f:
-            f.write(RESOURCE_LIMIT_TEMPLATE.format(
-                timeout=self.timeout or 0,
-                memory_limit=self.memory_limit or 0,
-                TIMEOUT_EXIT_CODE=TIMEOUT_EXIT_CODE)
-            )
+            f.write(resource_limit)
         with open(source_path, "w") as f:
-            f.write('#include "resource_limit.h"\n')
-            f.write(script)
-        result = yield shlex.split(
-                self.compiler_cl.format(
-                    source=shlex.quote(source_path),
-                    exe=shlex.quote(exec_path),
-                    workdir=shlex.quote(str(tmp_path))
-            ))
-        if not result.success:
-            raise CompileError(result.stderr)
-        yield shlex.split(self.run_cl.format(
+            f.write(source)
+
+        cached = False
+        if self.compile_cache is not None:
+            cache_key = CompileCache.make_key(source, resource_limit, self.compiler_cl)
+            cached, error = self.compile_cache.lookup(cache_key, exec_path)
+            if error is not None:
+                raise CompileError(error)
+
+        if not cached:
+            if use_pch:
+                self.precompiled_header.place(self.compiler_cl, tmp_path)
+            result = yield shlex.split(
+                    self.compiler_cl.format(
+                        source=shlex.quote(source_path),
+                        exe=shlex.quote(exec_path),
+                        workdir=shlex.quote(str(tmp_path))
+                ))
+            if self.compile_cache is not None:
+                if result.success:
+                    self.compile_cache.put_executable(cache_key, exec_path)
+                elif result.exit_code > 0:
+                    # only the errors reported by the compiler are cached.
+                    # the compiles killed by signals (timeout, output limit, oom...) are not deterministic.
+                    self.compile_cache.put_error(cache_key, result.stderr)
+            if not result.success:
+                raise CompileError(result.stderr)
+        return shlex.split(self.run_cl.format(
             exe=shlex.quote(exec_path),
             workdir=shlex.quote(str(tmp_path))
         ))
 
-    def execute_script(self, script, stdin=None, timeout=None):
+    def execute_script_cases(self, script, stdins, timeout=None, comparators=None, capture_stdout=True):
         try:
-            return super().execute_script(script, stdin, timeout)
+            yield from super().execute_script_cases(script, stdins, timeout, comparators, capture_stdout)
         except CompileError as e:
-            return ProcessExecuteResult(stdout='', stderr=str(e), exit_code=COMPILE_ERROR_EXIT_CODE, cost=0)
+            # compile error is raised before any case runs
+            compile_cost = e.compile_cost
+            for _ in stdins:
+                yield ProcessExecuteResult(
+                    stdout='', stderr=str(e), exit_code=COMPILE_ERROR_EXIT_CODE, cost=0, compile_cost=compile_cost
+                )
+                compile_cost = 0
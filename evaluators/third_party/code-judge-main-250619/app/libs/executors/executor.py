@@ -1,11 +1,18 @@
+import inspect
+import os
+import selectors
 import subprocess
 from dataclasses import dataclass, field
 import tempfile
 import time
-from contextlib import contextmanager
-from typing import Any, Generator, Protocol
+from contextlib import ExitStack, contextmanager
+from typing import IO, Any, Callable, Generator, Protocol
 
+from ..execution_deadlines import ExecutionDeadlines
 from ..utils import nothrow_killpg
+from .cgroup import CgroupBackend
+from .output_comparator import OutputComparator
+from .workdir_pool import WorkdirPool
 
 
 class ExecuteResult(Protocol):
@@ -20,108 +27,325 @@ class ProcessExecuteResult:
     exit_code: int
     cost: float # in seconds
     success: bool = field(init=False)
+    # time of preparing the workdir and the preparation commands (compiling for example),
+    # only set in the result of the first case
+    setup_cost: float = 0
+    compile_cost: float = 0
+    # wall time of the process, while `cost` can be measured in the script
+    run_cost: float = 0
+    # set if the stdout is compared with the expected output while running (see `OutputComparator`)
+    output_matched: bool | None = None
+    # the process is killed as its output diverges from the expected output
+    killed_on_mismatch: bool = False
+    # the process is killed as it prints more than `OutputLimit.max_size`
+    output_limit_exceeded: bool = False
+    # peak memory (in bytes) and cpu time (in seconds) of the process and its children,
+    # only measured by the cgroup backend
+    peak_memory: int | None = None
+    cpu_time: float | None = None
 
     def __post_init__(self):
         self.success = self.exit_code == 0
 
 
 class CompileError(Exception):
-    pass
-
-
-def _run_as_pg(args: list[str],
-        input=None, capture_output=False, timeout=None, check=False, **kwargs):
-    # copied from subprocess.run
-    # For most cases, this is enough to make sure all subprocesses are
-    # killed when the parent process is killed.
-    # But if the subprocess creates a child process with new session,
-    # this will not work.
-    from subprocess import Popen, PIPE, TimeoutExpired, CalledProcessError, CompletedProcess
-
-    kwargs['start_new_session'] = True
-    if input is not None:
-        if kwargs.get('stdin') is not None:
-            raise ValueError('stdin and input arguments may not both be used.')
-        kwargs['stdin'] = PIPE
-
-    if capture_output:
-        if kwargs.get('stdout') is not None or kwargs.get('stderr') is not None:
-            raise ValueError('stdout and stderr arguments may not be used '
-                             'with capture_output.')
-        kwargs['stdout'] = PIPE
-        kwargs['stderr'] = PIPE
-
-    with Popen(args, **kwargs) as process:
-        try:
-            stdout, stderr = process.communicate(input, timeout=timeout)
-        except TimeoutExpired as exc:
-            # as we set start_new_session=True, pid is the process group id
-            nothrow_killpg(pgid=process.pid)
-            process.wait()
-            raise
-        except:  # Including KeyboardInterrupt, communicate handled that.
-            nothrow_killpg(pgid=process.pid)
-            # We don't call process.wait() as .__exit__ does that for us.
-            raise
-        # in case some orphaned child process is still running
-        nothrow_killpg(pgid=process.pid)
-        retcode = process.poll()
-        if check and retcode:
-            raise CalledProcessError(retcode, process.args,
-                                     output=stdout, stderr=stderr)
-    return CompletedProcess(process.args, retcode, stdout, stderr)
+    compile_cost: float = 0
 
 
 TIMEOUT_EXIT_CODE = -101
 COMPILE_ERROR_EXIT_CODE = -102
 
+# how long to wait for the remaining output after the process is killed
+_DRAIN_TIMEOUT = 1
+# a process whose output diverges is given this long to exit by itself before it is killed,
+# so a wrong answer which is about to finish still reports its own exit code
+_MISMATCH_GRACE = 0.1
+
+
+# the input is encoded and written by chunks of this many characters
+_STDIN_CHUNK_SIZE = 1024 * 1024
+
+
+@contextmanager
+def stdin_file(stdin: str | None) -> Generator[IO[bytes] | None, None, None]:
+    """
+    Write the stdin once to an anonymous file (a memfd if supported), which is passed to the process as its stdin,
+    so it's neither copied into a bytes object as a whole nor pushed through a pipe.
+    None if there is no stdin.
+    """
+    if not stdin:
+        yield None
+        return
+    if hasattr(os, 'memfd_create'):
+        file = os.fdopen(os.memfd_create('stdin', os.MFD_CLOEXEC), 'w+b')
+    else:
+        file = tempfile.TemporaryFile()
+    with file:
+        for start in range(0, len(stdin), _STDIN_CHUNK_SIZE):
+            file.write(stdin[start:start + _STDIN_CHUNK_SIZE].encode())
+        file.flush()
+        file.seek(0)
+        yield file
+
+
+@dataclass
+class OutputLimit:
+    # the max total bytes of stdout and stderr, the process is killed if it prints more
+    max_size: int | None = None
+    # only the first and the last `capture_size` bytes of stdout/stderr are kept,
+    # so the memory of the caller doesn't grow with the output
+    capture_size: int | None = None
+
+
+class _BoundedBuffer:
+    """Keep the head and the tail of a stream, and count its total size"""
+    def __init__(self, capture_size: int | None):
+        self.capture_size = capture_size
+        self.size = 0
+        self._head = bytearray()
+        self._tail = bytearray()
+
+    def append(self, data: bytes):
+        self.size += len(data)
+        if self.capture_size is None:
+            self._head += data
+            return
+        if len(self._head) < self.capture_size:
+            count = self.capture_size - len(self._head)
+            self._head += data[:count]
+            data = data[count:]
+        self._tail += data
+        if len(self._tail) > self.capture_size:
+            del self._tail[:len(self._tail) - self.capture_size]
+
+    def getvalue(self) -> bytes:
+        omitted = self.size - len(self._head) - len(self._tail)
+        if omitted:
+            return bytes(self._head) + f'\n...({omitted} bytes omitted)...\n'.encode() + bytes(self._tail)
+        return bytes(self._head + self._tail)
+
+
+@dataclass
+class PipeOutputs:
+    stdout: bytes
+    stderr: bytes
+    timed_out: bool = False
+    killed_on_mismatch: bool = False
+    output_limit_exceeded: bool = False
+    output_matched: bool | None = None
+
+
+def read_pipes(
+    stdout_fd: int, stderr_fd: int, timeout: float | None, kill: Callable[[], None],
+    comparator: OutputComparator | None = None, capture_stdout: bool = True, output_limit: OutputLimit | None = None,
+) -> PipeOutputs:
+    """
+    Read stdout/stderr of a process until they are closed.
+    The process is killed by `kill` if it times out,
+    or its stdout diverges from the expected output of `comparator` and it doesn't exit in a short grace period.
+    If `capture_stdout` is False, the stdout is only fed to the comparator.
+    The captured output and the total output are bounded by `output_limit` (the process is killed if it prints too much).
+    """
+    output_limit = output_limit or OutputLimit()
+    buffers = {stdout_fd: _BoundedBuffer(output_limit.capture_size), stderr_fd: _BoundedBuffer(output_limit.capture_size)}
+    # the size of the stdout which is not captured
+    uncaptured_size = 0
+    outputs = PipeOutputs(b'', b'')
+    deadline = time.monotonic() + timeout if timeout else None
+    diverged = False
+    mismatch_deadline = None
+    with selectors.DefaultSelector() as selector:
+        selector.register(stdout_fd, selectors.EVENT_READ)
+        selector.register(stderr_fd, selectors.EVENT_READ)
+        while selector.get_map():
+            next_deadline = min((d for d in (deadline, mismatch_deadline) if d is not None), default=None)
+            wait_time = None if next_deadline is None else max(next_deadline - time.monotonic(), 0)
+            ready = selector.select(wait_time)
+            if not ready and mismatch_deadline is not None and time.monotonic() >= mismatch_deadline:
+                mismatch_deadline = None
+                if not outputs.timed_out and not outputs.output_limit_exceeded:
+                    outputs.killed_on_mismatch = True
+                    kill()
+                    deadline = time.monotonic() + _DRAIN_TIMEOUT
+                continue
+            if not ready and deadline is not None and time.monotonic() >= deadline:
+                if outputs.timed_out or outputs.killed_on_mismatch or outputs.output_limit_exceeded:
+                    break
+                outputs.timed_out = True
+                kill()
+                deadline = time.monotonic() + _DRAIN_TIMEOUT
+                continue
+            for key, _ in ready:
+                data = os.read(key.fd, 65536)
+                if not data:
+                    selector.unregister(key.fd)
+                    continue
+                if key.fd == stdout_fd and not capture_stdout:
+                    uncaptured_size += len(data)
+                else:
+                    buffers[key.fd].append(data)
+                total_size = buffers[stdout_fd].size + buffers[stderr_fd].size + uncaptured_size
+                if (
+                    output_limit.max_size is not None and total_size > output_limit.max_size
+                    and not (outputs.timed_out or outputs.killed_on_mismatch or outputs.output_limit_exceeded)
+                ):
+                    outputs.output_limit_exceeded = True
+                    kill()
+                    deadline = time.monotonic() + _DRAIN_TIMEOUT
+                if key.fd == stdout_fd:
+                    if comparator is not None and not diverged and not comparator.feed(data):
+                        diverged = True
+                        mismatch_deadline = time.monotonic() + _MISMATCH_GRACE
+    if comparator is not None:
+        outputs.output_matched = False if diverged else comparator.finish()
+    outputs.stdout = buffers[stdout_fd].getvalue()
+    outputs.stderr = buffers[stderr_fd].getvalue()
+    return outputs
+
 
 class ProcessExecutor:
-    def execute(self, command_args: list[str], cwd=None, stdin: str | None = None, timeout: float | None = None) -> ProcessExecuteResult:
+    # the limit of the output of the executed processes
+    output_limit: OutputLimit | None = None
+    # if set, every process runs in its own cgroup, instead of only in its own process group
+    cgroups: CgroupBackend | None = None
+    # if set, the processes are watched by the worker manager, which kills them after their deadlines
+    deadlines: ExecutionDeadlines | None = None
+
+    def execute(
+        self, command_args: list[str], cwd=None, stdin: str | None = None, timeout: float | None = None,
+        comparator: OutputComparator | None = None, capture_stdout: bool = True, memory_limit: int | None = None,
+    ) -> ProcessExecuteResult:
+        """`memory_limit` (in bytes) is only enforced by the cgroup backend (see `CgroupBackend`)"""
         time_start = time.perf_counter()
-        try:
-            std_input = stdin.encode() if stdin else None
-            result = _run_as_pg(command_args, cwd=cwd, shell=False, check=False, capture_output=True, timeout=timeout, input=std_input)
-            stdout = result.stdout.decode()
-            stderr = result.stderr.decode()
-            exit_code = result.returncode
-        except subprocess.TimeoutExpired as e:
-            stdout = e.stdout.decode()
-            stderr = e.stderr.decode()
-            exit_code = TIMEOUT_EXIT_CODE
+        with ExitStack() as stack:
+            cgroup = stack.enter_context(self.cgroups.create(memory_limit)) if self.cgroups is not None else None
+            std_input = stack.enter_context(stdin_file(stdin))
+            # as start_new_session=True, pid is the process group id
+            process = stack.enter_context(subprocess.Popen(
+                cgroup.wrap(command_args) if cgroup is not None else command_args,
+                cwd=cwd, shell=False, start_new_session=True,
+                stdin=std_input if std_input is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            ))
+            if self.deadlines is not None:
+                stack.enter_context(self.deadlines.watch(process.pid))
+
+            def kill():
+                if cgroup is not None:
+                    cgroup.kill()
+                nothrow_killpg(pgid=process.pid)
+
+            try:
+                outputs = read_pipes(
+                    process.stdout.fileno(), process.stderr.fileno(), timeout, kill,
+                    comparator=comparator, capture_stdout=capture_stdout, output_limit=self.output_limit,
+                )
+                try:
+                    # the process may still run after closing its stdout/stderr
+                    left_time = max(time_start + timeout - time.perf_counter(), 0) if timeout else None
+                    exit_code = process.wait(left_time)
+                except subprocess.TimeoutExpired:
+                    kill()
+                    exit_code = process.wait()
+                    outputs.timed_out = True
+            finally:
+                # in case some orphaned child process is still running
+                kill()
+            peak_memory = cgroup.peak_memory() if cgroup is not None else None
+            cpu_time = cgroup.cpu_time() if cgroup is not None else None
 
         time_end = time.perf_counter()
 
         return ProcessExecuteResult(
-            stdout=stdout,
-            stderr=stderr,
-            exit_code=exit_code,
-            cost=time_end - time_start
+            # the output may be cut in the middle of a character
+            stdout=outputs.stdout.decode(errors='replace'),
+            stderr=outputs.stderr.decode(errors='replace'),
+            exit_code=TIMEOUT_EXIT_CODE if outputs.timed_out else exit_code,
+            cost=time_end - time_start,
+            output_matched=outputs.output_matched,
+            killed_on_mismatch=outputs.killed_on_mismatch,
+            output_limit_exceeded=outputs.output_limit_exceeded,
+            peak_memory=peak_memory,
+            cpu_time=cpu_time,
         )
 
 
 class ScriptExecutor(ProcessExecutor):
-    def setup_command(self, tmp_path: str, script: str) -> Generator[list[str], ProcessExecuteResult, None]:
+    # if set, the workdirs are taken from the pool instead of being created for every script
+    workdir_pool: WorkdirPool | None = None
+    # the memory limit (in bytes) of the script, set by rlimits in the script, or by the cgroup backend
+    memory_limit: int | None = None
+
+    @property
+    def file_size_limit(self) -> int:
+        """The max size (in bytes) of every file written by the script (RLIMIT_FSIZE), 0 means no limit"""
+        return self.workdir_pool.quota if self.workdir_pool is not None else 0
+
+    def setup_command(self, tmp_path: str, script: str) -> list[str] | Generator[list[str], ProcessExecuteResult, list[str]]:
         """
-        Prepare the command to execute the script
+        Prepare the workdir and return the command to execute the script.
+        If some preparation commands (compiling for example) are needed,
+        it can be a generator which yields the preparation commands,
+        receives their results, and returns the command to execute the script.
         """
         raise NotImplementedError
 
     def process_result(self, result: ProcessExecuteResult) -> ProcessExecuteResult:
         return result
 
-    def execute_script(self, script: str, stdin: str | None = None, timeout: float | None = None) -> ProcessExecuteResult:
+    def _setup(self, tmp_path: str, script: str, timeout: float | None = None) -> tuple[list[str], float]:
+        """Return the command to execute the script, and the time of the preparation commands"""
+        setup = self.setup_command(tmp_path, script)
+        if not inspect.isgenerator(setup):
+            return setup, 0
+        compile_cost = 0
+        try:
+            command = next(setup)
+            while True:
+                result = self.execute(command, cwd=tmp_path, timeout=timeout)
+                compile_cost += result.cost
+                command = setup.send(result)
+        except StopIteration as e:
+            return e.value, compile_cost
+        except CompileError as e:
+            e.compile_cost = compile_cost
+            raise
+
+    def execute_script_cases(
+        self, script: str, stdins: list[str | None], timeout: float | None = None,
+        comparators: list[OutputComparator | None] | None = None, capture_stdout: bool = True,
+    ) -> Generator[ProcessExecuteResult, None, None]:
+        """
+        Setup the script once, and run it with every stdin in the same workdir.
+        Results are yielded one by one, so the caller can stop early.
+        If the comparator of a case is set, the stdout is compared while running (see `OutputComparator`).
+        """
         # add 1 second to timeout as the overhead of the pre/post processing
         timeout = timeout + 1 if timeout else None
 
-        with tempfile.TemporaryDirectory() as tmp_path:
-            gen_command = self.setup_command(tmp_path, script)
-            command = next(gen_command)
-            while True:
-                try:
-                    result = self.execute(command, cwd=tmp_path, stdin=stdin, timeout=timeout)
-                    command = gen_command.send(result)
-                except StopIteration:
-                    break
-            # return the last result
-            return self.process_result(result)
+        setup_start_time = time.perf_counter()
+        workdir = self.workdir_pool.acquire() if self.workdir_pool is not None else tempfile.TemporaryDirectory()
+        with workdir as tmp_path:
+            command, compile_cost = self._setup(tmp_path, script, timeout)
+            setup_cost = time.perf_counter() - setup_start_time - compile_cost
+            for stdin, comparator in zip(stdins, comparators or [None] * len(stdins)):
+                result = self.execute(
+                    command, cwd=tmp_path, stdin=stdin, timeout=timeout,
+                    comparator=comparator, capture_stdout=capture_stdout, memory_limit=self.memory_limit,
+                )
+                run_cost = result.cost
+                result = self.process_result(result)
+                result.run_cost = run_cost
+                result.setup_cost, result.compile_cost = setup_cost, compile_cost
+                setup_cost = compile_cost = 0
+                yield result
+
+    def execute_script(
+        self, script: str, stdin: str | None = None, timeout: float | None = None,
+        comparator: OutputComparator | None = None, capture_stdout: bool = True,
+    ) -> ProcessExecuteResult:
+        results = self.execute_script_cases(script, [stdin], timeout, [comparator], capture_stdout)
+        try:
+            return next(results)
+        finally:
+            results.close()
@@ -0,0 +1,118 @@
+import codecs
+import math
+
+
+COMPARE_MODES = ('exact', 'tokens', 'float')
+DEFAULT_FLOAT_TOLERANCE = 1e-6
+# the output can be longer than the expected output by this much (whitespaces for example)
+_MIN_OUTPUT_SLACK = 64 * 1024
+
+
+class OutputComparator:
+    """
+    Compare the stdout of a process with the expected output while it is running,
+    so the process can be killed as soon as its output diverges (or grows too long).
+
+    Modes:
+    - exact: the same as `stdout.strip() == expected.strip()`.
+    - tokens: the same tokens split by whitespaces.
+    - float: the same as tokens, but numbers are equal if they are close
+      (within `float_tolerance`, absolute or relative).
+
+    Call `feed` with every chunk of the stdout, and `finish` at the end of the stdout.
+    """
+    def __init__(self, expected: str, mode: str = 'exact', float_tolerance: float = DEFAULT_FLOAT_TOLERANCE):
+        if mode not in COMPARE_MODES:
+            raise ValueError(f'Unsupported compare mode: {mode}')
+        self.mode = mode
+        self.float_tolerance = float_tolerance
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._max_length = 2 * len(expected) + _MIN_OUTPUT_SLACK
+        self._length = 0
+        self._diverged = False
+        # exact mode
+        self._expected = expected.strip()
+        self._pos = 0  # the matched prefix of the expected output
+        self._started = False  # leading whitespaces are skipped
+        # tokens/float mode
+        self._expected_tokens = expected.split()
+        self._token_index = 0
+        self._partial = ''  # the last token may be continued in the next chunk
+        self._max_token_length = max((len(t) for t in self._expected_tokens), default=0) + 64
+
+    def feed(self, data: bytes) -> bool:
+        """Return False if the output diverges, then the process can be killed"""
+        if self._diverged:
+            return False
+        text = self._decoder.decode(data)
+        self._length += len(text)
+        if self._length > self._max_length or not self._feed_text(text):
+            self._diverged = True
+        return not self._diverged
+
+    def finish(self) -> bool:
+        """Return True if the whole output matches"""
+        if self.feed(b''):
+            text = self._decoder.decode(b'', final=True)
+            if not self._feed_text(text):
+                return False
+            if self.mode == 'exact':
+                return self._pos == len(self._expected)
+            if self._partial and not self._match_token(self._partial):
+                return False
+            return self._token_index == len(self._expected_tokens)
+        return False
+
+    def _feed_text(self, text: str) -> bool:
+        if self.mode == 'exact':
+            return self._feed_exact(text)
+        return self._feed_tokens(text)
+
+    def _feed_exact(self, text: str) -> bool:
+        if not self._started:
+            text = text.lstrip()
+            if not text:
+                return True
+            self._started = True
+        count = min(len(text), len(self._expected) - self._pos)
+        if text[:count] != self._expected[self._pos:self._pos + count]:
+            return False
+        self._pos += count
+        # only whitespaces are allowed after the expected output
+        rest = text[count:]
+        return not rest or rest.isspace()
+
+    def _feed_tokens(self, text: str) -> bool:
+        text = self._partial + text
+        tokens = text.split()
+        self._partial = ''
+        if tokens and not text[-1].isspace():
+            self._partial = tokens.pop()
+        for token in tokens:
+            if not self._match_token(token):
+                return False
+        if not self._partial:
+            return True
+        if self._token_index >= len(self._expected_tokens) or len(self._partial) > self._max_token_length:
+            return False
+        # a partial number can't be checked, but a partial word must be a prefix
+        return self.mode == 'float' or self._expected_tokens[self._token_index].startswith(self._partial)
+
+    def _match_token(self, token: str) -> bool:
+        if self._token_index >= len(self._expected_tokens):
+            return False
+        expected = self._expected_tokens[self._token_index]
+        self._token_index += 1
+        if token == expected:
+            return True
+        if self.mode != 'float':
+            return False
+        try:
+            actual_value, expected_value = float(token), float(expected)
+        except ValueError:
+            return False
+        if math.isnan(actual_value) or math.isnan(expected_value):
+            return math.isnan(actual_value) and math.isnan(expected_value)
+        return math.isclose(
+            actual_value, expected_value, rel_tol=self.float_tolerance, abs_tol=self.float_tolerance
+        )
@@ -0,0 +1,134 @@
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shlex
+import shutil
+import tempfile
+import threading
+
+from .executor import ProcessExecutor, TIMEOUT_EXIT_CODE
+
+
+logger = logging.getLogger(__name__)
+
+_INCLUDE_RE = re.compile(r'\s*#\s*include\s*[<"]([^>"]+)[>"]\s*(//.*)?$')
+# the max time of building a precompiled header
+_BUILD_TIMEOUT = 120
+
+
+class PrecompiledHeader:
+    """
+    Node-local precompiled header (gcc `.gch`) of the common headers, like `bits/stdc++.h`.
+
+    A precompiled header is built once for every compile command (so with the same flags),
+    and stored in `cache_dir` by the hash of the command, the compiler version and the headers.
+    To use it, `NAME` is written to the workdir, together with a symlink to the `.gch` file,
+    and `#include "NAME"` is added as the first line of the source.
+    If the `.gch` can't be used (not visible in the sandbox, or built with other flags for example),
+    the compiler silently falls back to the header itself, so the result is always the same.
+
+    It is only used if the source includes all the headers before anything else (see `applies`),
+    so that including them in advance doesn't change the meaning of the source.
+    It is built in the background, and the sources are compiled without it until it's ready.
+    """
+    NAME = 'code_judge_pch.h'
+
+    def __init__(self, cache_dir: str, headers: list[str], compiler_version: str = ''):
+        self.cache_dir = cache_dir
+        self.headers = headers
+        self.compiler_version = compiler_version
+        self.header_text = ''.join(f'#include <{header}>\n' for header in headers)
+        os.makedirs(cache_dir, exist_ok=True)
+        self._building: set[str] = set()
+        self._lock = threading.Lock()
+
+    def applies(self, script: str) -> bool:
+        """True if the leading #include lines of the script include all the headers"""
+        included = set()
+        for line in script.splitlines():
+            if not line.strip() or line.strip().startswith('//'):
+                continue
+            match = _INCLUDE_RE.match(line)
+            if match is None:
+                break
+            included.add(match.group(1))
+        return set(self.headers) <= included
+
+    def _key(self, compiler_cl: str) -> str:
+        h = hashlib.sha256()
+        for part in (compiler_cl, self.compiler_version, self.header_text):
+            h.update(part.encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def gch_path(self, compiler_cl: str) -> str | None:
+        """The path of the `.gch`, which is built in the background if needed. None if it is not available now."""
+        key = self._key(compiler_cl)
+        gch_path = os.path.join(self.cache_dir, key, self.NAME + '.gch')
+        if os.path.exists(gch_path):
+            return gch_path
+        if os.path.exists(os.path.join(self.cache_dir, f'{key}.failed')):
+            return None
+        with self._lock:
+            if key in self._building:
+                return None
+            self._building.add(key)
+        threading.Thread(target=self._try_build, args=(compiler_cl, key), daemon=True).start()
+        return None
+
+    def _try_build(self, compiler_cl: str, key: str):
+        try:
+            with open(os.path.join(self.cache_dir, f'{key}.lock'), 'w') as lock_file:
+                try:
+                    # only one worker builds it
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                if not os.path.exists(os.path.join(self.cache_dir, key)):
+                    self._build(compiler_cl, key)
+        except Exception:
+            logger.exception(f'Failed to build the precompiled header for `{compiler_cl}`')
+        finally:
+            with self._lock:
+                self._building.discard(key)
+
+    def _build(self, compiler_cl: str, key: str) -> bool:
+        build_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        try:
+            header_path = os.path.join(build_dir, self.NAME)
+            with open(header_path, 'w') as f:
+                f.write(self.header_text)
+            command = shlex.split(compiler_cl.format(
+                source=shlex.quote(header_path),
+                exe=shlex.quote(header_path + '.gch'),
+                workdir=shlex.quote(build_dir),
+            ))
+            result = ProcessExecutor().execute(command, cwd=build_dir, timeout=_BUILD_TIMEOUT)
+            if not result.success or not os.path.exists(header_path + '.gch'):
+                logger.error(f'Failed to build the precompiled header with `{compiler_cl}`: {result.stderr}')
+                # not retried, unless the failure is a timeout
+                if result.exit_code != TIMEOUT_EXIT_CODE:
+                    open(os.path.join(self.cache_dir, f'{key}.failed'), 'w').close()
+                return False
+            # readable in the sandboxes
+            os.chmod(build_dir, 0o755)
+            os.rename(build_dir, os.path.join(self.cache_dir, key))
+            logger.info(f'Built the precompiled header for `{compiler_cl}`')
+            return True
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+    def place(self, compiler_cl: str, workdir: str) -> bool:
+        """
+        Put the header and its precompiled header in the workdir.
+        Return False if the precompiled header is not available, then the header is compiled as usual.
+        """
+        with open(os.path.join(workdir, self.NAME), 'w') as f:
+            f.write(self.header_text)
+        gch_path = self.gch_path(compiler_cl)
+        if gch_path is None:
+            return False
+        os.symlink(gch_path, os.path.join(workdir, self.NAME + '.gch'))
+        return True
@@ -3,7 +3,11 @@ import tempfile
 import io
 import shlex
 
-from .executor import ScriptExecutor, ProcessExecuteResult, TIMEOUT_EXIT_CODE
+from .cgroup import CgroupBackend
+from ..execution_deadlines import ExecutionDeadlines
+from .executor import ScriptExecutor, ProcessExecuteResult, OutputLimit, TIMEOUT_EXIT_CODE
+from .python_zygote import PythonZygote
+from .workdir_pool import WorkdirPool
 
 
 SCRIPT_ENDING_MARK = "@@E"
@@ -48,6 +52,11 @@ def _exec_prepare():
         soft, hard = resource.getrlimit(resource.RLIMIT_AS)
         resource.setrlimit(resource.RLIMIT_AS, (maxsize, hard))
 
+    def _exec_limit_file_size(maxsize):
+        # python ignores SIGXFSZ, so writing more raises OSError (EFBIG)
+        soft, hard = resource.getrlimit(resource.RLIMIT_FSIZE)
+        resource.setrlimit(resource.RLIMIT_FSIZE, (maxsize, hard))
+
     resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
     if {{timeout}}:
         _exec_set_alarm_timeout({{timeout}})
@@ -56,6 +65,9 @@ def _exec_prepare():
     if {{memory_limit}}:
         _exec_limit_memory({{memory_limit}})
 
+    if {{file_size_limit}}:
+        _exec_limit_file_size({{file_size_limit}})
+
     return time.perf_counter()
 
 _exec_time_start = _exec_prepare()
@@ -65,18 +77,23 @@ _exec_time_start = _exec_prepare()
 POST_TEMPLATE = f"""
 
 def _exec_end():
+    import sys
     import time
     _exec_time_end = time.perf_counter()
     _exec_duration = _exec_time_end - _exec_time_start
-    print("{SCRIPT_ENDING_MARK}")
-    print(f"{DURATION_MARK}{{_exec_duration}}", flush=True)
+    print("{SCRIPT_ENDING_MARK}", file=sys.stderr)
+    print(f"{DURATION_MARK}{{_exec_duration}}", file=sys.stderr, flush=True)
 
 _exec_end()
 
 """.strip()
 
 class PythonExecutor(ScriptExecutor):
-    def __init__(self, run_cl: str, timeout: int = None, memory_limit: int = None):
+    def __init__(
+        self, run_cl: str, timeout: int = None, memory_limit: int = None, zygote: PythonZygote | None = None,
+        output_limit: OutputLimit | None = None, workdir_pool: WorkdirPool | None = None,
+        cgroups: CgroupBackend | None = None, deadlines: ExecutionDeadlines | None = None,
+    ):
         self.timeout = timeout
         self.memory_limit = (
             memory_limit + 128 * 1024 * 1024  # extra 128MB for python overhead
@@ -84,24 +101,52 @@ class PythonExecutor(ScriptExecutor):
             else None
         )
         self.run_cl = run_cl
+        # if zygote is set, scripts are forked from it instead of being run by run_cl
+        self.zygote = zygote
+        self.output_limit = output_limit
+        self.workdir_pool = workdir_pool
+        # not used by the zygote, as the scripts are forked by the zygote server
+        self.cgroups = cgroups if zygote is None else None
+        self.deadlines = deadlines
 
     def setup_command(self, tmp_path: str, script: str):
         source_path = f"{tmp_path}/source.py"
         with open(source_path, mode='w') as f:
-            f.write(PRE_TEMPLATE.format(timeout=self.timeout, memory_limit=self.memory_limit))
+            # the memory is limited by the cgroup instead of RLIMIT_AS if possible
+            memory_limit = self.memory_limit if self.cgroups is None else 0
+            f.write(PRE_TEMPLATE.format(
+                timeout=self.timeout, memory_limit=memory_limit, file_size_limit=self.file_size_limit
+            ))
             f.write("\n")
             f.write(script)
             f.write("\n")
             f.write(POST_TEMPLATE)
             f.flush()
-        yield shlex.split(self.run_cl.format(
+        if self.zygote is not None:
+            # not a real command, see `execute`
+            return [source_path]
+        return shlex.split(self.run_cl.format(
             source=shlex.quote(source_path),
             workdir=shlex.quote(str(tmp_path))
         ))
 
+    def execute(
+        self, command_args, cwd=None, stdin=None, timeout=None, comparator=None, capture_stdout=True, memory_limit=None,
+    ):
+        if self.zygote is None:
+            return super().execute(
+                command_args, cwd=cwd, stdin=stdin, timeout=timeout, comparator=comparator, capture_stdout=capture_stdout,
+                memory_limit=memory_limit,
+            )
+        return self.zygote.execute(
+            command_args[0], cwd=cwd, stdin=stdin, timeout=timeout, comparator=comparator, capture_stdout=capture_stdout,
+            output_limit=self.output_limit,
+        )
+
     def process_result(self, result):
-        if SCRIPT_ENDING_MARK in result.stdout:
-            result.stdout, meta_info = result.stdout.split(SCRIPT_ENDING_MARK, 2)
+        # the marks are printed to stderr, so the stdout can be compared while running
+        if SCRIPT_ENDING_MARK in result.stderr:
+            result.stderr, meta_info = result.stderr.rsplit(SCRIPT_ENDING_MARK, 1)
             for line in io.StringIO(meta_info):
                 if line.startswith(DURATION_MARK):
                     result.cost = float(line[len(DURATION_MARK):])
@@ -0,0 +1,129 @@
+from contextlib import nullcontext
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+from .executor import OutputLimit, ProcessExecuteResult, TIMEOUT_EXIT_CODE, read_pipes, stdin_file
+from .output_comparator import OutputComparator
+from ..execution_deadlines import ExecutionDeadlines
+from ..utils import nothrow_killpg
+
+
+ZYGOTE_SERVER_PATH = str(Path(__file__).parent / 'python_zygote_server.py')
+
+# how long to wait for the exit code after the script is killed
+_KILL_TIMEOUT = 1
+
+
+class PythonZygote:
+    """
+    Client of the python fork server (see `python_zygote_server.py`).
+    The server is started lazily, and restarted if it dies.
+    Only one script can be executed at a time.
+    """
+    def __init__(
+        self, python_path: str, preload_modules: list[str] | None = None, deadlines: ExecutionDeadlines | None = None,
+    ):
+        self.python_path = python_path
+        self.preload_modules = preload_modules or []
+        # the forked scripts are watched by the worker manager (see `ExecutionDeadlines`)
+        self.deadlines = deadlines
+        self._process: subprocess.Popen | None = None
+        self._sock: socket.socket | None = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self.close()
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        with child_sock:
+            self._process = subprocess.Popen(
+                [self.python_path, ZYGOTE_SERVER_PATH, str(child_sock.fileno()), *self.preload_modules],
+                pass_fds=[child_sock.fileno()],
+                stdin=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        self._sock = parent_sock
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+
+    def _recv(self, timeout: float | None = None) -> dict:
+        """Receive a message of the server, raise TimeoutError if it doesn't come in `timeout` seconds"""
+        self._sock.settimeout(timeout)
+        try:
+            msg = self._sock.recv(4096)
+        finally:
+            self._sock.settimeout(None)
+        if not msg:
+            raise ConnectionError('Python zygote exited unexpectedly')
+        return json.loads(msg)
+
+    def execute(
+        self, source_path: str, cwd: str, stdin: str | None = None, timeout: float | None = None,
+        comparator: OutputComparator | None = None, capture_stdout: bool = True,
+        output_limit: OutputLimit | None = None,
+    ) -> ProcessExecuteResult:
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self._start()
+            try:
+                return self._execute(source_path, cwd, stdin, timeout, comparator, capture_stdout, output_limit)
+            except OSError:
+                # the protocol state is unknown, so restart the server next time
+                self.close()
+                raise
+
+    def _execute(
+        self, source_path: str, cwd: str, stdin: str | None, timeout: float | None,
+        comparator: OutputComparator | None, capture_stdout: bool, output_limit: OutputLimit | None,
+    ) -> ProcessExecuteResult:
+        time_start = time.perf_counter()
+        with stdin_file(stdin) as std_input, open(os.devnull, 'rb') as devnull:
+            stdout_r, stdout_w = os.pipe()
+            stderr_r, stderr_w = os.pipe()
+            try:
+                try:
+                    request = json.dumps({'source': source_path, 'cwd': str(cwd)}).encode()
+                    socket.send_fds(self._sock, [request], [(std_input or devnull).fileno(), stdout_w, stderr_w])
+                finally:
+                    os.close(stdout_w)
+                    os.close(stderr_w)
+                pid = self._recv()['pid']
+                # watched until the exit code is received, as the script may still run after closing its stdout/stderr
+                with self.deadlines.watch(pid) if self.deadlines is not None else nullcontext():
+                    outputs = read_pipes(
+                        stdout_r, stderr_r, timeout, lambda: nothrow_killpg(pgid=pid),
+                        comparator=comparator, capture_stdout=capture_stdout, output_limit=output_limit,
+                    )
+                    try:
+                        left_time = max(time_start + timeout - time.perf_counter(), 0) if timeout else None
+                        exit_code = self._recv(left_time)['exit_code']
+                    except (TimeoutError, BlockingIOError):  # BlockingIOError if no time is left
+                        nothrow_killpg(pgid=pid)
+                        # the server reports the exit code right after the script is killed
+                        exit_code = self._recv(_KILL_TIMEOUT)['exit_code']
+                        outputs.timed_out = True
+            finally:
+                os.close(stdout_r)
+                os.close(stderr_r)
+        time_end = time.perf_counter()
+
+        return ProcessExecuteResult(
+            stdout=outputs.stdout.decode(errors='replace'),
+            stderr=outputs.stderr.decode(errors='replace'),
+            exit_code=TIMEOUT_EXIT_CODE if outputs.timed_out else exit_code,
+            cost=time_end - time_start,
+            output_matched=outputs.output_matched,
+            killed_on_mismatch=outputs.killed_on_mismatch,
+            output_limit_exceeded=outputs.output_limit_exceeded,
+        )
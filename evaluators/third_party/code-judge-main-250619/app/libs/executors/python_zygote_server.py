@@ -0,0 +1,171 @@
+"""
+Fork server (zygote) for `PythonExecutor`.
+
+It is run with the configured python interpreter (not the one of the worker),
+so it can only depend on the standard library.
+
+Usage: python3 python_zygote_server.py <control socket fd> [module ...]
+
+The modules are imported once when the server starts.
+For every request (a json message with `source` and `cwd`, plus the stdin/stdout/stderr fds),
+the server forks a child which runs the source as `__main__`, sends back `{"pid": ...}`,
+waits for the child and sends back `{"exit_code": ...}`.
+"""
+import atexit
+import builtins
+import importlib.util
+import json
+import marshal
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+import types
+
+
+def _preload(modules: list[str]):
+    # keep the same environment as PRE_TEMPLATE, but before the modules are imported
+    os.environ['OPENBLAS_NUM_THREADS'] = '1'
+    for module in modules:
+        try:
+            __import__(module)
+        except Exception:
+            pass
+
+
+def _load_code(source_path: str):
+    """
+    Compile the source with a (hash based) bytecode cache in `__pycache__` of the workdir,
+    so a source is only compiled once for all test cases.
+    """
+    with open(source_path, 'rb') as f:
+        source = f.read()
+    source_hash = importlib.util.source_hash(source)
+    cache_path = importlib.util.cache_from_source(source_path)
+    try:
+        with open(cache_path, 'rb') as f:
+            data = f.read()
+        # header: magic(4) + flags(4) + source hash(8)
+        if data[:4] == importlib.util.MAGIC_NUMBER and data[8:16] == source_hash:
+            return marshal.loads(data[16:])
+    except (OSError, ValueError, EOFError, TypeError):
+        pass
+
+    code = compile(source, source_path, 'exec', dont_inherit=True)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            # flags 0b11: hash based and checked
+            f.write(importlib.util.MAGIC_NUMBER + (0b11).to_bytes(4, 'little') + source_hash + marshal.dumps(code))
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return code
+
+
+def _exit_code(e: SystemExit) -> int:
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+def _run_child(request: dict, fds: list[int], code, error: BaseException | None):
+    exit_code = 1
+    try:
+        os.setsid()
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+        for fd in fds:
+            if fd > 2:
+                os.close(fd)
+        sys.stdin = sys.__stdin__ = os.fdopen(0, 'r', closefd=False)
+        sys.stdout = sys.__stdout__ = os.fdopen(1, 'w', closefd=False)
+        sys.stderr = sys.__stderr__ = os.fdopen(2, 'w', buffering=1, errors='backslashreplace', closefd=False)
+
+        os.chdir(request['cwd'])
+        sys.argv = [request['source']]
+        sys.path[0] = request['cwd']
+        if 'numpy' in sys.modules:
+            # the global random state is inherited from the zygote
+            sys.modules['numpy'].random.seed()
+
+        main = types.ModuleType('__main__')
+        main.__file__ = request['source']
+        main.__builtins__ = builtins
+        sys.modules['__main__'] = main
+        try:
+            if error is not None:
+                raise error
+            exec(code, main.__dict__)
+            exit_code = 0
+        except SystemExit as e:
+            exit_code = _exit_code(e)
+        except BaseException as e:
+            if isinstance(e, SyntaxError) and e is error:
+                traceback.print_exception(type(e), e, None)
+            else:
+                # skip the frame of this function
+                traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+            exit_code = 1
+
+        # what the interpreter does at exit
+        for thread in threading.enumerate():
+            if thread is not threading.main_thread() and not thread.daemon:
+                thread.join()
+        atexit._run_exitfuncs()
+    except SystemExit as e:
+        exit_code = _exit_code(e)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        os._exit(exit_code)
+
+
+def main():
+    sock = socket.socket(fileno=int(sys.argv[1]))
+    _preload(sys.argv[2:])
+
+    while True:
+        try:
+            msg, fds, _, _ = socket.recv_fds(sock, 65536, 3)
+        except ConnectionError:
+            break
+        if not msg:  # the worker is gone
+            break
+        request = json.loads(msg)
+        code = None
+        error = None
+        try:
+            code = _load_code(request['source'])
+        except BaseException as e:
+            error = e
+
+        pid = os.fork()
+        if pid == 0:
+            sock.close()
+            _run_child(request, fds, code, error)
+        for fd in fds:
+            os.close(fd)
+        sock.send(json.dumps({'pid': pid}).encode())
+        _, status = os.waitpid(pid, 0)
+        try:
+            # in case some orphaned child process is still running
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        sock.send(json.dumps({'exit_code': os.waitstatus_to_exitcode(status)}).encode())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+from contextlib import contextmanager
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from typing import Generator
+
+
+logger = logging.getLogger(__name__)
+
+
+def _dir_size(path: str) -> int:
+    """The disk usage of the directory tree (without following symlinks)"""
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return size
+
+
+def _rmtree(path: str):
+    def _on_error(func, error_path, _):
+        # the script may remove the permissions of its files
+        try:
+            os.chmod(os.path.dirname(error_path), 0o700)
+            os.chmod(error_path, 0o700)
+            func(error_path)
+        except OSError:
+            pass
+    shutil.rmtree(path, onerror=_on_error)
+
+
+def _scrub(path: str) -> bool:
+    """Remove everything in the directory. Return False if it can't be emptied"""
+    os.chmod(path, 0o700)
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                _rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+    return not os.listdir(path)
+
+
+_POOL_PREFIX = 'code-judge-workdirs-'
+
+
+def _remove_stale_pools(root: str):
+    """Remove the pools of the dead processes (workers may be killed without closing their pools)"""
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if not entry.name.startswith(_POOL_PREFIX):
+                continue
+            try:
+                os.kill(int(entry.name[len(_POOL_PREFIX):].split('-')[0]), 0)
+            except ProcessLookupError:
+                _rmtree(entry.path)
+            except (ValueError, OSError):
+                pass
+
+
+class WorkdirPool:
+    """
+    Reusable workdirs under `root` (a memory-backed filesystem like /dev/shm is recommended),
+    so a submission doesn't create and remove a directory tree on the (often overlay) temp filesystem.
+
+    A released workdir is scrubbed and kept for the next submission, up to `max_idle` workdirs.
+    Every file written by a script is limited to `quota` bytes (see `ScriptExecutor.file_size_limit`),
+    and a workdir using more than `quota` bytes in total is removed instead of being reused.
+    `TemporaryDirectory` is used instead when the filesystem of `root` has less than `quota` bytes free
+    for each of the `concurrency` workdirs which may be in use at the same time (by all pools on the filesystem).
+    Thread-safe. Every pool owns a directory under `root` named by its pid, which is removed by `close`
+    (or by a later pool if the process is killed).
+    """
+    def __init__(self, root: str, max_idle: int, quota: int, concurrency: int = 1):
+        os.makedirs(root, exist_ok=True)
+        _remove_stale_pools(root)
+        self.path = tempfile.mkdtemp(prefix=f'{_POOL_PREFIX}{os.getpid()}-', dir=root)
+        self.max_idle = max_idle
+        self.quota = quota
+        self.concurrency = concurrency
+        self._idle: list[str] = []
+        self._lock = threading.Lock()
+
+    def _has_room(self) -> bool:
+        stat = os.statvfs(self.path)
+        return stat.f_bavail * stat.f_frsize >= self.quota * self.concurrency
+
+    @contextmanager
+    def acquire(self) -> Generator[str, None, None]:
+        """An empty workdir, which is scrubbed and returned to the pool after use"""
+        if not self._has_room():
+            with tempfile.TemporaryDirectory() as tmp_path:
+                yield tmp_path
+            return
+        with self._lock:
+            path = self._idle.pop() if self._idle else None
+        if path is None:
+            path = tempfile.mkdtemp(dir=self.path)
+        try:
+            yield path
+        finally:
+            self._release(path)
+
+    def _release(self, path: str):
+        try:
+            reusable = _dir_size(path) <= self.quota and _scrub(path)
+        except OSError:
+            logger.exception(f'Failed to scrub workdir {path}')
+            reusable = False
+        if reusable:
+            with self._lock:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(path)
+                    return
+        _rmtree(path)
+
+    def close(self):
+        with self._lock:
+            self._idle.clear()
+        _rmtree(self.path)
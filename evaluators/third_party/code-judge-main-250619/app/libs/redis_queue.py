@@ -40,6 +40,9 @@ class RedisQueue:
         def pop(self, queue_name):
             return self.rq.redis.lpop(queue_name)
 
+        def pop_many(self, queue_name, count) -> list[bytes] | None | Awaitable[list[bytes] | None]:
+            return self.rq.redis.lpop(queue_name, count)
+
         def pop_multi(self, *queue_names):
             if not queue_names:
                 return []
@@ -107,8 +110,73 @@ class RedisQueue:
         def push(self, queue_name, key_score_dict: dict[str, float]):
             return self.rq.redis.zadd(queue_name, key_score_dict)
 
-        def pop(self, queue_name)-> tuple[bytes, float] | Awaitable[tuple[bytes, float]] | None | Awaitable[None]:
-            return self.rq.redis.zpopmin(queue_name)
+        @staticmethod
+        def _fair_scores(head, tenant_clock, max_clock, weight: float, count: int) -> tuple[list[float], float]:
+            # the virtual time is the score of the next value to pop,
+            # or the max finish time of all tenants if the queue is empty.
+            virtual_time = head[0][1] if head else float(max_clock or 0)
+            start = max(float(tenant_clock or 0), virtual_time)
+            return [start + i / weight for i in range(count)], start + count / weight
+
+        def _fair_push_pipeline(self, queue_name, clock_name, tenant, values, scores, finish, max_clock, expire):
+            pp = self.rq.redis.pipeline(transaction=False)
+            pp.zadd(queue_name, dict(zip(values, scores)))
+            pp.hset(clock_name, f't:{tenant}', finish)
+            if finish > float(max_clock or 0):
+                pp.hset(clock_name, 'max', finish)
+            pp.expire(clock_name, expire)
+            return pp
+
+        def _read_clocks_pipeline(self, queue_name, clock_name, tenant):
+            pp = self.rq.redis.pipeline(transaction=False)
+            pp.zrange(queue_name, 0, 0, withscores=True)
+            pp.hget(clock_name, f't:{tenant}')
+            pp.hget(clock_name, 'max')
+            return pp
+
+        def _push_fair_sync(self, queue_name, clock_name, tenant, weight, values, expire) -> list[float]:
+            head, tenant_clock, max_clock = self._read_clocks_pipeline(queue_name, clock_name, tenant).execute()
+            scores, finish = self._fair_scores(head, tenant_clock, max_clock, weight, len(values))
+            self._fair_push_pipeline(queue_name, clock_name, tenant, values, scores, finish, max_clock, expire).execute()
+            return scores
+
+        async def _push_fair_async(self, queue_name, clock_name, tenant, weight, values, expire) -> list[float]:
+            head, tenant_clock, max_clock = await self._read_clocks_pipeline(queue_name, clock_name, tenant).execute()
+            scores, finish = self._fair_scores(head, tenant_clock, max_clock, weight, len(values))
+            await self._fair_push_pipeline(queue_name, clock_name, tenant, values, scores, finish, max_clock, expire).execute()
+            return scores
+
+        def push_fair(
+            self, queue_name, clock_name, tenant: str, weight: float, values: list[str], expire: int
+        ) -> list[float] | Awaitable[list[float]]:
+            """
+            Push values of a tenant with start-time fair queueing scores, and return the scores.
+            Every tenant has a virtual clock (stored in the hash `clock_name`), which is advanced by 1 / weight
+            for every value, so the tenants share the queue in proportion to their weights
+            no matter how many values they pushed before.
+            The clocks are not updated atomically, so concurrent pushes of the same tenant may interleave.
+            """
+            assert values, 'values must not be empty'
+            if self.rq.is_async:
+                return self._push_fair_async(queue_name, clock_name, tenant, weight, values, expire)
+            else:
+                return self._push_fair_sync(queue_name, clock_name, tenant, weight, values, expire)
+
+        def pop(self, queue_name, count=None) -> list[tuple[bytes, float]] | Awaitable[list[tuple[bytes, float]]]:
+            return self.rq.redis.zpopmin(queue_name, count)
+
+        def pop_first(self, queue_names, count) -> list[tuple[str, bytes, float]]:
+            """
+            Pop at most `count` values from the first non-empty queues (in the order of `queue_names`).
+            Only sync mode is supported, as it is only used by workers.
+            """
+            assert not self.rq.is_async, 'pop_first is only supported in sync mode'
+            items = []
+            for queue_name in queue_names:
+                items.extend((queue_name, value, score) for value, score in self.rq.redis.zpopmin(queue_name, count - len(items)))
+                if len(items) >= count:
+                    break
+            return items
 
         def pop_multi(self, *queue_names):
             if not queue_names:
@@ -150,6 +218,148 @@ class RedisQueue:
         def len(self, queue_name):
             return self.rq.redis.zcard(queue_name)
 
+    class StreamQueueOp:
+        """
+        Reliable queue operations using stream and consumer group in Redis.
+        Every entry has a `payload` and a `timestamp` field.
+        An entry is pending (leased by the consumer) after it is read,
+        and is removed only after it is acknowledged.
+        """
+
+        PAYLOAD_FIELD = b'payload'
+        TIMESTAMP_FIELD = b'timestamp'
+
+        def __init__(self, rq: 'RedisQueue'):
+            self.rq = rq
+
+        @classmethod
+        def _to_item(cls, entry) -> tuple[bytes, bytes, float]:
+            entry_id, fields = entry
+            return entry_id, fields[cls.PAYLOAD_FIELD], float(fields[cls.TIMESTAMP_FIELD])
+
+        @staticmethod
+        def _has_group(groups, group_name) -> bool:
+            return any(g['name'] == group_name.encode() for g in groups)
+
+        def _create_group_sync(self, stream_name, group_name):
+            if self.rq.redis.exists(stream_name) and self._has_group(self.rq.redis.xinfo_groups(stream_name), group_name):
+                return
+            try:
+                self.rq.redis.xgroup_create(stream_name, group_name, id='0', mkstream=True)
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+        async def _create_group_async(self, stream_name, group_name):
+            if await self.rq.redis.exists(stream_name) and self._has_group(await self.rq.redis.xinfo_groups(stream_name), group_name):
+                return
+            try:
+                await self.rq.redis.xgroup_create(stream_name, group_name, id='0', mkstream=True)
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+        def create_group(self, stream_name, group_name):
+            """Create the consumer group (and the stream) if not exists"""
+            if self.rq.is_async:
+                return self._create_group_async(stream_name, group_name)
+            else:
+                return self._create_group_sync(stream_name, group_name)
+
+        def push(self, stream_name, payload_timestamps: dict[str, float]):
+            pp = self.rq.redis.pipeline(transaction=False)
+            for payload, timestamp in payload_timestamps.items():
+                pp.xadd(stream_name, {self.PAYLOAD_FIELD: payload, self.TIMESTAMP_FIELD: timestamp})
+            return pp.execute()
+
+        def _peak_sync(self, stream_name, group_name):
+            groups = self.rq.redis.xinfo_groups(stream_name) if self.rq.redis.exists(stream_name) else []
+            last_id = next((g['last-delivered-id'] for g in groups if g['name'] == group_name.encode()), b'0-0')
+            result = self.rq.redis.xrange(stream_name, b'(' + last_id, '+', count=1)
+            if result:
+                return self._to_item(result[0])[1:]
+            return None
+
+        async def _peak_async(self, stream_name, group_name):
+            groups = await self.rq.redis.xinfo_groups(stream_name) if await self.rq.redis.exists(stream_name) else []
+            last_id = next((g['last-delivered-id'] for g in groups if g['name'] == group_name.encode()), b'0-0')
+            result = await self.rq.redis.xrange(stream_name, b'(' + last_id, '+', count=1)
+            if result:
+                return self._to_item(result[0])[1:]
+            return None
+
+        def peak(self, stream_name, group_name) -> tuple[bytes, float] | Awaitable[tuple[bytes, float]] | None | Awaitable[None]:
+            """The first entry which is not delivered to any consumer yet"""
+            if self.rq.is_async:
+                return self._peak_async(stream_name, group_name)
+            else:
+                return self._peak_sync(stream_name, group_name)
+
+        def block_pop_first(self, stream_names, group_name, consumer_name, count=1, timeout=0) -> list[tuple[str, bytes, bytes, float]]:
+            """
+            Read at most `count` new entries from the first non-empty streams (in the order of `stream_names`),
+            as (stream name, entry id, payload, timestamp).
+            Only block when all streams are empty. Only sync mode is supported, as it is only used by workers
+            """
+            assert not self.rq.is_async, 'block_pop of stream is only supported in sync mode'
+            items = []
+            for stream_name in stream_names:
+                result = self.rq.redis.xreadgroup(group_name, consumer_name, {stream_name: '>'}, count=count - len(items))
+                for _, entries in result or []:
+                    items.extend((stream_name, *self._to_item(entry)) for entry in entries)
+                if len(items) >= count:
+                    return items
+            if items:
+                return items
+            start = time()
+            while True:
+                effective_timeout = self.rq._get_proper_timeout(start, timeout)
+                if effective_timeout <= 0:
+                    break
+                # entries may come from several streams at the same time
+                result = self.rq.redis.xreadgroup(
+                    group_name, consumer_name, {stream_name: '>' for stream_name in stream_names},
+                    count=count, block=effective_timeout * 1000
+                )
+                for stream_name, entries in result or []:
+                    stream_name = stream_name.decode() if isinstance(stream_name, bytes) else stream_name
+                    items.extend((stream_name, *self._to_item(entry)) for entry in entries)
+                if items:
+                    return items
+            return []
+
+        def claim_stale(
+            self, stream_name, group_name, consumer_name, min_idle_time: float, count: int = 1
+        ) -> list[tuple[tuple[bytes, bytes, float], int]]:
+            """
+            Take over at most `count` oldest entries whose leases are expired (not renewed for `min_idle_time` seconds).
+            Return the entries with how many times each of them has been delivered before.
+            """
+            assert not self.rq.is_async, 'claim_stale of stream is only supported in sync mode'
+            min_idle_time_ms = int(min_idle_time * 1000)
+            stale = self.rq.redis.xpending_range(stream_name, group_name, '-', '+', count, idle=min_idle_time_ms)
+            if not stale:
+                return []
+            times_delivered = {entry['message_id']: entry['times_delivered'] for entry in stale}
+            # xclaim checks the idle time again, so only one consumer can win every entry.
+            # the entries claimed by others are not returned, and the deleted ones have no payload
+            claimed = self.rq.redis.xclaim(stream_name, group_name, consumer_name, min_idle_time_ms, list(times_delivered))
+            return [(self._to_item(entry), times_delivered[entry[0]]) for entry in claimed if entry[1]]
+
+        def renew(self, stream_name, group_name, consumer_name, *entry_ids):
+            """Reset the idle time of the entries, so they will not be claimed by others"""
+            return self.rq.redis.xclaim(stream_name, group_name, consumer_name, 0, list(entry_ids), justid=True)
+
+        def ack(self, stream_name, group_name, *entry_ids):
+            pp = self.rq.redis.pipeline(transaction=False)
+            pp.xack(stream_name, group_name, *entry_ids)
+            pp.xdel(stream_name, *entry_ids)
+            return pp.execute()
+
+        def len(self, stream_name):
+            """Number of entries not acknowledged yet (including the pending ones)"""
+            return self.rq.redis.xlen(stream_name)
+
     def __init__(self, redis_uri, *, socket_timeout: int = None, is_async: bool = False):
         self.redis_uri = redis_uri
         self.is_async = is_async
@@ -159,6 +369,7 @@ class RedisQueue:
         self.redis: redis.Redis | redis.asyncio.Redis = self._init_redis(socket_timeout)
         self.queue = self.QueueOp(self)
         self.pqueue = self.PriorityQueueOp(self)
+        self.squeue = self.StreamQueueOp(self)
 
     def _init_redis(self, socket_timeout) -> redis.Redis | redis.asyncio.Redis:
         if '+cluster://' in self.redis_uri:
@@ -204,6 +415,16 @@ class RedisQueue:
         else:
             return self._count_keys_sync(pattern)
 
+    def incr_fields(self, key, field_amounts: dict[str, int]):
+        """Increase the fields of a hash in one round trip"""
+        pp = self.redis.pipeline(transaction=False)
+        for field, amount in field_amounts.items():
+            pp.hincrby(key, field, amount)
+        return pp.execute()
+
+    def get_fields(self, key) -> dict[bytes, bytes] | Awaitable[dict[bytes, bytes]]:
+        return self.redis.hgetall(key)
+
     def expire(self, key, timeout):
         return self.redis.expire(key, timeout)
 
@@ -0,0 +1,49 @@
+import fcntl
+import os
+import random
+from contextlib import contextmanager
+from pathlib import Path
+from time import sleep
+
+
+class SandboxSlots:
+    """
+    Node-wide limit of running sandboxes, shared by all processes and threads.
+
+    Every slot is a lock file, and a slot is taken by holding an exclusive `flock` on it.
+    Unlike a posix semaphore, the slots held by a process are released by the kernel
+    when it is killed, so a dead worker never leaks slots.
+    """
+    MIN_POLL_INTERVAL = 0.002
+    MAX_POLL_INTERVAL = 0.05
+
+    def __init__(self, slot_dir: str, count: int):
+        self.slot_dir = Path(slot_dir)
+        self.count = count
+        self.slot_dir.mkdir(parents=True, exist_ok=True)
+        self._slot_paths = [str(self.slot_dir / f'slot-{i}.lock') for i in range(count)]
+
+    def _try_acquire(self) -> int | None:
+        # start from a random slot to avoid contention on the first ones
+        offset = random.randrange(self.count)
+        for i in range(self.count):
+            # every acquisition needs its own open file description, as flock is per open file description
+            fd = os.open(self._slot_paths[(offset + i) % self.count], os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    @contextmanager
+    def acquire(self):
+        poll_interval = self.MIN_POLL_INTERVAL
+        while (fd := self._try_acquire()) is None:
+            sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, self.MAX_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            # closing the fd releases the lock
+            os.close(fd)
@@ -1,19 +1,39 @@
+from collections import Counter
 from contextlib import asynccontextmanager
 import logging
+import os
 from time import time
+from typing import Callable
 
 import fastapi
+from fastapi.responses import PlainTextResponse, StreamingResponse
 import uvicorn.logging
 
 from app.model import (
     Submission,
     BatchSubmission,
+    BatchStreamResult,
+    BatchStreamSummary,
+    SubmissionResult,
     JudgeResult,
     BatchJudgeResult,
+    MultiCaseSubmission,
+    MultiCaseJudgeResult,
+    WorkPriority,
+)
+from app.judge import (
+    judge as _judge,
+    judge_batch as _judge_batch,
+    iter_judge_batch as _iter_judge_batch,
+    judge_multi_case as _judge_multi_case,
 )
-from app.judge import judge as _judge, judge_batch as _judge_batch
 from app.worker_manager import WorkerManager
+from app.libs.cpu_affinity import parse_cpu_list
 from app.work_queue import connect_queue
+import app.work_queue as work_queue
+import app.metrics as metrics
+import app.jobs as jobs
+import app.admission as admission
 import app.config as app_config
 
 
@@ -21,6 +41,8 @@ logger = logging.getLogger(__name__)
 
 
 redis_queue = connect_queue(True)
+if app_config.API_CPUS:
+    os.sched_setaffinity(0, parse_cpu_list(app_config.API_CPUS))
 if app_config.RUN_WORKERS:
     print('Running workers...')
     worker_manager =  WorkerManager()
@@ -66,43 +88,178 @@ async def _set_access_log(_: fastapi.FastAPI):
 app = fastapi.FastAPI(lifespan=_set_access_log)
 
 
+def _tenant(x_tenant: str | None = fastapi.Header(None)) -> str:
+    """The tenant of the request, which shares the workers with other tenants by its weight"""
+    return x_tenant or app_config.DEFAULT_TENANT
+
+
+def _admission(priority: WorkPriority):
+    """Reject the request at once with 429 if its works can't be finished before they are timed out"""
+    async def check():
+        retry_after = await admission.check(redis_queue, priority)
+        if retry_after is not None:
+            request_metrics = metrics.Metrics()
+            request_metrics.inc('rejected_total', priority=priority.value)
+            await metrics.flush(redis_queue, request_metrics)
+            raise fastapi.HTTPException(
+                status_code=429, detail='Too many works in the queue',
+                headers={'Retry-After': str(retry_after)},
+            )
+    return fastapi.Depends(check)
+
+
 @app.get('/ping')
 def ping():
     return 'pong'
 
 
-@app.post('/run')
-async def run(submission: Submission):
-    return await _judge(redis_queue, submission)
+@app.post('/run', dependencies=[_admission(WorkPriority.INTERACTIVE)])
+async def run(submission: Submission, tenant: str = fastapi.Depends(_tenant)):
+    return await _judge(redis_queue, submission, endpoint='/run', tenant=tenant)
+
+
+@app.post('/run/batch', dependencies=[_admission(WorkPriority.BATCH)])
+async def run_batch(batch_sub: BatchSubmission, tenant: str = fastapi.Depends(_tenant)):
+    return await _judge_batch(redis_queue, batch_sub, endpoint='/run/batch', tenant=tenant)
+
+
+@app.post('/run/long-batch', dependencies=[_admission(WorkPriority.LONG_BATCH)])
+async def run_long_batch(batch_sub: BatchSubmission, tenant: str = fastapi.Depends(_tenant)):
+    return await _judge_batch(redis_queue, batch_sub, long_batch=True, endpoint='/run/long-batch', tenant=tenant)
 
 
-@app.post('/run/batch')
-async def run_batch(batch_sub: BatchSubmission):
-    return await _judge_batch(redis_queue, batch_sub)
+@app.post('/run/long-batch/stream', dependencies=[_admission(WorkPriority.LONG_BATCH)])
+async def run_long_batch_stream(batch_sub: BatchSubmission, tenant: str = fastapi.Depends(_tenant)):
+    return _stream_batch(batch_sub, '/run/long-batch/stream', tenant, lambda result: result)
 
 
-@app.post('/run/long-batch')
-async def run_long_batch(batch_sub: BatchSubmission):
-    return await _judge_batch(redis_queue, batch_sub, long_batch=True)
+@app.post('/run/multi-case', dependencies=[_admission(WorkPriority.INTERACTIVE)])
+async def run_multi_case(submission: MultiCaseSubmission, tenant: str = fastapi.Depends(_tenant)):
+    return await _judge_multi_case(redis_queue, submission, endpoint='/run/multi-case', tenant=tenant)
 
 
-@app.post('/judge')
-async def judge(submission: Submission):
-    return JudgeResult.from_submission_result(await _judge(redis_queue, submission))
+@app.post('/judge', dependencies=[_admission(WorkPriority.INTERACTIVE)])
+async def judge(submission: Submission, tenant: str = fastapi.Depends(_tenant)):
+    return JudgeResult.from_submission_result(await _judge(
+        redis_queue, submission, endpoint='/judge', tenant=tenant, verdict_only=True
+    ))
 
 
-@app.post('/judge/batch')
-async def judge_batch(batch_sub: BatchSubmission):
-    return BatchJudgeResult.from_submission_result(await _judge_batch(redis_queue, batch_sub))
+@app.post('/judge/batch', dependencies=[_admission(WorkPriority.BATCH)])
+async def judge_batch(batch_sub: BatchSubmission, tenant: str = fastapi.Depends(_tenant)):
+    return BatchJudgeResult.from_submission_result(await _judge_batch(
+        redis_queue, batch_sub, endpoint='/judge/batch', tenant=tenant, verdict_only=True
+    ))
+
+
+@app.post('/judge/long-batch', dependencies=[_admission(WorkPriority.LONG_BATCH)])
+async def judge_batch(batch_sub: BatchSubmission, tenant: str = fastapi.Depends(_tenant)):
+    return BatchJudgeResult.from_submission_result(
+        await _judge_batch(
+            redis_queue, batch_sub, long_batch=True, endpoint='/judge/long-batch', tenant=tenant, verdict_only=True
+        )
+    )
+
+@app.post('/judge/long-batch/stream', dependencies=[_admission(WorkPriority.LONG_BATCH)])
+async def judge_long_batch_stream(batch_sub: BatchSubmission, tenant: str = fastapi.Depends(_tenant)):
+    return _stream_batch(batch_sub, '/judge/long-batch/stream', tenant, JudgeResult.from_submission_result, verdict_only=True)
+
+
+@app.post('/judge/multi-case', dependencies=[_admission(WorkPriority.INTERACTIVE)])
+async def judge_multi_case(submission: MultiCaseSubmission, tenant: str = fastapi.Depends(_tenant)):
+    return MultiCaseJudgeResult.from_submission_result(
+        await _judge_multi_case(redis_queue, submission, endpoint='/judge/multi-case', tenant=tenant, verdict_only=True)
+    )
 
 
-@app.post('/judge/long-batch')
-async def judge_batch(batch_sub: BatchSubmission):
-    return BatchJudgeResult.from_submission_result(await _judge_batch(redis_queue, batch_sub, long_batch=True))
+@app.post('/jobs', dependencies=[_admission(WorkPriority.LONG_BATCH)])
+async def submit_job(batch_sub: BatchSubmission, tenant: str = fastapi.Depends(_tenant)):
+    """Submit a batch as an async job, and return the job info (with `job_id`) right away"""
+    return await jobs.submit(redis_queue, batch_sub, endpoint='/jobs', tenant=tenant)
+
+
+@app.get('/jobs/{job_id}')
+async def get_job(
+    job_id: str,
+    offset: int = fastapi.Query(0, ge=0),
+    limit: int = fastapi.Query(app_config.JOB_MAX_PAGE_SIZE, ge=1, le=app_config.JOB_MAX_PAGE_SIZE),
+):
+    job = await jobs.get(redis_queue, job_id, offset, limit)
+    if job is None:
+        raise fastapi.HTTPException(status_code=404, detail='Job not found')
+    return job
+
+
+@app.delete('/jobs/{job_id}')
+async def cancel_job(job_id: str):
+    job = await jobs.cancel(redis_queue, job_id)
+    if job is None:
+        raise fastapi.HTTPException(status_code=404, detail='Job not found')
+    return job
+
+
+def _stream_batch(
+    batch_sub: BatchSubmission, endpoint: str, tenant: str,
+    convert: Callable[[SubmissionResult], SubmissionResult | JudgeResult], verdict_only: bool = False,
+):
+    """
+    Send the result of every submission as a line of NDJSON as soon as it is finished,
+    and a summary line after all of them.
+    """
+    async def _lines():
+        start_time = time()
+        success = 0
+        reasons = Counter()
+        async for index, result in _iter_judge_batch(
+            redis_queue, batch_sub, long_batch=True, endpoint=endpoint, tenant=tenant, verdict_only=verdict_only
+        ):
+            if result.success:
+                success += 1
+            else:
+                reasons[result.reason.value or 'none'] += 1
+            yield BatchStreamResult(index=index, sub_id=result.sub_id, result=convert(result)).model_dump_json() + '\n'
+        yield BatchStreamSummary(
+            sub_id=batch_sub.sub_id, total=len(batch_sub.submissions), success=success,
+            reasons=dict(reasons), cost=time() - start_time,
+        ).model_dump_json() + '\n'
+    return StreamingResponse(_lines(), media_type='application/x-ndjson')
+
+
+def _hit_rate(hit: int, miss: int):
+    return {
+        'hit': hit,
+        'miss': miss,
+        'hit_rate': hit / (hit + miss) if hit + miss else 0,
+    }
+
+
+def _utilization(idle: float, busy: float):
+    return {
+        'idle': idle,
+        'busy': busy,
+        'utilization': busy / (idle + busy) if idle + busy else 0,
+    }
+
 
 @app.get('/status')
 async def status():
+    stats = await redis_queue.get_fields(app_config.REDIS_STATS_KEY)
+    stats = {k.decode(): int(v) for k, v in stats.items()}
     return {
-        'queue': await redis_queue.pqueue.len(app_config.REDIS_WORK_QUEUE_NAME),
-        'num_workers': await redis_queue.count_keys(f'{app_config.REDIS_WORKER_ID_PREFIX}*')
-    }
\ No newline at end of file
+        'queue': await work_queue.length(redis_queue),
+        'num_workers': await redis_queue.count_keys(f'{app_config.REDIS_WORKER_ID_PREFIX}*'),
+        'compile_cache': {
+            'hit': stats.get('compile_cache_hit', 0),
+            'miss': stats.get('compile_cache_miss', 0),
+        },
+        'verdict_cache': _hit_rate(stats.get('verdict_cache_hit', 0), stats.get('verdict_cache_miss', 0)),
+        'worker_time': _utilization(stats.get('worker_idle_ms', 0) / 1000, stats.get('worker_busy_ms', 0) / 1000),
+    }
+
+
+@app.get('/metrics')
+async def prometheus_metrics():
+    """Metrics of the api and all workers in the prometheus text format"""
+    return PlainTextResponse(
+        await metrics.render(redis_queue), media_type='text/plain; version=0.0.4; charset=utf-8'
+    )
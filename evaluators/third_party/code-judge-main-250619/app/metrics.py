@@ -0,0 +1,143 @@
+"""
+Prometheus metrics of the api and the workers.
+
+The api and all workers (in all nodes) accumulate their metrics in one redis hash,
+so any api process can render all of them in the prometheus text format for `/metrics`.
+Histogram buckets are stored without accumulation (one field per bucket),
+and are accumulated when rendering.
+"""
+from collections import defaultdict
+import socket
+
+import app.config as app_config
+from app.libs.redis_queue import RedisQueue
+import app.work_queue as work_queue
+
+
+METRIC_PREFIX = 'code_judge_'
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, 3600)
+METRICS = {
+    'queue_wait_seconds': ('histogram', 'Time from submitting a work to a worker starting it'),
+    'compile_seconds': ('histogram', 'Time of compiling a submission (compile cache hits are not included)'),
+    'execution_seconds': ('histogram', 'Time of running a submission (a case for multi-case submissions)'),
+    'request_seconds': ('histogram', 'End to end latency of a submission in the api'),
+    'results_total': ('counter', 'Results returned by the api'),
+    'rejected_total': ('counter', 'Requests rejected by admission control'),
+    'worker_restarts_total': ('counter', 'Worker processes restarted by the worker manager after they exited'),
+    'killed_executions_total': ('counter', 'Executions killed by the worker manager after their deadlines'),
+}
+WORKER_STATES = ('total', 'busy', 'free', 'draining')
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    return ','.join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+
+
+class Metrics:
+    """Metrics observed by a process, to be accumulated in redis"""
+    def __init__(self):
+        self.counts: dict[str, int] = defaultdict(int)
+        self.sums: dict[str, float] = defaultdict(float)
+
+    def observe(self, name: str, value: float, **labels: str):
+        labels = _format_labels(labels)
+        bucket = next((le for le in HISTOGRAM_BUCKETS if value <= le), '+Inf')
+        self.counts[f'{name}|bucket|{labels}|{bucket}'] += 1
+        self.counts[f'{name}|count|{labels}|'] += 1
+        self.sums[f'{name}|sum|{labels}|'] += value
+
+    def inc(self, name: str, amount: int = 1, **labels: str):
+        self.counts[f'{name}|total|{_format_labels(labels)}|'] += amount
+
+    def merge(self, other: 'Metrics'):
+        for field, amount in other.counts.items():
+            self.counts[field] += amount
+        for field, amount in other.sums.items():
+            self.sums[field] += amount
+
+    def add_to_pipeline(self, pp):
+        for field, amount in self.counts.items():
+            pp.hincrby(app_config.REDIS_METRICS_KEY, field, amount)
+        for field, amount in self.sums.items():
+            pp.hincrbyfloat(app_config.REDIS_METRICS_KEY, field, amount)
+
+
+async def flush(redis_queue: RedisQueue, metrics: Metrics):
+    if not metrics.counts and not metrics.sums:
+        return
+    pp = redis_queue.redis.pipeline(transaction=False)
+    metrics.add_to_pipeline(pp)
+    await pp.execute()
+
+
+def report_worker_states(redis_queue: RedisQueue, states: dict[str, int]):
+    """Called by `WorkerManager` (sync mode) every `REPORT_INTERVAL` seconds"""
+    key = f'{app_config.REDIS_WORKER_STATES_PREFIX}{socket.gethostname()}'
+    pp = redis_queue.redis.pipeline(transaction=False)
+    pp.hset(key, mapping=states)
+    pp.expire(key, app_config.REDIS_WORKER_STATES_EXPIRE)
+    pp.execute()
+
+
+def _render_histogram(name: str, fields: dict[tuple[str, str, str], float]) -> list[str]:
+    lines = []
+    labels_list = sorted({labels for kind, labels, _ in fields if kind == 'count'})
+    for labels in labels_list:
+        sep = ',' if labels else ''
+        accumulated = 0
+        for le in HISTOGRAM_BUCKETS:
+            accumulated += fields.get(('bucket', labels, str(le)), 0)
+            lines.append(f'{METRIC_PREFIX}{name}_bucket{{{labels}{sep}le="{le}"}} {int(accumulated)}')
+        count = fields.get(('count', labels, ''), 0)
+        lines.append(f'{METRIC_PREFIX}{name}_bucket{{{labels}{sep}le="+Inf"}} {int(count)}')
+        lines.append(f'{METRIC_PREFIX}{name}_sum{{{labels}}} {fields.get(("sum", labels, ""), 0)}')
+        lines.append(f'{METRIC_PREFIX}{name}_count{{{labels}}} {int(count)}')
+    return lines
+
+
+async def render(redis_queue: RedisQueue) -> str:
+    metric_fields: dict[str, dict[tuple[str, str, str], float]] = defaultdict(dict)
+    for field, value in (await redis_queue.get_fields(app_config.REDIS_METRICS_KEY)).items():
+        name, kind, labels, le = field.decode().split('|')
+        metric_fields[name][(kind, labels, le)] = float(value)
+
+    lines = []
+    for name, (metric_type, help) in METRICS.items():
+        lines.append(f'# HELP {METRIC_PREFIX}{name} {help}')
+        lines.append(f'# TYPE {METRIC_PREFIX}{name} {metric_type}')
+        fields = metric_fields.get(name, {})
+        if metric_type == 'histogram':
+            lines.extend(_render_histogram(name, fields))
+        else:
+            for (_, labels, _), value in sorted(fields.items()):
+                lines.append(f'{METRIC_PREFIX}{name}{{{labels}}} {int(value)}')
+
+    # the stats reported to /status
+    stats = await redis_queue.get_fields(app_config.REDIS_STATS_KEY)
+    for field, value in sorted(stats.items()):
+        field = field.decode()
+        value = int(value)
+        if field.endswith('_ms'):
+            field = field[:-len('_ms')] + '_seconds'
+            value = value / 1000
+        lines.append(f'# TYPE {METRIC_PREFIX}{field}_total counter')
+        lines.append(f'{METRIC_PREFIX}{field}_total {value}')
+
+    lines.append(f'# HELP {METRIC_PREFIX}queue_length Works in the queue by priority')
+    lines.append(f'# TYPE {METRIC_PREFIX}queue_length gauge')
+    for priority, length in (await work_queue.lengths(redis_queue)).items():
+        lines.append(f'{METRIC_PREFIX}queue_length{{{_format_labels({"priority": priority.value})}}} {length}')
+
+    lines.append(f'# HELP {METRIC_PREFIX}workers Worker processes by state, reported by the worker manager of every host')
+    lines.append(f'# TYPE {METRIC_PREFIX}workers gauge')
+    async for key in redis_queue.redis.scan_iter(f'{app_config.REDIS_WORKER_STATES_PREFIX}*', count=100):
+        host = key.decode()[len(app_config.REDIS_WORKER_STATES_PREFIX):]
+        states = await redis_queue.get_fields(key)
+        for state in WORKER_STATES:
+            if (value := states.get(state.encode())) is not None:
+                lines.append(f'{METRIC_PREFIX}workers{{{_format_labels({"host": host, "state": state})}}} {int(value)}')
+    return '\n'.join(lines) + '\n'
@@ -1,9 +1,26 @@
 from enum import Enum
-from typing import Literal
+from typing import Any, Literal
 import uuid
 from time import time
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
+
+from app.libs.executors.output_comparator import COMPARE_MODES
+
+
+def _validate_options(options: dict[str, str] | None) -> dict[str, str] | None:
+    """
+    Supported options:
+    - compare: how the output is compared with the expected output, one of `COMPARE_MODES` (default exact).
+    - float_tolerance: the tolerance of numbers in the float compare mode (default 1e-6).
+    """
+    if options is None:
+        return None
+    if options.get('compare', 'exact') not in COMPARE_MODES:
+        raise ValueError(f'compare must be one of {", ".join(COMPARE_MODES)}')
+    if 'float_tolerance' in options:
+        float(options['float_tolerance'])
+    return options
 
 
 class Submission(BaseModel):
@@ -14,6 +31,8 @@ class Submission(BaseModel):
     input: str | None = None
     expected_output: str | None = None
 
+    _check_options = field_validator('options')(_validate_options)
+
     def model_post_init(self, __context):
         self.sub_id = self.sub_id or str(uuid.uuid4())
 
@@ -24,6 +43,25 @@ class ResultReason(Enum):
     WORKER_TIMEOUT = 'worker_timeout'
     QUEUE_TIMEOUT = 'queue_timeout'
     INVALID_INPUT = 'invalid_input'
+    SKIPPED = 'skipped'  # not run because a previous test case failed
+    OUTPUT_LIMIT_EXCEEDED = 'output_limit_exceeded'  # killed as it prints more than MAX_OUTPUT_SIZE
+
+
+class WorkPriority(Enum):
+    """Priority lanes of the work queue, from the highest to the lowest"""
+    INTERACTIVE = 'interactive'  # single submissions
+    BATCH = 'batch'
+    LONG_BATCH = 'long-batch'  # long batches and async jobs
+
+
+class Timings(BaseModel):
+    """Time (in seconds) of every phase of a submission. None if the phase is not applicable."""
+    queue_wait: float | None = None  # from submitted to the queue to taken by a worker
+    setup: float | None = None  # preparing the workdir
+    compile: float | None = None  # None if it is not compiled (or the compile cache is hit)
+    run: float | None = None  # wall time of running the program
+    publish: float | None = None  # from the worker finishing it to the api receiving the result
+    collect: float | None = None  # from the api receiving the result to returning it (for example, waiting for the rest of a batch)
 
 
 class SubmissionResult(BaseModel):
@@ -34,6 +72,49 @@ class SubmissionResult(BaseModel):
     stdout: str | None = None
     stderr: str | None = None
     reason: ResultReason = ResultReason.UNSPECIFIED
+    # the exit code of the process, negative if it is killed (by a signal, the timeout or a compile error)
+    exit_code: int | None = None
+    timings: Timings | None = None
+    # only measured with the cgroup backend (see CGROUP_ROOT)
+    peak_memory: int | None = None  # in bytes
+    cpu_time: float | None = None  # in seconds
+
+
+class TestCase(BaseModel):
+    input: str | None = None
+    expected_output: str | None = None
+
+
+class MultiCaseSubmission(BaseModel):
+    """A solution to run against multiple test cases. It is compiled/setup only once."""
+    sub_id: str | None = None
+    type: Literal['multi_case'] = 'multi_case'
+    language: Literal['python', 'cpp']
+    options: dict[str, str] | None = None
+    solution: str
+    cases: list[TestCase] = Field(..., min_length=1)
+    # skip the remaining cases after the first failed case
+    stop_on_failure: bool = False
+
+    _check_options = field_validator('options')(_validate_options)
+
+    def model_post_init(self, __context):
+        self.sub_id = self.sub_id or str(uuid.uuid4())
+
+    def case_sub_id(self, index: int) -> str:
+        return f'{self.sub_id}:{index}'
+
+
+class MultiCaseSubmissionResult(BaseModel):
+    sub_id: str
+    success: bool         # all cases are successful
+    run_success: bool     # all cases run successfully
+    cost: float           # total cost of all cases
+    reason: ResultReason = ResultReason.UNSPECIFIED  # the reason of the first failed case
+    results: list[SubmissionResult] = []  # one result per case
+    timings: Timings | None = None  # run is the total of all cases
+    peak_memory: int | None = None  # the max of all cases
+    cpu_time: float | None = None  # the total of all cases
 
 
 class BatchSubmission(BaseModel):
@@ -56,6 +137,7 @@ class JudgeResult(BaseModel):
     run_success: bool
     cost: float
     reason: ResultReason = ResultReason.UNSPECIFIED
+    timings: Timings | None = None
 
     @classmethod
     def from_submission_result(cls, result: SubmissionResult):
@@ -64,7 +146,8 @@ class JudgeResult(BaseModel):
             success=result.success,
             run_success=result.run_success,
             cost=result.cost,
-            reason=result.reason
+            reason=result.reason,
+            timings=result.timings,
         )
 
 
@@ -80,12 +163,93 @@ class BatchJudgeResult(BaseModel):
         )
 
 
+class BatchStreamResult(BaseModel):
+    """A line of the streaming batch response, sent as soon as the submission is finished"""
+    type: Literal['result'] = 'result'
+    index: int  # index of the submission in the batch
+    sub_id: str
+    result: SubmissionResult | JudgeResult
+
+
+class BatchStreamSummary(BaseModel):
+    """The last line of the streaming batch response"""
+    type: Literal['summary'] = 'summary'
+    sub_id: str  # sub_id of the batch
+    total: int
+    success: int
+    reasons: dict[str, int]  # number of failed results by reason ('none' if the reason is unspecified)
+    cost: float  # time of the whole batch
+
+
+class JobStatus(Enum):
+    RUNNING = 'running'
+    DONE = 'done'  # all submissions are finished (or timed out)
+    CANCELLED = 'cancelled'  # the unfinished submissions are skipped
+
+
+class JobInfo(BaseModel):
+    job_id: str
+    sub_id: str  # sub_id of the batch
+    status: JobStatus
+    total: int
+    finished: int  # number of submissions which have results
+    created_at: float
+    # the available results in the requested page ([offset, offset + limit) of the submissions)
+    results: list[BatchStreamResult] = []
+    next_offset: int | None = None  # None if it is the last page
+
+
+class MultiCaseJudgeResult(BaseModel):
+    sub_id: str
+    success: bool
+    run_success: bool
+    cost: float
+    reason: ResultReason = ResultReason.UNSPECIFIED
+    results: list[JudgeResult]
+    timings: Timings | None = None
+
+    @classmethod
+    def from_submission_result(cls, result: MultiCaseSubmissionResult):
+        return cls(
+            sub_id=result.sub_id,
+            success=result.success,
+            run_success=result.run_success,
+            cost=result.cost,
+            reason=result.reason,
+            results=[JudgeResult.from_submission_result(r) for r in result.results],
+            timings=result.timings,
+        )
+
+
 class WorkPayload(BaseModel):
     work_id: str | None = None
     timestamp: float | None = None
     long_running: bool = False
-    submission: Submission | BatchSubmission = Field(..., discriminator='type')
+    # where the worker pushes the result to.
+    # the default is a queue for this work only (`REDIS_RESULT_PREFIX` + work_id),
+    # and all works of a batch share one queue.
+    result_queue_name: str | None = None
+    # the api endpoint which submits the work, for metrics only
+    endpoint: str = ''
+    # set if the work belongs to an async job.
+    # the result is stored in the results of the job, instead of pushed to `result_queue_name`.
+    job_id: str | None = None
+    job_index: int | None = None  # index of the submission in the job
+    # only the verdict is returned (the judge api), so the output is not captured
+    verdict_only: bool = False
+    # the fields of the submission which are stored as blobs (see `app.blobs`),
+    # from the path of the field (for example, `input` or `cases.0.input`) to the content hash
+    blobs: dict[str, str] = {}
+    submission: Submission | BatchSubmission | MultiCaseSubmission = Field(..., discriminator='type')
 
     def model_post_init(self, __context):
         self.work_id = self.work_id or str(uuid.uuid4())
         self.timestamp = self.timestamp or time()
+
+
+class WorkResult(BaseModel):
+    """What the worker pushes to the result queue"""
+    work_id: str
+    finished_at: float = Field(default_factory=time)
+    # SubmissionResult or MultiCaseSubmissionResult, depending on the submission
+    result: dict[str, Any]
@@ -0,0 +1,124 @@
+"""
+Cache of deterministic results in redis, keyed by the content hash of the submission
+and the execution limits.
+
+Every cached result is stored in its own key with `VERDICT_CACHE_EXPIRE`.
+To cap the memory, all keys are also recorded in a sorted set (scored by insertion time)
+together with their sizes, and the oldest ones are evicted
+when the total size exceeds `VERDICT_CACHE_MAX_MEMORY`.
+The total size is approximate if multiple api processes evict at the same time.
+"""
+import hashlib
+import json
+from time import time
+
+import app.config as app_config
+from app.libs.redis_queue import RedisQueue
+from app.model import Submission, SubmissionResult, ResultReason
+
+_EVICT_BATCH_SIZE = 100
+
+
+def enabled() -> bool:
+    return app_config.VERDICT_CACHE_EXPIRE > 0
+
+
+def verdict_key(sub: Submission, verdict_only: bool = False) -> str:
+    """`verdict_only` results have no output, so they are cached separately"""
+    content = json.dumps([
+        app_config.version,
+        sub.type,
+        sub.options,
+        sub.solution,
+        sub.input,
+        sub.expected_output,
+        app_config.MAX_EXECUTION_TIME,
+        app_config.MAX_MEMORY,
+        verdict_only,
+    ], sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def is_cacheable(result: SubmissionResult) -> bool:
+    # timeouts, internal errors and the processes killed by signals (oom for example) are not deterministic
+    return result.reason == ResultReason.UNSPECIFIED and result.exit_code is not None and result.exit_code >= 0
+
+
+async def get_many(redis_queue: RedisQueue, keys: list[str]) -> dict[str, SubmissionResult]:
+    if not keys:
+        return {}
+    pp = redis_queue.redis.pipeline(transaction=False)
+    for key in keys:
+        pp.get(f'{app_config.REDIS_VERDICT_CACHE_PREFIX}{key}')
+    values = await pp.execute()
+    return {
+        key: SubmissionResult.model_validate_json(value)
+        for key, value in zip(keys, values) if value is not None
+    }
+
+
+async def put_many(redis_queue: RedisQueue, results: dict[str, SubmissionResult]):
+    entries = {}
+    for key, result in results.items():
+        if not is_cacheable(result):
+            continue
+        # timings are only meaningful for the run which produces the result
+        value = result.model_dump_json(exclude={'timings'})
+        if len(value) > app_config.VERDICT_CACHE_MAX_ITEM_SIZE:
+            continue
+        entries[key] = value
+    if not entries:
+        return
+
+    pp = redis_queue.redis.pipeline(transaction=False)
+    for key, value in entries.items():
+        pp.set(f'{app_config.REDIS_VERDICT_CACHE_PREFIX}{key}', value, ex=app_config.VERDICT_CACHE_EXPIRE, nx=True)
+    added = await pp.execute()
+
+    now = time()
+    members = {f'{key}:{len(value)}': now for (key, value), ok in zip(entries.items(), added) if ok}
+    if not members:
+        return
+    pp = redis_queue.redis.pipeline(transaction=False)
+    pp.zadd(app_config.REDIS_VERDICT_CACHE_INDEX, members)
+    pp.incrby(app_config.REDIS_VERDICT_CACHE_SIZE, sum(_member_size(m.encode()) for m in members))
+    _, total_size = await pp.execute()
+    await _evict(redis_queue, now, total_size)
+
+
+def _member_size(member: bytes) -> int:
+    return int(member.split(b':', 1)[1])
+
+
+async def _evict(redis_queue: RedisQueue, now: float, total_size: int):
+    # expired keys are removed from the index, and the oldest keys are evicted if the cache is full
+    expired = await redis_queue.redis.zrangebyscore(
+        app_config.REDIS_VERDICT_CACHE_INDEX, '-inf', now - app_config.VERDICT_CACHE_EXPIRE,
+        start=0, num=_EVICT_BATCH_SIZE
+    )
+    evicted = list(expired)
+    evicted_size = sum(_member_size(m) for m in evicted)
+    if expired:
+        await redis_queue.redis.zrem(app_config.REDIS_VERDICT_CACHE_INDEX, *expired)
+    while total_size - evicted_size > app_config.VERDICT_CACHE_MAX_MEMORY:
+        # evict a batch at a time
+        oldest = await redis_queue.redis.zpopmin(app_config.REDIS_VERDICT_CACHE_INDEX, _EVICT_BATCH_SIZE)
+        if not oldest:
+            break
+        for member, _ in oldest:
+            evicted.append(member)
+            evicted_size += _member_size(member)
+    if not evicted:
+        return
+    pp = redis_queue.redis.pipeline(transaction=False)
+    for member in evicted:
+        key = member.split(b':', 1)[0].decode()
+        pp.delete(f'{app_config.REDIS_VERDICT_CACHE_PREFIX}{key}')
+    pp.decrby(app_config.REDIS_VERDICT_CACHE_SIZE, evicted_size)
+    await pp.execute()
+
+
+async def record_stats(redis_queue: RedisQueue, hits: int, misses: int):
+    stats = {k: v for k, v in {'verdict_cache_hit': hits, 'verdict_cache_miss': misses}.items() if v}
+    if stats:
+        await redis_queue.incr_fields(app_config.REDIS_STATS_KEY, stats)
@@ -1,10 +1,222 @@
+from time import time
+import logging
+import threading
+
 from app.libs.redis_queue import RedisQueue
+from app.model import WorkPriority
 import app.config as app_config
 
 
+logger = logging.getLogger(__name__)
+
+
 def connect_queue(is_async: bool = False) -> RedisQueue:
     return RedisQueue(
         redis_uri=app_config.REDIS_URI,
         socket_timeout=app_config.REDIS_SOCKET_TIMEOUT,
         is_async=is_async,
     )
+
+
+# The work queue shared by the api and the workers.
+# The backend is selected by `WORK_QUEUE_BACKEND`, and there is a queue (lane) for every `WorkPriority`.
+
+def _is_stream() -> bool:
+    return app_config.WORK_QUEUE_BACKEND == 'stream'
+
+
+def queue_name(priority: WorkPriority) -> str:
+    # use a hash tag to make sure all lanes are in the same slot in redis cluster,
+    # so they can be popped with one command.
+    name = app_config.REDIS_WORK_STREAM_NAME if _is_stream() else app_config.REDIS_WORK_QUEUE_NAME
+    return f'{{{name}}}:{priority.value}'
+
+
+def _clock_name(priority: WorkPriority) -> str:
+    return f'{queue_name(priority)}:clock'
+
+
+def _queue_names() -> list[str]:
+    return [queue_name(priority) for priority in WorkPriority]
+
+
+def _tenant_weight(tenant: str) -> float:
+    return app_config.TENANT_WEIGHTS.get(tenant, 1.0)
+
+
+async def push(
+    redis_queue: RedisQueue, payload_timestamps: dict[str, float],
+    priority: WorkPriority, tenant: str = app_config.DEFAULT_TENANT,
+) -> list[float]:
+    """
+    Push the works (of the same tenant) to the lane of `priority`, and return their scores
+    (which are comparable with the score returned by `peak`).
+    """
+    if not payload_timestamps:
+        return []
+    if _is_stream():
+        await redis_queue.squeue.push(queue_name(priority), payload_timestamps)
+        return list(payload_timestamps.values())
+    return await redis_queue.pqueue.push_fair(
+        queue_name(priority), _clock_name(priority), tenant, _tenant_weight(tenant),
+        list(payload_timestamps), app_config.LONG_BATCH_MAX_QUEUE_WAIT_TIME,
+    )
+
+
+async def peak(redis_queue: RedisQueue, priority: WorkPriority):
+    """The first work of the lane not taken by any worker yet, as (payload, score)"""
+    if _is_stream():
+        return await redis_queue.squeue.peak(queue_name(priority), app_config.REDIS_WORK_STREAM_GROUP)
+    return await redis_queue.pqueue.peak(queue_name(priority))
+
+
+async def lengths(redis_queue: RedisQueue) -> dict[WorkPriority, int]:
+    result = {}
+    for priority in WorkPriority:
+        if _is_stream():
+            result[priority] = await redis_queue.squeue.len(queue_name(priority))
+        else:
+            result[priority] = await redis_queue.pqueue.len(queue_name(priority))
+    return result
+
+
+async def length(redis_queue: RedisQueue) -> int:
+    return sum((await lengths(redis_queue)).values())
+
+
+def length_sync(redis_queue: RedisQueue) -> int:
+    """
+    The total length of the lanes, used by the worker manager (sync mode).
+    Please note the works taken by workers are included in stream mode, until they are acknowledged.
+    """
+    pp = redis_queue.redis.pipeline(transaction=False)
+    for name in _queue_names():
+        if _is_stream():
+            pp.xlen(name)
+        else:
+            pp.zcard(name)
+    return sum(pp.execute())
+
+
+def in_progress_grace_time() -> int:
+    """
+    How long the api waits for the works which are taken by workers.
+    A work of a dead worker is redelivered after its lease is expired in stream mode,
+    and a pipelined worker may hold `WORKER_PREFETCH_COUNT` works besides the running one.
+    """
+    grace_time = app_config.MAX_PROCESS_TIME
+    if app_config.WORKER_PIPELINE:
+        grace_time *= 1 + app_config.WORKER_PREFETCH_COUNT
+    if _is_stream():
+        grace_time += app_config.WORK_QUEUE_LEASE_TIME
+    return grace_time
+
+
+# (stream name, entry id) of a work in stream mode, None in zset mode
+WorkHandle = tuple[str, bytes] | None
+
+
+class WorkConsumer:
+    """
+    Used by workers (sync mode) to take works from the queue, from the highest priority lane to the lowest.
+    In stream mode, the leases of the works taken by this consumer are renewed in a background thread
+    until they are acknowledged.
+    """
+    def __init__(self, redis_queue: RedisQueue, consumer_name: str):
+        self.redis_queue = redis_queue
+        self.consumer_name = consumer_name
+        self._last_claim_time = 0
+        self._held_handles: set[tuple[str, bytes]] = set()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        if _is_stream():
+            for stream_name in _queue_names():
+                redis_queue.squeue.create_group(stream_name, app_config.REDIS_WORK_STREAM_GROUP)
+            threading.Thread(target=self._renew_loop, daemon=True).start()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed.is_set()
+
+    @staticmethod
+    def _group_by_stream(handles) -> dict[str, list[bytes]]:
+        entry_ids = {}
+        for stream_name, entry_id in handles:
+            entry_ids.setdefault(stream_name, []).append(entry_id)
+        return entry_ids
+
+    def _renew_loop(self):
+        while not self._closed.wait(max(app_config.WORK_QUEUE_LEASE_TIME / 3, 1)):
+            with self._lock:
+                handles = list(self._held_handles)
+            for stream_name, entry_ids in self._group_by_stream(handles).items():
+                try:
+                    self.redis_queue.squeue.renew(
+                        stream_name, app_config.REDIS_WORK_STREAM_GROUP, self.consumer_name, *entry_ids
+                    )
+                except Exception:
+                    logger.exception(f'Failed to renew the lease of works {entry_ids}')
+
+    def _pop_many(self, count: int, timeout: int) -> list[tuple[WorkHandle, bytes, int]]:
+        if not _is_stream():
+            work_items = self.redis_queue.pqueue.pop_first(_queue_names(), count)
+            if work_items:
+                return [(None, payload_json, 1) for _, payload_json, _ in work_items]
+            work_item = self.redis_queue.pqueue.block_pop(*_queue_names(), timeout=timeout)
+            if not work_item:
+                return []
+            _, payload_json, _ = work_item
+            return [(None, payload_json, 1)]
+
+        if time() - self._last_claim_time >= app_config.WORK_QUEUE_LEASE_TIME / 2:
+            # works of dead workers go first
+            work_items = []
+            for stream_name in _queue_names():
+                stale = self.redis_queue.squeue.claim_stale(
+                    stream_name, app_config.REDIS_WORK_STREAM_GROUP,
+                    self.consumer_name, app_config.WORK_QUEUE_LEASE_TIME, count - len(work_items)
+                )
+                work_items.extend(
+                    ((stream_name, entry_id), payload_json, times_delivered + 1)
+                    for (entry_id, payload_json, _), times_delivered in stale
+                )
+                if len(work_items) >= count:
+                    break
+            else:
+                # all stale works are taken, check again later
+                self._last_claim_time = time()
+            if work_items:
+                return work_items
+        work_items = self.redis_queue.squeue.block_pop_first(
+            _queue_names(), app_config.REDIS_WORK_STREAM_GROUP, self.consumer_name, count,
+            # wake up in time to claim stale works
+            timeout=min(timeout, max(app_config.WORK_QUEUE_LEASE_TIME // 2, 1))
+        )
+        return [((stream_name, entry_id), payload_json, 1) for stream_name, entry_id, payload_json, _ in work_items]
+
+    def pop_many(self, count: int, timeout: int) -> list[tuple[WorkHandle, bytes, int]]:
+        """
+        Return at most `count` works as (handle, payload, delivery count).
+        Only block (for at most `timeout` seconds) when there is no work.
+        """
+        work_items = self._pop_many(count, timeout)
+        with self._lock:
+            self._held_handles.update(handle for handle, _, _ in work_items if handle is not None)
+        return work_items
+
+    def pop(self, timeout: int) -> tuple[WorkHandle, bytes, int] | None:
+        work_items = self.pop_many(1, timeout)
+        return work_items[0] if work_items else None
+
+    def ack(self, *handles: WorkHandle):
+        handles = [handle for handle in handles if handle is not None]
+        if not handles:
+            return
+        with self._lock:
+            self._held_handles.difference_update(handles)
+        for stream_name, entry_ids in self._group_by_stream(handles).items():
+            self.redis_queue.squeue.ack(stream_name, app_config.REDIS_WORK_STREAM_GROUP, *entry_ids)
+
+    def close(self):
+        """Stop renewing the leases. The works not acknowledged will be redelivered."""
+        self._closed.set()
@@ -1,24 +1,54 @@
+import multiprocessing
 from multiprocessing import Process
+from multiprocessing.connection import wait
 import logging
+import os
+import queue
+import socket
+import subprocess
 import threading
-from time import sleep, time
+from time import monotonic, perf_counter, sleep, time
 from pathlib import Path
 import json
 from dataclasses import asdict
+from contextlib import nullcontext
 import traceback
 import uuid
 import json
 
-import psutil
 from pydantic import ValidationError
 
 from app.libs.executors.executor import ProcessExecuteResult
-from app.model import Submission, SubmissionResult, WorkPayload, ResultReason
+from app.model import (
+    Submission,
+    SubmissionResult,
+    MultiCaseSubmission,
+    MultiCaseSubmissionResult,
+    WorkPayload,
+    WorkResult,
+    ResultReason,
+    Timings,
+)
 from app.libs.executors.python_executor import PythonExecutor, ScriptExecutor
 from app.libs.executors.cpp_executor import CppExecutor
-from app.libs.executors.executor import TIMEOUT_EXIT_CODE
+from app.libs.executors.compile_cache import CompileCache
+from app.libs.executors.python_zygote import PythonZygote
+from app.libs.executors.output_comparator import OutputComparator, DEFAULT_FLOAT_TOLERANCE
+from app.libs.executors.workdir_pool import WorkdirPool
+from app.libs.executors.precompiled_header import PrecompiledHeader
+from app.libs.executors.cgroup import CgroupBackend
+from app.libs.sandbox_slots import SandboxSlots
+from app.libs.execution_deadlines import ExecutionDeadlines
+from app.libs.autoscaler import Autoscaler
+from app.libs.cpu_affinity import CpuAllocator, parse_cpu_list
+from app.libs.executors.executor import TIMEOUT_EXIT_CODE, COMPILE_ERROR_EXIT_CODE, OutputLimit
 import app.config as app_config
-from app.work_queue import connect_queue
+from app.metrics import Metrics, report_worker_states
+from app.work_queue import connect_queue, length_sync, WorkConsumer, WorkHandle
+import app.jobs as jobs
+import app.admission as admission
+import app.blobs as blobs
+from app.libs.redis_queue import RedisQueue
 
 from app.libs.utils import nothrow_killpg
 
@@ -26,7 +56,7 @@ from app.libs.utils import nothrow_killpg
 logger = logging.getLogger(__name__)
 
 
-def save_error_case(sub: Submission, result: ProcessExecuteResult | None = None, exception: Exception | None = None):
+def save_error_case(sub: Submission | MultiCaseSubmission, result: ProcessExecuteResult | None = None, exception: Exception | None = None):
     if not app_config.ERROR_CASE_SAVE_PATH:
         return
 
@@ -48,12 +78,151 @@ def save_error_case(sub: Submission, result: ProcessExecuteResult | None = None,
         logger.exception(f'Failed to save error case for submission {sub.sub_id}')
 
 
+_compile_cache: CompileCache | None = None
+_compile_cache_lock = threading.Lock()
+
+
+def get_compile_cache() -> CompileCache | None:
+    """The compile cache is created lazily, so it is only created in worker processes."""
+    global _compile_cache
+    with _compile_cache_lock:
+        if _compile_cache is None and app_config.CPP_COMPILE_CACHE_DIR:
+            try:
+                _compile_cache = CompileCache(
+                    app_config.CPP_COMPILE_CACHE_DIR,
+                    app_config.CPP_COMPILE_CACHE_MAX_SIZE * 1024 * 1024,
+                )
+            except Exception:
+                logger.exception(f'Failed to create compile cache in {app_config.CPP_COMPILE_CACHE_DIR}. Disabled.')
+                app_config.CPP_COMPILE_CACHE_DIR = ''
+    return _compile_cache
+
+
+_cgroups: CgroupBackend | None = None
+_cgroups_lock = threading.Lock()
+
+
+def get_cgroups() -> CgroupBackend | None:
+    """The cgroup backend is created lazily, so it is only created in worker processes."""
+    global _cgroups
+    with _cgroups_lock:
+        if _cgroups is None and app_config.CGROUP_ROOT:
+            try:
+                _cgroups = CgroupBackend(app_config.CGROUP_ROOT, app_config.CGROUP_CPUS, app_config.CGROUP_PIDS_MAX)
+            except Exception:
+                logger.exception(f'Failed to use cgroups in {app_config.CGROUP_ROOT}. Fall back to rlimits.')
+                app_config.CGROUP_ROOT = ''
+    return _cgroups
+
+
+_precompiled_header: PrecompiledHeader | None = None
+_precompiled_header_lock = threading.Lock()
+
+
+def get_precompiled_header() -> PrecompiledHeader | None:
+    """The precompiled header is created lazily, so it is only created in worker processes."""
+    global _precompiled_header
+    with _precompiled_header_lock:
+        if _precompiled_header is None and app_config.CPP_PCH_HEADERS and app_config.CPP_PCH_DIR:
+            try:
+                compiler_version = subprocess.run(
+                    [app_config.CPP_COMPILER_PATH, '--version'], capture_output=True, text=True, timeout=10,
+                ).stdout
+                _precompiled_header = PrecompiledHeader(
+                    app_config.CPP_PCH_DIR, app_config.CPP_PCH_HEADERS, compiler_version,
+                )
+            except Exception:
+                logger.exception(f'Failed to create precompiled header in {app_config.CPP_PCH_DIR}. Disabled.')
+                app_config.CPP_PCH_DIR = ''
+    return _precompiled_header
+
+
+_workdir_pool: WorkdirPool | None = None
+_workdir_pool_lock = threading.Lock()
+
+
+def get_workdir_pool() -> WorkdirPool | None:
+    """The workdir pool is created lazily, so it is only created in worker processes."""
+    global _workdir_pool
+    with _workdir_pool_lock:
+        if _workdir_pool is None and app_config.WORKDIR_POOL_DIR:
+            try:
+                _workdir_pool = WorkdirPool(
+                    app_config.WORKDIR_POOL_DIR,
+                    # an idle workdir for every executor thread
+                    app_config.WORKER_CONCURRENCY,
+                    app_config.WORKDIR_QUOTA * 1024 * 1024,
+                    # the workdirs of all sandboxes in the node may be written at the same time
+                    app_config.MAX_SANDBOXES,
+                )
+            except Exception:
+                logger.exception(f'Failed to create workdir pool in {app_config.WORKDIR_POOL_DIR}. Disabled.')
+                app_config.WORKDIR_POOL_DIR = ''
+    return _workdir_pool
+
+
+# the deadlines of the executions of this worker process, watched by the worker manager
+_execution_deadlines: ExecutionDeadlines | None = None
+
+
+# one zygote per executor thread, as a zygote can only run one script at a time
+_python_zygote = threading.local()
+
+
+def get_python_zygote() -> PythonZygote | None:
+    """The zygote is created lazily, so it is only created in worker processes."""
+    if getattr(_python_zygote, 'zygote', None) is None and app_config.PYTHON_ZYGOTE:
+        _python_zygote.zygote = PythonZygote(
+            app_config.PYTHON_EXECUTOR_PATH, app_config.PYTHON_ZYGOTE_PRELOAD_MODULES, _execution_deadlines,
+        )
+    return getattr(_python_zygote, 'zygote', None)
+
+
+_sandbox_slots: SandboxSlots | None = None
+
+
+def sandbox_slot():
+    """Take a slot of the node-wide sandbox limit, if the limit can be exceeded."""
+    global _sandbox_slots
+    if app_config.MAX_WORKERS * app_config.WORKER_CONCURRENCY <= app_config.MAX_SANDBOXES:
+        return nullcontext()
+    if _sandbox_slots is None:
+        _sandbox_slots = SandboxSlots(app_config.SANDBOX_SLOTS_DIR, app_config.MAX_SANDBOXES)
+    return _sandbox_slots.acquire()
+
+
+def collect_stats(idle_time: float = 0, busy_time: float = 0) -> dict[str, int]:
+    """The stats since the last call, which are accumulated in redis."""
+    stats = {
+        # time of the worker waiting for works / processing works
+        'worker_idle_ms': int(idle_time * 1000),
+        'worker_busy_ms': int(busy_time * 1000),
+    }
+    compile_cache = get_compile_cache()
+    if compile_cache is not None:
+        stats.update(compile_cache.pop_stats())
+    return {k: v for k, v in stats.items() if v}
+
+
+def _output_limit() -> OutputLimit:
+    return OutputLimit(
+        max_size=app_config.MAX_OUTPUT_SIZE * 1024 * 1024 or None,
+        # enough bytes for MAX_STDOUT_ERROR_LENGTH characters (the returned length)
+        capture_size=app_config.MAX_STDOUT_ERROR_LENGTH * 4,
+    )
+
+
 def executor_factory(type: str) -> ScriptExecutor:
     if type == 'python':
         return PythonExecutor(
             run_cl=app_config.PYTHON_EXECUTE_COMMAND,
             timeout=app_config.MAX_EXECUTION_TIME,
             memory_limit=app_config.MAX_MEMORY * 1024 * 1024,
+            zygote=get_python_zygote(),
+            output_limit=_output_limit(),
+            workdir_pool=get_workdir_pool(),
+            cgroups=get_cgroups(),
+            deadlines=_execution_deadlines,
         )
     elif type == 'cpp':
         return CppExecutor(
@@ -61,46 +230,174 @@ def executor_factory(type: str) -> ScriptExecutor:
             run_cl=app_config.CPP_EXECUTE_COMMAND,
             timeout=app_config.MAX_EXECUTION_TIME,
             memory_limit=app_config.MAX_MEMORY * 1024 * 1024,
+            compile_cache=get_compile_cache(),
+            output_limit=_output_limit(),
+            workdir_pool=get_workdir_pool(),
+            precompiled_header=get_precompiled_header(),
+            cgroups=get_cgroups(),
+            deadlines=_execution_deadlines,
         )
     else:
         raise ValueError(f'Unsupported type: {type}')
 
 
-def judge(sub: Submission):
+def _to_submission_result(
+    sub_id: str, expected_output: str | None, result: ProcessExecuteResult, verdict_only: bool = False
+) -> SubmissionResult:
+    success = result.success
+    # a process killed for its wrong output (not exiting in the grace period) doesn't run successfully either
+    run_success = result.success
+    if result.output_matched is not None:
+        success = success and result.output_matched
+    elif expected_output is not None:
+        success = success and result.stdout.strip() == expected_output.strip()
+    return SubmissionResult(
+        sub_id=sub_id, success=success, cost=result.cost,
+        run_success=run_success,
+        # the output is not returned to the judge api
+        stdout=result.stdout[:app_config.MAX_STDOUT_ERROR_LENGTH]
+            if result.stdout is not None and not verdict_only else None,
+        stderr=result.stderr[:app_config.MAX_STDOUT_ERROR_LENGTH]
+            if result.stdout is not None and not verdict_only else None,
+        reason=ResultReason.WORKER_TIMEOUT
+            if result.exit_code == TIMEOUT_EXIT_CODE
+            else ResultReason.OUTPUT_LIMIT_EXCEEDED
+            if result.output_limit_exceeded
+            else ResultReason.UNSPECIFIED,
+        exit_code=result.exit_code,
+        timings=Timings(
+            setup=result.setup_cost or None,
+            compile=result.compile_cost or None,
+            run=result.run_cost if result.exit_code != COMPILE_ERROR_EXIT_CODE else None,
+        ),
+        peak_memory=result.peak_memory,
+        cpu_time=result.cpu_time,
+    )
+
+
+def _sum_timings(results: list[SubmissionResult]) -> Timings:
+    """Timings of a multi-case submission from its cases (only the first case has setup/compile)."""
+    def _sum(phase: str) -> float | None:
+        values = [getattr(r.timings, phase) for r in results if r.timings is not None]
+        values = [v for v in values if v is not None]
+        return sum(values) if values else None
+    return Timings(setup=_sum('setup'), compile=_sum('compile'), run=_sum('run'))
+
+
+def _observe_result(metrics: Metrics | None, result: ProcessExecuteResult, language: str, endpoint: str):
+    if metrics is None:
+        return
+    if result.compile_cost:
+        metrics.observe('compile_seconds', result.compile_cost, language=language, endpoint=endpoint)
+    if result.exit_code != COMPILE_ERROR_EXIT_CODE:
+        metrics.observe('execution_seconds', result.cost, language=language, endpoint=endpoint)
+
+
+def _comparator(expected_output: str | None, options: dict[str, str] | None) -> OutputComparator | None:
+    """The comparator of the stdout with the expected output (see `Submission.options`)"""
+    if expected_output is None:
+        return None
+    options = options or {}
+    return OutputComparator(
+        expected_output,
+        options.get('compare', 'exact'),
+        float(options.get('float_tolerance', DEFAULT_FLOAT_TOLERANCE)),
+    )
+
+
+def judge(sub: Submission, metrics: Metrics | None = None, endpoint: str = '', verdict_only: bool = False):
     try:
         executor = executor_factory(sub.type)
-        result = executor.execute_script(sub.solution, sub.input)
-
-        success = result.success
-        run_success = result.success
-        if sub.expected_output is not None:
-            success = success and result.stdout.strip() == sub.expected_output.strip()
-        if not success:
+        result = executor.execute_script(
+            sub.solution, sub.input,
+            comparator=_comparator(sub.expected_output, sub.options), capture_stdout=not verdict_only,
+        )
+        _observe_result(metrics, result, sub.type, endpoint)
+        sub_result = _to_submission_result(sub.sub_id, sub.expected_output, result, verdict_only)
+        if not sub_result.success:
             save_error_case(sub, result)
+    except Exception as e:
+        logger.exception(f'Worker failed to judge submission {sub.sub_id}')
+        save_error_case(sub, None, e)
         sub_result = SubmissionResult(
-            sub_id=sub.sub_id, success=success, cost=result.cost,
-            run_success=run_success,
-            # only save stdout and stderr if expected_output is None
-            stdout=result.stdout[:app_config.MAX_STDOUT_ERROR_LENGTH]
-                if result.stdout is not None else None,
-            stderr=result.stderr[:app_config.MAX_STDOUT_ERROR_LENGTH]
-                if result.stdout is not None else None,
-            reason=ResultReason.WORKER_TIMEOUT
-                if result.exit_code == TIMEOUT_EXIT_CODE
-                else ResultReason.UNSPECIFIED
+            sub_id=sub.sub_id, run_success=False, success=False, cost=0, reason=ResultReason.INTERNAL_ERROR
+        )
+    return sub_result
+
+
+def judge_multi_case(
+    sub: MultiCaseSubmission, metrics: Metrics | None = None, endpoint: str = '', verdict_only: bool = False
+):
+    try:
+        executor = executor_factory(sub.language)
+        case_results = executor.execute_script_cases(
+            sub.solution, [case.input for case in sub.cases],
+            comparators=[_comparator(case.expected_output, sub.options) for case in sub.cases],
+            capture_stdout=not verdict_only,
+        )
+        results: list[SubmissionResult] = []
+        failed_result = None
+        try:
+            for case, result in zip(sub.cases, case_results):
+                _observe_result(metrics, result, sub.language, endpoint)
+                case_result = _to_submission_result(
+                    sub.case_sub_id(len(results)), case.expected_output, result, verdict_only
+                )
+                results.append(case_result)
+                if not case_result.success and failed_result is None:
+                    failed_result = case_result
+                    save_error_case(sub, result)
+                    if sub.stop_on_failure:
+                        break
+        finally:
+            # stop running the remaining cases and clean up the workdir
+            case_results.close()
+
+        for index in range(len(results), len(sub.cases)):
+            results.append(SubmissionResult(
+                sub_id=sub.case_sub_id(index), run_success=False, success=False, cost=0, reason=ResultReason.SKIPPED
+            ))
+        peak_memories = [r.peak_memory for r in results if r.peak_memory is not None]
+        cpu_times = [r.cpu_time for r in results if r.cpu_time is not None]
+        sub_result = MultiCaseSubmissionResult(
+            sub_id=sub.sub_id,
+            success=failed_result is None,
+            run_success=all(r.run_success for r in results),
+            cost=sum(r.cost for r in results),
+            reason=failed_result.reason if failed_result is not None else ResultReason.UNSPECIFIED,
+            results=results,
+            timings=_sum_timings(results),
+            peak_memory=max(peak_memories) if peak_memories else None,
+            cpu_time=sum(cpu_times) if cpu_times else None,
         )
     except Exception as e:
         logger.exception(f'Worker failed to judge submission {sub.sub_id}')
         save_error_case(sub, None, e)
-        sub_result = SubmissionResult(
+        sub_result = MultiCaseSubmissionResult(
             sub_id=sub.sub_id, run_success=False, success=False, cost=0, reason=ResultReason.INTERNAL_ERROR
         )
     return sub_result
 
 
+# (result queue name, hash field, result json, expire time)
+# the result is pushed to the queue if the field is None, otherwise it is stored in the hash (the results of a job).
+Publication = tuple[str, str | None, str, int]
+
+
 class Worker(Process):
+    """
+    A worker process, which runs `WORKER_CONCURRENCY` executors.
+    When `drain` is set (by the worker manager to scale down), the executors stop taking new works,
+    and the process exits after the taken works are processed and their results are published.
+    If `cpus` is set, the process (and so its sandboxes) is pinned to them.
+    """
+    def __init__(self, deadlines: ExecutionDeadlines, cpus: list[int] | None = None):
+        super().__init__()
+        self.deadlines = deadlines
+        self.cpus = cpus
+        self.drain = multiprocessing.Event()
+
     def _run_loop(self):
-        worker_id = str(uuid.uuid4())
         redis_queue = connect_queue(False)
         # warm up the connection
         for _ in range(10):
@@ -109,79 +406,274 @@ class Worker(Process):
             logger.warning(f'Clock skew detected: {time_offset:.2f} seconds. '
                            f'This may cause issues with timeouts.'
                            f'Please make sure MAX_QUEUE_WORK_LIFE_TIME{app_config.MAX_QUEUE_WORK_LIFE_TIME} is large enough.')
-        while True:
-            # register worker id
-            redis_queue.set(
-                f'{app_config.REDIS_WORKER_ID_PREFIX}{worker_id}',
-                1,
-                app_config.REDIS_WORKER_REGISTER_EXPIRE
-            )
-            work_item = redis_queue.pqueue.block_pop(app_config.REDIS_WORK_QUEUE_NAME, timeout=app_config.REDIS_WORK_QUEUE_BLOCK_TIMEOUT)
+        if app_config.WORKER_CONCURRENCY == 1:
+            self._run_executor(redis_queue)
+            return
+
+        # the redis client is thread safe, so it is shared by all executor threads
+        threads = [
+            threading.Thread(target=self._run_executor_forever, args=(redis_queue,), name=f'executor-{i}', daemon=True)
+            for i in range(app_config.WORKER_CONCURRENCY)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _run_executor_forever(self, redis_queue: RedisQueue):
+        while not self.drain.is_set():
+            try:
+                self._run_executor(redis_queue)
+            except Exception:
+                logger.exception(f'Executor failed. Will retry in 60 seconds...')
+                sleep(60)
+
+    def _run_executor(self, redis_queue: RedisQueue):
+        """Take works and run them one by one. Every executor is registered as a worker."""
+        worker_id = str(uuid.uuid4())
+        consumer = WorkConsumer(redis_queue, worker_id)
+        try:
+            if app_config.WORKER_PIPELINE:
+                self._run_pipelined_loop(redis_queue, consumer, worker_id)
+            else:
+                self._run_simple_loop(redis_queue, consumer, worker_id)
+            # drained, so it is not counted as a worker any more
+            redis_queue.redis.delete(f'{app_config.REDIS_WORKER_ID_PREFIX}{worker_id}')
+        finally:
+            consumer.close()
+
+    def _run_simple_loop(self, redis_queue: RedisQueue, consumer: WorkConsumer, worker_id: str):
+        self._publish(redis_queue, worker_id, [], {})
+        while not self.drain.is_set():
+            wait_start_time = perf_counter()
+            work_item = consumer.pop(timeout=app_config.REDIS_WORK_QUEUE_BLOCK_TIMEOUT)
+            idle_time = perf_counter() - wait_start_time
             if not work_item:
+                self._publish(redis_queue, worker_id, [], collect_stats(idle_time))
                 continue
-            _, payload_json, _ = work_item
+            handle, payload_json, delivery_count = work_item
+            # only hold the node-wide slot while running, never while waiting for works
+            with sandbox_slot():
+                process_start_time = perf_counter()
+                metrics = Metrics()
+                publication = self._process_work(redis_queue, payload_json, delivery_count, metrics)
+                busy_time = perf_counter() - process_start_time
+            self._publish(
+                redis_queue, worker_id, [publication] if publication else [], collect_stats(idle_time, busy_time), metrics
+            )
+            # acknowledge after the result is published,
+            # so the work is redelivered if this worker dies before that.
+            consumer.ack(handle)
 
-            payload = None
-            result = None
-            result_queue_name = None
-            long_running = False
-            try:
-                payload = WorkPayload.model_validate_json(payload_json)
-                long_running = payload.long_running
-                result_queue_name = f'{app_config.REDIS_RESULT_PREFIX}{payload.work_id}'
-                if not long_running and (lifetime := time() - payload.timestamp) >= app_config.MAX_QUEUE_WORK_LIFE_TIME:
-                    logger.warning(f'Work {payload.work_id} lifetime ({lifetime:.2f}>{app_config.MAX_QUEUE_WORK_LIFE_TIME}) timed out. '
-                                f'Ignored. Concurrency is too hight?')
-                    continue
-                result = judge(payload.submission)
-            except ValidationError:
-                logger.exception(f'Failed to parse payload {payload_json}')
+    def _run_pipelined_loop(self, redis_queue: RedisQueue, consumer: WorkConsumer, worker_id: str):
+        """
+        The works are prefetched by one thread, and the results are published by another thread,
+        so the main thread only waits for redis when there is no work in the queue.
+        """
+        works: queue.Queue[tuple[WorkHandle, bytes, int]] = queue.Queue()
+        # free slots of prefetched works
+        prefetch_slots = threading.Semaphore(app_config.WORKER_PREFETCH_COUNT)
+        # (publication, handle, idle time, busy time, metrics), None when the worker is drained
+        results: queue.Queue[tuple[Publication | None, WorkHandle, float, float, Metrics | None] | None] = queue.Queue()
+
+        def _prefetch():
+            while not consumer.closed and not self.drain.is_set():
+                prefetch_slots.acquire()
+                count = 1
+                while count < app_config.WORKER_PREFETCH_COUNT and prefetch_slots.acquire(blocking=False):
+                    count += 1
+                work_items = []
                 try:
-                    payload_dict = json.load(payload_json)
-                    work_id = payload_dict.get('work_id')
-                    sub_id = payload_dict.get('submission', {}).get('sub_id')
-                    long_running = payload_dict.get('long_running', False)
+                    work_items = consumer.pop_many(count, timeout=app_config.REDIS_WORK_QUEUE_BLOCK_TIMEOUT)
                 except Exception:
-                    work_id = None
-                    sub_id = None
-                    long_running = False
-                if work_id and sub_id:
-                    result_queue_name = f'{app_config.REDIS_RESULT_PREFIX}{work_id}'
-                    result = SubmissionResult(
-                        sub_id=sub_id,
-                        run_success=False,
-                        success=False,
-                        cost=0,
-                        reason=ResultReason.INVALID_INPUT
-                    )
-                else:
-                    logger.error(f'Failed to parse payload {payload_json}')
-                    continue
+                    logger.exception('Failed to prefetch works. Will retry in 1 second...')
+                    sleep(1)
+                for _ in range(count - len(work_items)):
+                    prefetch_slots.release()
+                for work_item in work_items:
+                    works.put(work_item)
+
+        def _publish():
+            while not consumer.closed:
+                try:
+                    batch = [results.get(timeout=app_config.REDIS_WORK_QUEUE_BLOCK_TIMEOUT)]
+                except queue.Empty:
+                    batch = []
+                while True:
+                    try:
+                        batch.append(results.get_nowait())
+                    except queue.Empty:
+                        break
+                drained = None in batch
+                batch = [item for item in batch if item is not None]
+                stats = collect_stats(sum(item[2] for item in batch), sum(item[3] for item in batch))
+                publications = [item[0] for item in batch if item[0] is not None]
+                metrics = Metrics()
+                for item in batch:
+                    if item[4] is not None:
+                        metrics.merge(item[4])
+                while True:
+                    try:
+                        self._publish(redis_queue, worker_id, publications, stats, metrics)
+                        consumer.ack(*(item[1] for item in batch))
+                        break
+                    except Exception:
+                        logger.exception('Failed to publish results. Will retry in 1 second...')
+                        sleep(1)
+                if drained:
+                    return
+
+        self._publish(redis_queue, worker_id, [], {})
+        prefetcher = threading.Thread(target=_prefetch, name='work-prefetcher', daemon=True)
+        prefetcher.start()
+        publisher = threading.Thread(target=_publish, name='result-publisher', daemon=True)
+        publisher.start()
+        while True:
+            wait_start_time = perf_counter()
+            try:
+                handle, payload_json, delivery_count = works.get(timeout=app_config.REDIS_WORK_QUEUE_BLOCK_TIMEOUT)
+            except queue.Empty:
+                results.put((None, None, perf_counter() - wait_start_time, 0, None))
+                # draining: all the prefetched works are processed
+                if self.drain.is_set() and not prefetcher.is_alive() and works.empty():
+                    break
+                continue
+            idle_time = perf_counter() - wait_start_time
+            # start fetching the next work while this one is running
+            prefetch_slots.release()
+            with sandbox_slot():
+                process_start_time = perf_counter()
+                metrics = Metrics()
+                publication = self._process_work(redis_queue, payload_json, delivery_count, metrics)
+                busy_time = perf_counter() - process_start_time
+            results.put((publication, handle, idle_time, busy_time, metrics))
+        # wait for the results to be published and acknowledged
+        results.put(None)
+        publisher.join()
+
+    def _publish(
+        self, redis_queue: RedisQueue, worker_id: str, publications: list[Publication],
+        stats: dict[str, int], metrics: Metrics | None = None
+    ):
+        """Publish the results, register the worker and report the stats/metrics in one round trip"""
+        pp = redis_queue.redis.pipeline(transaction=False)
+        for result_queue_name, field, result_json, expire in publications:
+            if field is None:
+                pp.rpush(result_queue_name, result_json)
+            else:
+                pp.hsetnx(result_queue_name, field, result_json)
+            pp.expire(result_queue_name, expire)
+        pp.set(f'{app_config.REDIS_WORKER_ID_PREFIX}{worker_id}', 1, ex=app_config.REDIS_WORKER_REGISTER_EXPIRE)
+        for field, amount in stats.items():
+            pp.hincrby(app_config.REDIS_STATS_KEY, field, amount)
+        admission.record(pp, len(publications), stats.get('worker_busy_ms', 0), stats.get('worker_idle_ms', 0))
+        if metrics is not None:
+            metrics.add_to_pipeline(pp)
+        pp.execute()
+
+    def _process_work(
+        self, redis_queue: RedisQueue, payload_json: bytes, delivery_count: int, metrics: Metrics
+    ) -> Publication | None:
+        payload = None
+        result = None
+        result_queue_name = None
+        work_id = None
+        job_id = job_index = None
+        long_running = False
+        try:
+            payload = WorkPayload.model_validate_json(payload_json)
+            long_running = payload.long_running
+            work_id = payload.work_id
+            job_id, job_index = payload.job_id, payload.job_index
+            result_queue_name = payload.result_queue_name or f'{app_config.REDIS_RESULT_PREFIX}{work_id}'
+            if job_id is not None and jobs.is_skipped(redis_queue, payload):
+                logger.info(f'Work {payload.work_id} is skipped, as its job is cancelled or timed out.')
+                return None
+            if not long_running and (lifetime := time() - payload.timestamp) >= app_config.MAX_QUEUE_WORK_LIFE_TIME:
+                logger.warning(f'Work {payload.work_id} lifetime ({lifetime:.2f}>{app_config.MAX_QUEUE_WORK_LIFE_TIME}) timed out. '
+                            f'Ignored. Concurrency is too hight?')
+                return None
+            if delivery_count > app_config.WORK_QUEUE_MAX_DELIVERIES:
+                # the previous workers died while processing it
+                raise RuntimeError(f'Work {payload.work_id} has been delivered {delivery_count} times')
+            queue_wait = time() - payload.timestamp
+            blobs.resolve(redis_queue, payload)
+            if isinstance(payload.submission, MultiCaseSubmission):
+                metrics.observe('queue_wait_seconds', queue_wait,
+                                language=payload.submission.language, endpoint=payload.endpoint)
+                result = judge_multi_case(payload.submission, metrics, payload.endpoint, payload.verdict_only)
+            else:
+                metrics.observe('queue_wait_seconds', queue_wait,
+                                language=payload.submission.type, endpoint=payload.endpoint)
+                result = judge(payload.submission, metrics, payload.endpoint, payload.verdict_only)
+            if result.timings is not None:
+                result.timings.queue_wait = queue_wait
+        except ValidationError:
+            logger.exception(f'Failed to parse payload {payload_json}')
+            try:
+                payload_dict = json.loads(payload_json)
+                work_id = payload_dict.get('work_id')
+                sub_id = payload_dict.get('submission', {}).get('sub_id')
+                long_running = payload_dict.get('long_running', False)
+                result_queue_name = payload_dict.get('result_queue_name')
+                job_id, job_index = payload_dict.get('job_id'), payload_dict.get('job_index')
             except Exception:
-                logger.exception(f'Worker failed to process work item {payload_json}')
-                if payload is not None and result_queue_name is not None:
-                    long_running = payload.long_running
-                    result = SubmissionResult(
-                        sub_id=payload.submission.sub_id,
-                        run_success=False,
-                        success=False,
-                        cost=0,
-                        reason=ResultReason.INTERNAL_ERROR
-                    )
-                else:
-                    logger.error(f'Failed to process work item {payload_json}')
-                    continue
-
-            redis_queue.queue.push(result_queue_name, result.model_dump_json())
-            redis_queue.expire(
-                result_queue_name,
-                app_config.REDIS_RESULT_EXPIRE
-                    if not long_running
-                    else app_config.REDIS_RESULT_LONG_BATCH_EXPIRE
+                work_id = None
+                sub_id = None
+                long_running = False
+            if work_id and sub_id:
+                result_queue_name = result_queue_name or f'{app_config.REDIS_RESULT_PREFIX}{work_id}'
+                result = SubmissionResult(
+                    sub_id=sub_id,
+                    run_success=False,
+                    success=False,
+                    cost=0,
+                    reason=ResultReason.INVALID_INPUT
+                )
+            else:
+                logger.error(f'Failed to parse payload {payload_json}')
+                return None
+        except Exception:
+            logger.exception(f'Worker failed to process work item {payload_json}')
+            if payload is not None and result_queue_name is not None:
+                long_running = payload.long_running
+                result = SubmissionResult(
+                    sub_id=payload.submission.sub_id,
+                    run_success=False,
+                    success=False,
+                    cost=0,
+                    reason=ResultReason.INTERNAL_ERROR
+                )
+            else:
+                logger.error(f'Failed to process work item {payload_json}')
+                return None
+
+        work_result = WorkResult(work_id=work_id, result=result.model_dump(mode='json'))
+        if job_id is not None:
+            return (
+                jobs.results_key(job_id),
+                str(job_index),
+                work_result.model_dump_json(),
+                app_config.JOB_EXPIRE,
             )
+        return (
+            result_queue_name,
+            None,
+            work_result.model_dump_json(),
+            app_config.REDIS_RESULT_EXPIRE
+                if not long_running
+                else app_config.REDIS_RESULT_LONG_BATCH_EXPIRE
+        )
 
     def run(self):
-        while True:
+        global _execution_deadlines
+        _execution_deadlines = self.deadlines
+        if self.cpus:
+            try:
+                os.sched_setaffinity(0, self.cpus)
+            except OSError:
+                logger.exception(f'Failed to pin worker to cpus {self.cpus}')
+        while not self.drain.is_set():
             try:
                 self._run_loop()
             except Exception:
@@ -190,62 +682,174 @@ class Worker(Process):
 
 
 class WorkerManager:
+    """
+    Start the workers, and supervise them by events instead of scanning their processes:
+    - a worker is restarted as soon as it exits (its sentinel is ready), unless it is drained.
+    - an execution is killed as soon as it passes its deadline (see `ExecutionDeadlines`).
+    - the workers are scaled between `MIN_WORKERS` and `MAX_WORKERS` every `AUTOSCALE_INTERVAL` seconds (see `Autoscaler`).
+      A worker is scaled down by draining it, so the works taken by it are not lost.
+    The worker states are reported every `REPORT_INTERVAL` seconds.
+    """
+    REPORT_INTERVAL = 30
+
     def __init__(self):
-        max_workers = app_config.MAX_WORKERS
+        self.autoscaler = Autoscaler(
+            app_config.MIN_WORKERS, app_config.MAX_WORKERS, app_config.WORKER_CONCURRENCY,
+            app_config.AUTOSCALE_MAX_LOAD, app_config.AUTOSCALE_MIN_AVAILABLE_MEMORY,
+        )
+        # start with the min workers, and scale up by the queue
+        min_workers = app_config.MIN_WORKERS
+        # including the draining workers
         self.workers: list[Worker] = []
-        logger.info(f'Starting {max_workers} workers...')
-        for _ in range(max_workers):
-            worker = Worker()
-            worker.start()
-            self.workers.append(worker)
-        logger.info(f'Started {max_workers} workers')
+        self._redis_queue: RedisQueue | None = None
+        # the counts since the last report
+        self._restarted = 0
+        self._killed = 0
+        # the killed executions (process group, deadline), which are still registered by their workers
+        self._killed_executions: set[tuple[int, float]] = set()
+        self._cpu_allocator: CpuAllocator | None = None
+        if app_config.WORKER_CPUS:
+            try:
+                self._cpu_allocator = CpuAllocator(parse_cpu_list(app_config.WORKER_CPUS), app_config.CPUS_PER_WORKER)
+                logger.info(f'Pinning workers to cpu sets {self._cpu_allocator.cpu_sets}')
+            except Exception:
+                logger.exception(f'Failed to allocate cpus {app_config.WORKER_CPUS}. Workers are not pinned.')
+        logger.info(f'Starting {min_workers} workers...')
+        for _ in range(min_workers):
+            self.workers.append(self._start_worker())
+        logger.info(f'Started {min_workers} workers')
+
+    def _start_worker(self) -> Worker:
+        worker = Worker(
+            ExecutionDeadlines(app_config.WORKER_CONCURRENCY, app_config.MAX_PROCESS_TIME),
+            self._cpu_allocator.allocate() if self._cpu_allocator is not None else None,
+        )
+        worker.start()
+        return worker
+
+    def _redis(self) -> RedisQueue:
+        if self._redis_queue is None:
+            self._redis_queue = connect_queue(False)
+        return self._redis_queue
 
     def run(self):
+        next_report = next_scale = monotonic()
         while True:
             try:
-                logger.info('Checking workers...')
-                self._check_workers()
-            except Exception as e:
-                logger.exception(f'Check worker failed. Will retry in 60 seconds...')
-            sleep(30)
+                now = monotonic()
+                if now >= next_report:
+                    self._report()
+                    next_report = now + self.REPORT_INTERVAL
+                if self.autoscaler.enabled and now >= next_scale:
+                    self._scale()
+                    next_scale = now + app_config.AUTOSCALE_INTERVAL
+                # the executions started while waiting expire after MAX_PROCESS_TIME, so no need to wait longer
+                wake_time = min(
+                    [next_report, now + app_config.MAX_PROCESS_TIME]
+                    + ([next_scale] if self.autoscaler.enabled else [])
+                    + [
+                        deadline for worker in self.workers for pgid, deadline in worker.deadlines.running()
+                        if (pgid, deadline) not in self._killed_executions
+                    ]
+                )
+                exited = wait([worker.sentinel for worker in self.workers], max(wake_time - now, 0))
+                if exited:
+                    self._restart_workers(set(exited))
+                self._kill_expired_executions()
+            except Exception:
+                logger.exception('Supervising workers failed. Will retry in 1 second...')
+                sleep(1)
 
     def run_background(self):
         self._check_thread = threading.Thread(target=self.run, name='worker-checker')
         self._check_thread.daemon = True
         self._check_thread.start()
 
-    def _check_workers(self):
-        failed_workers = 0
-        busy_workers = 0
-        hanged_workers = 0
-        for i, worker in enumerate(self.workers):
-            if not worker.is_alive():
-                logger.error('Worker dead. Restarting...')
-                worker = Worker()
-                worker.start()
-                self.workers[i] = worker
-                failed_workers += 1
-            else:
-                try:
-                    worker_p = psutil.Process(worker.pid)
-                    is_busy = 0
-                    is_hanged = 0
-                    for subp in worker_p.children(recursive=True):
-                        is_busy = 1
-                        if subp.is_running() and time() - subp.create_time() > app_config.MAX_PROCESS_TIME:
-                            is_hanged = 1
-                            logger.info(f'Worker {subp.pid} is running for {time() - subp.create_time()} seconds. Terminating...')
-                            nothrow_killpg(pid=subp.pid)
-                        try:
-                            # it should have been terminated by now
-                            # let's wait to avoid zombie process
-                            subp.wait(timeout=0.1)
-                        except Exception:
-                            # will try in the next loop
-                            pass
-                    busy_workers += is_busy
-                    hanged_workers += is_hanged
-                except Exception:
-                    logger.exception(f'Failed to check worker {worker.pid}')
+    def _restart_workers(self, sentinels: set[int]):
+        workers = []
+        for worker in self.workers:
+            if worker.sentinel not in sentinels:
+                workers.append(worker)
+                continue
+            worker.join()
+            # the executions of the dead worker may still be running
+            for pgid, _ in worker.deadlines.running():
+                nothrow_killpg(pgid=pgid)
+            pid, exitcode = worker.pid, worker.exitcode
+            worker.close()
+            if worker.cpus is not None:
+                self._cpu_allocator.release(worker.cpus)
+            if worker.drain.is_set():
+                # it is not restarted, as it is scaled down anyway
+                if exitcode == 0:
+                    logger.info(f'Worker {pid} is drained')
+                else:
+                    logger.error(f'Worker {pid} exited with {exitcode} while draining')
+                continue
+            logger.error(f'Worker {pid} exited with {exitcode}. Restarting...')
+            workers.append(self._start_worker())
+            self._restarted += 1
+        self.workers = workers
 
-        logger.info(f'Total: {len(self.workers)}, free: {len(self.workers) - busy_workers} failed: {failed_workers}, busy: {busy_workers}, hanged: {hanged_workers}')
+    def _scale(self):
+        active = [worker for worker in self.workers if not worker.drain.is_set()]
+        busy = sum(len(worker.deadlines.running()) for worker in active)
+        queue_length = length_sync(self._redis())
+        if app_config.WORK_QUEUE_BACKEND == 'stream':
+            # the works taken by workers are still in the streams
+            queue_length = max(queue_length - sum(len(worker.deadlines.running()) for worker in self.workers), 0)
+        under_pressure = self.autoscaler.under_pressure(busy)
+        target = self.autoscaler.target(len(active), busy, queue_length, under_pressure)
+        if target > len(active):
+            logger.info(f'Scaling up from {len(active)} to {target} workers (queue length: {queue_length}, busy: {busy})')
+            for _ in range(target - len(active)):
+                self.workers.append(self._start_worker())
+        elif target < len(active):
+            logger.info(
+                f'Scaling down from {len(active)} to {target} workers '
+                f'(queue length: {queue_length}, busy: {busy}, under pressure: {under_pressure})'
+            )
+            # drain the idle workers first
+            active.sort(key=lambda worker: len(worker.deadlines.running()))
+            for worker in active[:len(active) - target]:
+                worker.drain.set()
+
+    def _kill_expired_executions(self):
+        now = monotonic()
+        running = set()
+        for worker in self.workers:
+            for pgid, deadline in worker.deadlines.running():
+                running.add((pgid, deadline))
+                if deadline <= now and (pgid, deadline) not in self._killed_executions:
+                    logger.info(f'Execution {pgid} of worker {worker.pid} passed its deadline. Killing...')
+                    nothrow_killpg(pgid=pgid)
+                    self._killed_executions.add((pgid, deadline))
+                    self._killed += 1
+        # forget the executions which are unregistered by their workers
+        self._killed_executions &= running
+
+    def _report(self):
+        active = [worker for worker in self.workers if not worker.drain.is_set()]
+        busy_workers = sum(1 for worker in active if worker.deadlines.running())
+        draining = len(self.workers) - len(active)
+        logger.info(
+            f'Total: {len(self.workers)}, free: {len(active) - busy_workers}, draining: {draining}, '
+            f'restarted: {self._restarted}, busy: {busy_workers}, killed executions: {self._killed}'
+        )
+        try:
+            metrics = Metrics()
+            metrics.inc('worker_restarts_total', self._restarted, host=socket.gethostname())
+            metrics.inc('killed_executions_total', self._killed, host=socket.gethostname())
+            pp = self._redis().redis.pipeline(transaction=False)
+            metrics.add_to_pipeline(pp)
+            pp.execute()
+            # reset once they are counted, so they are not counted again if reporting the states fails
+            self._restarted = self._killed = 0
+            report_worker_states(self._redis(), {
+                'total': len(self.workers),
+                'busy': busy_workers,
+                'free': len(active) - busy_workers,
+                'draining': draining,
+            })
+        except Exception:
+            logger.exception('Failed to report worker states')
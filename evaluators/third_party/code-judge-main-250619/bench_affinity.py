@@ -0,0 +1,88 @@
+"""
+Benchmark of the timing variance of the executions under load, with and without cpu pinning.
+
+Every mode runs the same cpu bound solution `--runs` times, while `--load` busy processes run in the background:
+- floating: neither the executions nor the load are pinned (the default of the workers).
+- pinned: the executions are pinned to one cpu (like WORKER_CPUS), while the load floats on all cpus.
+- isolated: the executions are pinned to one cpu, and the load is pinned to the other cpus
+  (like the cpus reserved for the workers on a dedicated host). It needs at least 2 cpus.
+
+Usage: python bench_affinity.py [--runs 30] [--load <cpu count>] [--cpu <the last cpu>]
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+
+from app.libs.executors.python_executor import PythonExecutor
+
+
+SOLUTION = """
+total = 0
+for i in range(3_000_000):
+    total += i * i % 7
+print(total)
+"""
+
+
+def _busy(cpus: list[int] | None):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    while True:
+        pass
+
+
+def bench(executor: PythonExecutor, runs: int, cpus: list[int], load_cpus: list[int] | None, load: int) -> list[float]:
+    hogs = [multiprocessing.Process(target=_busy, args=(load_cpus,), daemon=True) for _ in range(load)]
+    for hog in hogs:
+        hog.start()
+    old_cpus = os.sched_getaffinity(0)
+    # the executions inherit the affinity of this process, like the sandboxes of a worker
+    os.sched_setaffinity(0, cpus)
+    try:
+        costs = []
+        for _ in range(runs):
+            result = executor.execute_script(SOLUTION)
+            assert result.success, result.stderr
+            costs.append(result.cost)
+        return costs
+    finally:
+        os.sched_setaffinity(0, old_cpus)
+        for hog in hogs:
+            hog.kill()
+            hog.join()
+
+
+def main():
+    all_cpus = sorted(os.sched_getaffinity(0))
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=30)
+    parser.add_argument('--load', type=int, default=len(all_cpus), help='the number of busy processes')
+    parser.add_argument('--cpu', type=int, default=all_cpus[-1], help='the cpu of the pinned executions')
+    args = parser.parse_args()
+
+    other_cpus = [cpu for cpu in all_cpus if cpu != args.cpu]
+    modes = {
+        'floating': (all_cpus, None),
+        'pinned': ([args.cpu], None),
+    }
+    if other_cpus:
+        modes['isolated'] = ([args.cpu], other_cpus)
+    else:
+        print('isolated mode is skipped, as there is only 1 cpu')
+
+    executor = PythonExecutor(run_cl='python3 {source}', timeout=60)
+    print(f'cpus: {len(all_cpus)}, load: {args.load} busy processes, runs: {args.runs}')
+    for name, (cpus, load_cpus) in modes.items():
+        costs = bench(executor, args.runs, cpus, load_cpus, args.load)
+        mean = statistics.mean(costs)
+        stdev = statistics.stdev(costs) if len(costs) > 1 else 0
+        p95 = sorted(costs)[min(len(costs) - 1, int(len(costs) * 0.95))]
+        print(
+            f'{name:>10}: mean {mean:.3f}s, stdev {stdev:.3f}s, cv {stdev / mean:.1%}, '
+            f'p95 {p95:.3f}s, min {min(costs):.3f}s, max {max(costs):.3f}s'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark of the C++ compile latency with and without the precompiled header.
+
+Usage: python bench_compile.py [--runs 10] [--compile-command 'g++ -O2 -o {exe} {source}']
+"""
+import argparse
+import statistics
+import tempfile
+import time
+
+from app.libs.executors.cpp_executor import CppExecutor
+from app.libs.executors.precompiled_header import PrecompiledHeader
+
+
+SOLUTIONS = {
+    'stdc++': """#include <bits/stdc++.h>
+using namespace std;
+int main() {
+    int n; cin >> n;
+    vector<long long> a(n);
+    for (auto &x : a) cin >> x;
+    sort(a.begin(), a.end());
+    map<long long, int> cnt;
+    for (auto x : a) cnt[x]++;
+    cout << cnt.size() << endl;
+}
+""",
+    # doesn't include bits/stdc++.h, so the precompiled header is not used
+    'iostream': """#include <iostream>
+int main() { int n; std::cin >> n; std::cout << n * 2 << std::endl; }
+""",
+}
+
+
+def bench(executor: CppExecutor, solution: str, runs: int) -> list[float]:
+    costs = []
+    for i in range(runs):
+        # a different source every time, so nothing is cached except the precompiled header
+        result = executor.execute_script(f'{solution}\n// run {i} {time.time()}\n', '3\n1 2 2\n')
+        assert result.success, result.stderr
+        costs.append(result.compile_cost)
+    return costs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--compile-command', default='g++ -O2 -o {exe} {source}')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as pch_dir:
+        pch = PrecompiledHeader(pch_dir, ['bits/stdc++.h'])
+        executors = {
+            'without pch': CppExecutor(args.compile_command, '{exe}', timeout=10),
+            'with pch': CppExecutor(args.compile_command, '{exe}', timeout=10, precompiled_header=pch),
+        }
+        # build the precompiled header in advance
+        build_start = time.perf_counter()
+        executors['with pch'].execute_script(SOLUTIONS['stdc++'], '3\n1 2 2\n')
+        while pch.gch_path(args.compile_command) is None:
+            time.sleep(0.1)
+        print(f'precompiled header built in {time.perf_counter() - build_start:.2f}s')
+
+        for name, solution in SOLUTIONS.items():
+            for executor_name, executor in executors.items():
+                costs = bench(executor, solution, args.runs)
+                print(
+                    f'{name:>10} {executor_name:>12}: '
+                    f'mean {statistics.mean(costs):.3f}s, median {statistics.median(costs):.3f}s, '
+                    f'min {min(costs):.3f}s, max {max(costs):.3f}s'
+                )
+
+
+if __name__ == '__main__':
+    main()
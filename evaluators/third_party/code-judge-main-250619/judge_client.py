@@ -5,8 +5,15 @@ to demostrate how the judge server can be used.
 1. `JudgeClient`: A simple client that sends submissions to the judge server and returns the results.
 2. `BufferedJudgeClient`: A buffered version of `JudgeClient` that sends submissions in batches.
 3. `BufferedAsyncJudgeClient`: An async version of `BufferedJudgeClient` that sends submissions in batches.
+   With `stream=True`, results are received one by one as soon as they are finished.
 4. `QueuedJudgeClient`: A client that queue submissions and return results when all submissions are done.
 5. `QueuedAsyncJudgeClient`: An async version of `QueuedJudgeClient` that queue submissions and return results when all submissions are done.
+   With `stream=True`, `iter_results` returns results as soon as they are finished.
+6. `JobJudgeClient`: A client that submits submissions as async jobs, and polls their results later.
+
+When the judge server is overloaded, it rejects requests with 429 and a `Retry-After` header.
+All clients wait for at least `Retry-After` seconds (with exponential backoff) before retrying,
+and also back off before resubmitting the submissions which are timed out in the queue.
 """
 
 import threading
@@ -16,7 +23,9 @@ import math
 import time
 import asyncio
 import queue
-from typing import Any, Literal
+import random
+import json
+from typing import Any, AsyncIterator, Literal
 from dataclasses import dataclass, asdict
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import concurrent.futures as syncio
@@ -25,6 +34,45 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# retry so many times when the server rejects a request as overloaded (429)
+MAX_OVERLOAD_RETRIES = 10
+MAX_BACKOFF_DELAY = 60
+
+
+def _backoff_delay(attempt: int, retry_after: str | None = None) -> float:
+    """Exponential backoff with jitter, but never earlier than the `Retry-After` of the server"""
+    delay = min(2 ** attempt, MAX_BACKOFF_DELAY) * random.uniform(0.5, 1)
+    try:
+        return max(delay, float(retry_after)) if retry_after else delay
+    except ValueError:
+        # Retry-After in http-date format is not sent by the judge server
+        return delay
+
+
+def _post(url: str, **kwargs) -> requests.Response:
+    """POST, and retry with backoff if the server is overloaded"""
+    attempt = 0
+    while (response := requests.post(url, **kwargs)).status_code == 429 and attempt < MAX_OVERLOAD_RETRIES:
+        delay = _backoff_delay(attempt, response.headers.get('Retry-After'))
+        logger.debug(f'The server is overloaded. Retry in {delay:.1f} seconds.')
+        time.sleep(delay)
+        attempt += 1
+    response.raise_for_status()
+    return response
+
+
+async def _post_async(http: aiohttp.ClientSession, path: str, **kwargs) -> aiohttp.ClientResponse:
+    """The async version of `_post`. The caller should release the response."""
+    attempt = 0
+    while (response := await http.post(path, **kwargs)).status == 429 and attempt < MAX_OVERLOAD_RETRIES:
+        delay = _backoff_delay(attempt, response.headers.get('Retry-After'))
+        response.release()
+        logger.debug(f'The server is overloaded. Retry in {delay:.1f} seconds.')
+        await asyncio.sleep(delay)
+        attempt += 1
+    response.raise_for_status()
+    return response
+
 
 def chunkify(iterable, size):
     """Yield successive chunks from iterable."""
@@ -50,6 +98,7 @@ class SubmissionResult:
     stdout: str | None = None
     stderr: str | None = None
     reason: str = ''
+    timings: dict[str, float | None] | None = None
 
 
 @dataclass
@@ -82,12 +131,11 @@ def _judge_batch(url: str, submissions: list[Submission], timeout: int = 3600) -
         return []
 
     batch_submission = BatchSubmission(submissions=submissions, type='batch')
-    response = requests.post(
+    response = _post(
         f'{url}/run/long-batch',
         json=asdict(batch_submission),
         timeout=timeout,
     )
-    response.raise_for_status()
     result = BatchSubmissionResult.from_response(response.json())
     return result.results
 
@@ -100,15 +148,40 @@ async def _judge_batch_async(
         return []
 
     batch_submission = BatchSubmission(submissions=submissions, type='batch')
-    async with http.post(
+    async with await _post_async(
+        http,
         f'/run/long-batch',
         json=asdict(batch_submission),
     ) as response:
-        response.raise_for_status()
         result = BatchSubmissionResult.from_response(await response.json())
         return result.results
 
 
+async def _judge_batch_stream_async(
+    submissions: list[Submission],
+    http: aiohttp.ClientSession,
+) -> AsyncIterator[tuple[int, SubmissionResult]]:
+    """Yield (index, result) in the order the submissions are finished"""
+    if not submissions:
+        return
+
+    batch_submission = BatchSubmission(submissions=submissions, type='batch')
+    async with await _post_async(
+        http,
+        f'/run/long-batch/stream',
+        json=asdict(batch_submission),
+    ) as response:
+        # every line is a json record, and the last one is the summary
+        async for line in response.content:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record['type'] == 'summary':
+                return
+            yield record['index'], SubmissionResult(**record['result'])
+    raise ConnectionError('The result stream is closed before the summary.')
+
+
 class JudgeClient:
     """
     A client for the judge server.
@@ -142,8 +215,12 @@ class JudgeClient:
         n_sumissions = len(submissions)
         sub_ids = list(range(len(submissions)))
         results = {}
+        attempt = 0
 
         while submissions:
+            if attempt:
+                time.sleep(_backoff_delay(attempt - 1))
+            attempt += 1
             num_batches = max(math.ceil(len(submissions) / self.max_batch_size), self.max_workers)
             batch_size = math.ceil(len(submissions) / num_batches)
 
@@ -271,8 +348,12 @@ class BufferedJudgeClient:
         n_submissions = len(submissions)
         sub_ids = list(range(len(submissions)))
         results = {}
+        attempt = 0
 
         while submissions:
+            if attempt:
+                time.sleep(_backoff_delay(attempt - 1))
+            attempt += 1
             logger.debug(f'Judging {len(submissions)} submissions.')
             results = _judge_batch(self.url, submissions, self.timeout)
 
@@ -295,11 +376,14 @@ class BufferedJudgeClient:
 class BufferedAsyncJudgeClient:
     """
     A async client for the judge server that buffers submissions and sends them in batches.
+    If `stream` is True, the batches are sent to the streaming endpoint,
+    and every submission is resolved as soon as it is finished instead of waiting for the whole batch.
     """
-    def __init__(self, url, *, max_batch_size=1000, max_workers=4, timeout: int = 3600):
+    def __init__(self, url, *, max_batch_size=1000, max_workers=4, timeout: int = 3600, stream: bool = False):
         self.url = url
         self.max_batch_size = max_batch_size
         self.max_workers = max_workers
+        self.stream = stream
         self._running = True
         self._submission_queue = asyncio.Queue()
         self._workers = [asyncio.create_task(self._sender_worker()) for _ in range(self.max_workers)]
@@ -338,6 +422,21 @@ class BufferedAsyncJudgeClient:
         result = await asyncio.gather(*futures)
         return result
 
+    async def judge_as_completed(self, submissions: list[Submission]) -> AsyncIterator[tuple[int, SubmissionResult]]:
+        """
+        Send a list of submissions to the judge server,
+        and yield (index, result) in the order the submissions are finished.
+        """
+        futures = {}
+        for index, sub in enumerate(submissions):
+            futures[await self._enqueue(sub)] = index
+
+        pending = set(futures)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for f in done:
+                yield futures[f], f.result()
+
     async def _enqueue(self, submission: Submission) -> asyncio.Future:
         """
         Add a submission to the queue.
@@ -354,12 +453,16 @@ class BufferedAsyncJudgeClient:
                 continue
             submissions = [sub for _, sub in batch]
             try:
-                result = await self._judge(submissions)
-                for i, r in enumerate(result):
-                    batch[i][0].set_result(r)
+                if self.stream:
+                    await self._judge_stream(batch)
+                else:
+                    result = await self._judge(submissions)
+                    for i, r in enumerate(result):
+                        batch[i][0].set_result(r)
             except Exception as e:
                 for i, _ in enumerate(batch):
-                    batch[i][0].set_exception(e)
+                    if not batch[i][0].done():
+                        batch[i][0].set_exception(e)
 
     def _get_next_batch(self):
         batch_submissions = []
@@ -379,8 +482,12 @@ class BufferedAsyncJudgeClient:
         n_submissions = len(submissions)
         sub_ids = list(range(len(submissions)))
         results = {}
+        attempt = 0
 
         while submissions:
+            if attempt:
+                await asyncio.sleep(_backoff_delay(attempt - 1))
+            attempt += 1
             logger.debug(f'Judging {len(submissions)} submissions.')
             results = await _judge_batch_async(submissions, self._http)
 
@@ -400,6 +507,83 @@ class BufferedAsyncJudgeClient:
         return [results[i] for i in range(n_submissions)]
 
 
+    async def _judge_stream(self, batch: list[tuple[asyncio.Future, Submission]]) -> None:
+        attempt = 0
+        while batch:
+            if attempt:
+                await asyncio.sleep(_backoff_delay(attempt - 1))
+            attempt += 1
+            logger.debug(f'Judging {len(batch)} submissions.')
+            queue_timeouts = []
+            async for index, result in _judge_batch_stream_async([sub for _, sub in batch], self._http):
+                if result.reason == 'queue_timeout':
+                    # Retry the submission later
+                    queue_timeouts.append(batch[index])
+                else:
+                    batch[index][0].set_result(result)
+
+            logger.debug(f'Processed {len(batch) - len(queue_timeouts)} submissions, Got {len(queue_timeouts)} timeouts.')
+            batch = queue_timeouts
+
+
+class JobJudgeClient:
+    """
+    A client for the async job api of the judge server.
+    Judging is done in two steps, and no connection is kept open in between:
+
+    1. Call `submit` to submit a list of submissions as a job, which returns the job id.
+    2. Call `get_results` to wait for the results of the job.
+
+    As the job is kept in the judge server, `get_results` can be called
+    by another process (for example, after the client is restarted).
+    """
+    def __init__(self, url, *, poll_interval: float = 5, timeout: int = 60):
+        self.url = url
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def submit(self, submissions: list[Submission]) -> str:
+        batch_submission = BatchSubmission(submissions=submissions, type='batch')
+        response = _post(
+            f'{self.url}/jobs',
+            json=asdict(batch_submission),
+            timeout=self.timeout,
+        )
+        return response.json()['job_id']
+
+    def get_job(self, job_id: str, offset: int = 0) -> dict:
+        response = requests.get(
+            f'{self.url}/jobs/{job_id}',
+            params={'offset': offset},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def get_results(self, job_id: str) -> list[SubmissionResult]:
+        """
+        Wait for the job to finish, and return the results in the order of the submissions.
+        """
+        while (job := self.get_job(job_id))['status'] == 'running':
+            logger.debug(f'Job {job_id}: {job["finished"]}/{job["total"]} finished.')
+            time.sleep(self.poll_interval)
+
+        results = []
+        while True:
+            results.extend(SubmissionResult(**r['result']) for r in job['results'])
+            if job['next_offset'] is None:
+                break
+            job = self.get_job(job_id, job['next_offset'])
+        return results
+
+    def cancel(self, job_id: str) -> None:
+        response = requests.delete(
+            f'{self.url}/jobs/{job_id}',
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+
+
 class QueuedJudgeClient:
     """
     A client for the judge server that buffers submissions and sends them in batches.
@@ -464,13 +648,16 @@ class QueuedAsyncJudgeClient:
     2. Call `get_result` to get the results of all submitted submissions.
 
     The results are returned in the order of the submissions.
+    Alternatively, call `iter_results` to get the results in the order they are finished
+    (use `stream=True` to receive every result as soon as it is finished).
     """
-    def __init__(self, url, *, max_batch_size=1000, max_workers=4, timeout: int = 3600):
+    def __init__(self, url, *, max_batch_size=1000, max_workers=4, timeout: int = 3600, stream: bool = False):
         self._client = BufferedAsyncJudgeClient(
             url,
             max_batch_size=max_batch_size,
             max_workers=max_workers,
-            timeout=timeout
+            timeout=timeout,
+            stream=stream,
         )
         self._submission = []
         self._futures = []
@@ -506,3 +693,16 @@ class QueuedAsyncJudgeClient:
         self._submission.clear()
         self._futures.clear()
         return results
+
+    async def iter_results(self) -> AsyncIterator[tuple[Submission, SubmissionResult]]:
+        """
+        Get the results of the submissions in the order they are finished.
+        """
+        futures = dict(zip(self._futures, self._submission))
+        self._submission.clear()
+        self._futures.clear()
+        pending = set(futures)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for f in done:
+                yield futures[f], f.result()
@@ -0,0 +1,45 @@
+import os
+
+from app.libs.autoscaler import Autoscaler
+
+
+def test_autoscaler_target():
+    autoscaler = Autoscaler(2, 8, concurrency=2)
+    assert autoscaler.enabled
+    # scaled up at once to run all the works
+    assert autoscaler.target(2, busy=4, queue_length=6) == 5
+    assert autoscaler.target(2, busy=4, queue_length=100) == 8
+    # enough workers
+    assert autoscaler.target(5, busy=4, queue_length=6) == 5
+    # scaled down one by one
+    assert autoscaler.target(5, busy=1, queue_length=0) == 4
+    assert autoscaler.target(2, busy=0, queue_length=0) == 2
+    # under pressure, scaled down one by one regardless of the queue
+    assert autoscaler.target(5, busy=10, queue_length=100, under_pressure=True) == 4
+    assert autoscaler.target(2, busy=10, queue_length=100, under_pressure=True) == 2
+    # out of range
+    assert autoscaler.target(10, busy=20, queue_length=0) == 8
+
+
+def test_autoscaler_disabled():
+    autoscaler = Autoscaler(4, 4)
+    assert not autoscaler.enabled
+    assert autoscaler.target(4, busy=0, queue_length=0) == 4
+
+
+def test_autoscaler_under_pressure():
+    assert Autoscaler(1, 2, max_load=1e9, min_available_memory=0).under_pressure() is False
+    assert Autoscaler(1, 2, max_load=1e9, min_available_memory=1.1).under_pressure() is True
+
+
+def test_autoscaler_own_load(monkeypatch):
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+    autoscaler = Autoscaler(1, 8, max_load=1.0, min_available_memory=0)
+    # a full pool with a backlog on an otherwise idle host, the load is the running works of the workers
+    monkeypatch.setattr(os, 'getloadavg', lambda: (12.0, 12.0, 12.0))
+    under_pressure = autoscaler.under_pressure(busy=8)
+    assert under_pressure is False
+    assert autoscaler.target(8, busy=8, queue_length=100, under_pressure=under_pressure) == 8
+    # the load of other jobs on the host
+    monkeypatch.setattr(os, 'getloadavg', lambda: (20.0, 20.0, 20.0))
+    assert autoscaler.under_pressure(busy=8) is True
@@ -0,0 +1,48 @@
+import os
+
+from app.libs.cpu_affinity import CpuAllocator, numa_nodes, parse_cpu_list
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def _fake_sysfs(root):
+    """2 numa nodes with 2 cores each, and 2 threads per core (cpu N and N + 4 are siblings)"""
+    _write(os.path.join(root, 'node', 'node0', 'cpulist'), '0-1,4-5\n')
+    _write(os.path.join(root, 'node', 'node1', 'cpulist'), '2-3,6-7\n')
+    for cpu in range(8):
+        core = cpu % 4
+        _write(os.path.join(root, 'cpu', f'cpu{cpu}', 'topology', 'thread_siblings_list'), f'{core},{core + 4}\n')
+    return str(root)
+
+
+def test_parse_cpu_list():
+    assert parse_cpu_list('0-3,8,10-11') == [0, 1, 2, 3, 8, 10, 11]
+    assert parse_cpu_list('5') == [5]
+    assert parse_cpu_list('') == []
+
+
+def test_numa_nodes(tmp_path):
+    sysfs = _fake_sysfs(tmp_path)
+    assert numa_nodes(list(range(8)), sysfs) == [[0, 4, 1, 5], [2, 6, 3, 7]]
+    # the cpus not in the list are ignored
+    assert numa_nodes([1, 2, 3, 5], sysfs) == [[1, 5], [2, 3]]
+    # no topology
+    assert numa_nodes([0, 1, 2], str(tmp_path / 'missing')) == [[0, 1, 2]]
+
+
+def test_cpu_allocator(tmp_path):
+    sysfs = _fake_sysfs(tmp_path)
+    # whole physical cores, never across numa nodes
+    allocator = CpuAllocator(list(range(8)), 2, sysfs)
+    assert allocator.cpu_sets == [[0, 4], [1, 5], [2, 6], [3, 7]]
+    # the left cpu of node1 is not used
+    assert CpuAllocator([0, 1, 4, 5, 2, 6, 3], 2, sysfs).cpu_sets == [[0, 4], [1, 5], [2, 6]]
+
+    allocator = CpuAllocator([0, 1], 1, sysfs)
+    assert [allocator.allocate() for _ in range(3)] == [[0], [1], [0]]
+    allocator.release([1])
+    assert allocator.allocate() == [1]
@@ -0,0 +1,55 @@
+import multiprocessing
+import threading
+import time
+
+from app.libs.execution_deadlines import ExecutionDeadlines
+from app.libs.executors.python_executor import PythonExecutor
+
+
+def _watch(deadlines, started, stop):
+    with deadlines.watch(12345):
+        started.set()
+        stop.wait(timeout=10)
+
+
+def test_execution_deadlines():
+    deadlines = ExecutionDeadlines(2, 10)
+    assert deadlines.running() == []
+    with deadlines.watch(100):
+        with deadlines.watch(200):
+            # no free slot, so it is not watched
+            with deadlines.watch(300):
+                running = deadlines.running()
+                assert sorted(pgid for pgid, _ in running) == [100, 200]
+                assert all(time.monotonic() < deadline <= time.monotonic() + 10 for _, deadline in running)
+        assert [pgid for pgid, _ in deadlines.running()] == [100]
+    assert deadlines.running() == []
+
+
+def test_execution_deadlines_shared_with_parent():
+    deadlines = ExecutionDeadlines(1, 10)
+    started = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    p = multiprocessing.Process(target=_watch, args=(deadlines, started, stop))
+    p.start()
+    assert started.wait(timeout=10)
+    assert [pgid for pgid, _ in deadlines.running()] == [12345]
+    stop.set()
+    p.join()
+    assert deadlines.running() == []
+
+
+def test_executor_watched():
+    deadlines = ExecutionDeadlines(1, 10)
+    executor = PythonExecutor(run_cl='python3 {source}', timeout=5, deadlines=deadlines)
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(executor.execute_script('import os, time\ntime.sleep(1)\nprint(os.getpgid(0))'))
+    )
+    thread.start()
+    time.sleep(0.5)
+    running = deadlines.running()
+    thread.join()
+    assert results[0].success
+    assert [pgid for pgid, _ in running] == [int(results[0].stdout)]
+    assert deadlines.running() == []
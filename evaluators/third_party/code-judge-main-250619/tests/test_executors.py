@@ -0,0 +1,242 @@
+import glob
+import os
+import time
+
+import pytest
+
+from app.libs.executors.cgroup import CgroupBackend
+from app.libs.executors.compile_cache import CompileCache
+from app.libs.executors.cpp_executor import CppExecutor
+from app.libs.executors.executor import COMPILE_ERROR_EXIT_CODE, TIMEOUT_EXIT_CODE, OutputLimit
+from app.libs.executors.precompiled_header import PrecompiledHeader
+from app.libs.executors.python_executor import PythonExecutor
+from app.libs.executors.python_zygote import PythonZygote
+from app.libs.executors.output_comparator import OutputComparator
+from app.libs.executors.workdir_pool import WorkdirPool
+
+
+@pytest.fixture(scope='module')
+def zygote():
+    zygote = PythonZygote('python3', ['math', 'collections'])
+    yield zygote
+    zygote.close()
+
+
+@pytest.fixture
+def python_executor(zygote):
+    return PythonExecutor(run_cl='python3 {source}', timeout=2, memory_limit=256 * 1024 * 1024, zygote=zygote)
+
+
+def test_python_zygote(python_executor):
+    result = python_executor.execute_script('print(input() * 2)', 'ab')
+    assert result.success
+    assert result.stdout == 'abab\n'
+
+
+def test_python_zygote_exit_code(python_executor):
+    result = python_executor.execute_script('import sys\nprint("x", file=sys.stderr)\nsys.exit(3)')
+    assert result.exit_code == 3
+    assert result.stderr == 'x\n'
+
+
+@pytest.mark.parametrize("solution, error", [
+    ("def f(:\n    pass", "SyntaxError"),
+    ("raise ValueError('boom')", "ValueError: boom"),
+])
+def test_python_zygote_error(python_executor, solution, error):
+    result = python_executor.execute_script(solution)
+    assert result.exit_code == 1
+    assert error in result.stderr
+    # the same as running with a new interpreter
+    expected = PythonExecutor(run_cl='python3 {source}', timeout=2).execute_script(solution)
+    assert result.stderr.replace(' ', '').splitlines()[-1] == expected.stderr.replace(' ', '').splitlines()[-1]
+
+
+def test_python_zygote_timeout(python_executor):
+    result = python_executor.execute_script('from time import sleep\nsleep(10)')
+    assert not result.success
+    assert result.stdout.strip() == 'Suicide from timeout.'
+
+
+def test_python_zygote_closed_outputs(python_executor):
+    # the script cancels its own alarm and keeps running after closing its stdout/stderr
+    start = time.perf_counter()
+    result = python_executor.execute_script('import os, signal, time\nsignal.alarm(0)\nos.close(1)\nos.close(2)\ntime.sleep(30)', timeout=1)
+    assert result.exit_code == TIMEOUT_EXIT_CODE
+    assert time.perf_counter() - start < 5
+    assert python_executor.execute_script('print(1)').stdout == '1\n'
+
+
+def test_python_zygote_bytecode_cache(python_executor):
+    code = 'import os\nprint(input(), len(os.listdir("__pycache__")))'
+    results = list(python_executor.execute_script_cases(code, ['a', 'b']))
+    assert [r.stdout for r in results] == ['a 1\n', 'b 1\n']
+
+
+def test_python_zygote_random(python_executor):
+    code = 'import random\nprint(random.random())'
+    assert python_executor.execute_script(code).stdout != python_executor.execute_script(code).stdout
+
+
+@pytest.mark.parametrize("mode, expected, chunks, matched", [
+    ('exact', '1 2\n3', [b'\n 1 2', b'\n3 \n\n'], True),
+    ('exact', '1 2\n3', [b'1  2\n3'], False),
+    ('exact', 'ab', [b'a', b'bc'], False),
+    ('exact', '', [b' \n'], True),
+    ('tokens', '1 2\n3', [b'1  2', b'\n', b'3'], True),
+    ('tokens', 'abc def', [b'ab', b'c de', b'f\n'], True),
+    ('tokens', 'abc', [b'abc abc'], False),
+    ('float', '0.5 3', [b'0.5000001 3.0'], True),
+    ('float', '0.5 x', [b'0.51 x'], False),
+    ('float', '1e9', [b'1000000000.1'], True),
+    ('exact', '你好', ['你好'.encode()[:2], '你好'.encode()[2:]], True),
+])
+def test_output_comparator(mode, expected, chunks, matched):
+    comparator = OutputComparator(expected, mode)
+    assert (all(comparator.feed(chunk) for chunk in chunks) and comparator.finish()) == matched
+
+
+def test_output_comparator_early_kill(python_executor):
+    # the process is killed as soon as the output diverges, instead of timing out
+    code = 'import time\nprint("wrong", flush=True)\ntime.sleep(10)'
+    result = python_executor.execute_script(code, comparator=OutputComparator('right'), capture_stdout=False)
+    assert result.killed_on_mismatch
+    assert result.output_matched is False
+    assert result.cost < 1
+    assert result.stdout == ''
+
+    # too long output
+    code = 'while True: print("right")'
+    result = python_executor.execute_script(code, comparator=OutputComparator('right'))
+    assert result.killed_on_mismatch
+
+    for executor in (python_executor, PythonExecutor(run_cl='python3 {source}', timeout=2)):
+        result = executor.execute_script('print(input())', '1.0 2', comparator=OutputComparator('1 2.0', 'float'))
+        assert result.output_matched
+        assert result.success
+
+
+def test_output_limit(zygote):
+    output_limit = OutputLimit(max_size=1024 * 1024, capture_size=10)
+    for executor in (
+        PythonExecutor(run_cl='python3 {source}', timeout=5, zygote=zygote, output_limit=output_limit),
+        PythonExecutor(run_cl='python3 {source}', timeout=5, output_limit=output_limit),
+    ):
+        result = executor.execute_script('while True: print("0123456789")')
+        assert result.output_limit_exceeded
+        assert result.cost < 4
+        head, omitted, tail = result.stdout.split('\n', 2)
+        assert head == '0123456789' and omitted.endswith('bytes omitted)...') and len(tail) == 10
+
+        # the head and the tail are kept
+        result = executor.execute_script('print("a" * 20)')
+        assert result.success
+        assert not result.output_limit_exceeded
+        assert result.stdout == 'aaaaaaaaaa\n...(1 bytes omitted)...\naaaaaaaaa\n'
+
+
+def test_large_stdin(python_executor):
+    # the input is passed as a file, so the process can read it at any time, or not at all
+    stdin = 'ab\n' * (8 * 1024 * 1024)
+    code = 'import sys\nprint(len(sys.stdin.read()))'
+    for executor in (python_executor, PythonExecutor(run_cl='python3 {source}', timeout=2)):
+        assert executor.execute_script(code, stdin).stdout == f'{len(stdin)}\n'
+        assert executor.execute_script('print(input())', stdin).stdout == 'ab\n'
+
+
+def test_workdir_pool(tmp_path):
+    pool = WorkdirPool(str(tmp_path), max_idle=1, quota=1024 * 1024)
+    executor = PythonExecutor(run_cl='python3 {source}', timeout=2, workdir_pool=pool)
+    code = 'import os\nprint(os.getcwd(), sorted(os.listdir()))\nopen("out.txt", "w").write("x")'
+    cwd, files = executor.execute_script(code).stdout.split(' ', 1)
+    assert files.strip() == "['source.py']"
+    # the workdir is scrubbed and reused
+    assert executor.execute_script(code).stdout == f"{cwd} ['source.py']\n"
+
+    # a file can't be larger than the quota
+    result = executor.execute_script('open("big", "wb").write(b"0" * 2 * 1024 * 1024)')
+    assert not result.success and 'File too large' in result.stderr
+    # a workdir over the quota is not reused
+    assert executor.execute_script('for i in range(2):\n    open(f"f{i}", "wb").write(b"0" * 768 * 1024)').success
+    assert not os.path.exists(cwd)
+    assert executor.execute_script(code).stdout.split(' ')[0] != cwd
+
+    cpp_executor = CppExecutor(compiler_cl='g++ -O2 -o {exe} {source}', run_cl='{exe}', timeout=10, workdir_pool=pool)
+    code = '#include <cstdio>\nint main() { FILE *f = fopen("big", "wb"); static char b[2 << 20]; printf("%zu", fwrite(b, 1, sizeof(b), f)); }'
+    assert int(cpp_executor.execute_script(code).stdout) < 2 * 1024 * 1024
+
+    # no room for a workdir of every sandbox
+    crowded_pool = WorkdirPool(str(tmp_path), max_idle=1, quota=1024 * 1024, concurrency=2 ** 40)
+    assert crowded_pool._has_room() is False
+    crowded_pool.close()
+
+    pool.close()
+    assert not os.listdir(tmp_path)
+
+
+def test_compile_cache(tmp_path):
+    cache = CompileCache(str(tmp_path / 'cache'), 1024 * 1024 * 1024)
+    executor = CppExecutor(compiler_cl='g++ -O2 -o {exe} {source}', run_cl='{exe}', timeout=10, compile_cache=cache)
+    # the submission can't change the cached executable through its own copy
+    code = '#include <cstdio>\n#include <sys/stat.h>\nint main(int, char **argv) { printf("%d", chmod(argv[0], 0700) == 0); }'
+    assert executor.execute_script(code).stdout == '1'
+    result = executor.execute_script(code)
+    assert result.stdout == '1'
+    assert cache.pop_stats() == {'compile_cache_hit': 1, 'compile_cache_miss': 1}
+    exe_entries = glob.glob(str(tmp_path / 'cache' / f'*{CompileCache.EXE_SUFFIX}'))
+    assert len(exe_entries) == 1 and os.stat(exe_entries[0]).st_mode & 0o777 == 0o555
+
+    # a compile error is cached
+    assert executor.execute_script('int main() { return x; }').exit_code == COMPILE_ERROR_EXIT_CODE
+    assert len(glob.glob(str(tmp_path / 'cache' / f'*{CompileCache.ERROR_SUFFIX}'))) == 1
+
+    # a compile killed by a signal is not cached
+    killed = CppExecutor(compiler_cl='sh -c "kill -9 $$" {source} {exe}', run_cl='{exe}', timeout=10, compile_cache=cache)
+    assert killed.execute_script('int main() {}').exit_code == COMPILE_ERROR_EXIT_CODE
+    assert len(glob.glob(str(tmp_path / 'cache' / f'*{CompileCache.ERROR_SUFFIX}'))) == 1
+
+
+def test_precompiled_header(tmp_path):
+    pch = PrecompiledHeader(str(tmp_path / 'pch'), ['bits/stdc++.h'])
+    assert pch.applies('// header\n#include <cstdio>\n#include <bits/stdc++.h>\nint main() {}')
+    # the source may change the headers, or it doesn't include them
+    assert not pch.applies('#define _GLIBCXX_DEBUG\n#include <bits/stdc++.h>\nint main() {}')
+    assert not pch.applies('#include <iostream>\nint y1;\nint main() {}')
+
+    executor = CppExecutor(compiler_cl='g++ -O2 -o {exe} {source}', run_cl='{exe}', timeout=10, precompiled_header=pch)
+    code = '#include <bits/stdc++.h>\nint main() { std::vector<int> v{1, 2}; std::cout << v.size(); }'
+    # compiled without it, while it's built in the background
+    assert executor.execute_script(code).stdout == '2'
+    for _ in range(300):
+        if glob.glob(str(tmp_path / 'pch' / '*' / f'{PrecompiledHeader.NAME}.gch')):
+            break
+        time.sleep(0.1)
+    result = executor.execute_script(code)
+    assert result.stdout == '2'
+    assert executor.execute_script('#include <bits/stdc++.h>\nint main() { return x; }').exit_code == COMPILE_ERROR_EXIT_CODE
+
+
+def test_cgroup_fallback(tmp_path):
+    # not a delegated cgroup v2, so rlimits are used instead
+    with pytest.raises(OSError):
+        CgroupBackend(str(tmp_path))
+
+
+@pytest.mark.skipif(not os.environ.get('TEST_CGROUP_ROOT'), reason='TEST_CGROUP_ROOT (a delegated cgroup v2) is not set')
+def test_cgroup():
+    cgroups = CgroupBackend(os.environ['TEST_CGROUP_ROOT'], pids_max=16)
+    executor = PythonExecutor(run_cl='python3 {source}', timeout=2, memory_limit=64 * 1024 * 1024, cgroups=cgroups)
+    # a large virtual memory reservation is allowed, as only the real memory is limited
+    result = executor.execute_script('import mmap\nm = mmap.mmap(-1, 4 << 30)\nprint(len(m))')
+    assert result.success
+    assert result.peak_memory < 192 * 1024 * 1024
+    assert result.cpu_time < result.run_cost
+
+    result = executor.execute_script('x = bytearray(256 * 1024 * 1024)')
+    assert not result.success
+
+    # the grandchildren leaving the process group are killed, too
+    code = 'import os, time\nif os.fork() == 0:\n    os.setsid()\n    time.sleep(100)\nprint(os.getpid())'
+    result = executor.execute_script(code)
+    assert result.success
+    assert not [d for d in os.listdir(os.environ['TEST_CGROUP_ROOT']) if d.startswith('code-judge-')]
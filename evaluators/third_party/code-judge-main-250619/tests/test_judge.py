@@ -0,0 +1,86 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+import app.config as app_config
+from app.judge import _iter_run_batch
+from app.libs.redis_queue import RedisQueue
+from app.model import ResultReason, Submission, SubmissionResult, WorkPayload, WorkPriority, WorkResult
+import app.work_queue as work_queue
+
+
+def _async_queue() -> RedisQueue:
+    redis_queue = RedisQueue('redis://localhost:6388/7', socket_timeout=10, is_async=True)
+    redis_queue.redis = fakeredis.FakeAsyncRedis()
+    return redis_queue
+
+
+async def _fake_worker(redis_queue: RedisQueue, answer_count: int, result_json=None):
+    """Take `answer_count` works from the batch lane, and push their results in the reversed order"""
+    works = []
+    while len(works) < answer_count:
+        popped = await redis_queue.pqueue.pop(work_queue.queue_name(WorkPriority.BATCH), answer_count - len(works))
+        works.extend(WorkPayload.model_validate_json(payload) for payload, _ in popped)
+        await asyncio.sleep(0.05)
+    result_jsons = []
+    for payload in reversed(works):
+        result = SubmissionResult(
+            sub_id=payload.submission.sub_id, run_success=True, success=True, cost=0, stdout=payload.submission.input,
+        )
+        result_jsons.append(
+            result_json or WorkResult(work_id=payload.work_id, result=result.model_dump(mode='json')).model_dump_json()
+        )
+    # all at once, so they are in the queue before the batch fails
+    await redis_queue.redis.rpush(works[0].result_queue_name, *result_jsons)
+    return works[0].result_queue_name
+
+
+def _subs(count: int) -> list[Submission]:
+    return [Submission(sub_id=str(i), type='python', solution='print(input())', input=str(i)) for i in range(count)]
+
+
+async def _run(redis_queue: RedisQueue, subs: list[Submission], answer_count: int, result_json=None):
+    worker = asyncio.create_task(_fake_worker(redis_queue, answer_count, result_json))
+    results = []
+    try:
+        async for index, result in _iter_run_batch(redis_queue, subs):
+            results.append((index, result))
+    finally:
+        result_queue_name = await worker
+    return results, result_queue_name
+
+
+@pytest.fixture
+def batch_config(monkeypatch):
+    monkeypatch.setattr(app_config, 'BATCH_PACING', 0)
+    monkeypatch.setattr(app_config, 'MAX_BATCH_CHUNK_SIZE', 2)
+    monkeypatch.setattr(app_config, 'WORK_QUEUE_BACKEND', 'zset')
+
+
+def test_batch_results_out_of_order(batch_config):
+    redis_queue = _async_queue()
+    results, result_queue_name = asyncio.run(_run(redis_queue, _subs(5), 5))
+    # the results are yielded in the order they are finished, and matched to their submissions
+    assert [index for index, _ in results] == [4, 3, 2, 1, 0]
+    assert all(result.sub_id == str(index) and result.stdout == str(index) for index, result in results)
+    assert not asyncio.run(redis_queue.redis.exists(result_queue_name))
+
+
+def test_batch_results_timeout(batch_config, monkeypatch):
+    monkeypatch.setattr(app_config, 'MAX_QUEUE_WAIT_TIME', 2)
+    redis_queue = _async_queue()
+    # only 3 of 5 works are answered
+    results, result_queue_name = asyncio.run(_run(redis_queue, _subs(5), 3))
+    assert sorted(index for index, _ in results) == [0, 1, 2, 3, 4]
+    reasons = {index: result.reason for index, result in results}
+    assert [reasons[i] for i in range(5)] == [ResultReason.UNSPECIFIED] * 3 + [ResultReason.QUEUE_TIMEOUT] * 2
+    assert not asyncio.run(redis_queue.redis.exists(result_queue_name))
+
+
+def test_batch_results_failure(batch_config):
+    redis_queue = _async_queue()
+    with pytest.raises(ValueError):
+        asyncio.run(_run(redis_queue, _subs(3), 3, result_json='not a result'))
+    # the result queue is removed, even if the batch fails
+    assert asyncio.run(redis_queue.redis.keys(f'{app_config.REDIS_RESULT_PREFIX}*')) == []
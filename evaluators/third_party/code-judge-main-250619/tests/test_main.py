@@ -1,3 +1,7 @@
+import json
+import uuid
+from time import sleep
+
 import pytest
 
 
@@ -7,10 +11,35 @@ def test_status(test_client):
     """
     response = test_client.get('/status')
     assert response.status_code == 200
-    assert response.json() == {
-        'queue': 0,
-        'num_workers': 4
+    assert response.json()['queue'] == 0
+    # every executor thread is registered as a worker
+    import app.config as app_config
+    assert response.json()['num_workers'] == 4 * app_config.WORKER_CONCURRENCY
+    assert set(response.json()['compile_cache']) == {'hit', 'miss'}
+    assert set(response.json()['verdict_cache']) == {'hit', 'miss', 'hit_rate'}
+    assert set(response.json()['worker_time']) == {'idle', 'busy', 'utilization'}
+
+
+def test_metrics(test_client):
+    data = {
+        "type": "cpp",
+        "solution": f"#include <cstdio>\nint main(){{printf(\"{uuid.uuid4()}\");return 0;}}",
+        "expected_output": "wrong answer"
     }
+    response = test_client.post('/judge', json=data)
+    assert response.status_code == 200
+    assert response.json()['success'] is False
+
+    response = test_client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    text = response.text
+    assert 'code_judge_results_total{endpoint="/judge",language="cpp",reason="none",success="false"}' in text
+    for name in ['queue_wait_seconds', 'compile_seconds', 'execution_seconds', 'request_seconds']:
+        assert f'code_judge_{name}_bucket{{endpoint="/judge",language="cpp",le="+Inf"}}' in text
+        assert f'code_judge_{name}_count{{endpoint="/judge",language="cpp"}}' in text
+    assert 'code_judge_queue_length{priority="interactive"} ' in text
+    assert 'state="busy"' in text
 
 
 @pytest.mark.parametrize("type", ["judge", "run"])
@@ -83,6 +112,34 @@ int main(){printf("a")xx;return 0;}
     assert not response.json()['success']
 
 
+@pytest.mark.parametrize("compile_error", [False, True])
+def test_cpp_compile_cache(test_client, compile_error):
+    data = {
+        "type": "cpp",
+        "solution": f"""// {uuid.uuid4()}
+#include <cstdio>
+int main(){{printf("a"){'xx' if compile_error else ''};return 0;}}
+""",
+        "expected_output": "a"
+    }
+    before = test_client.get('/status').json()['compile_cache']
+    # different inputs to bypass the verdict cache
+    results = [test_client.post('/run', json={**data, "input": str(i)}).json() for i in range(2)]
+    print(results)
+    assert results[0]['success'] != compile_error
+    assert results[1]['success'] != compile_error
+    assert results[0]['stderr'] == results[1]['stderr']
+
+    # stats are reported after the result is sent
+    for _ in range(10):
+        after = test_client.get('/status').json()['compile_cache']
+        if after['hit'] > before['hit']:
+            break
+        sleep(0.1)
+    assert after['miss'] - before['miss'] == 1
+    assert after['hit'] - before['hit'] == 1
+
+
 @pytest.mark.parametrize("type", ["judge", "run"])
 def test_python(test_client, type):
     data = {
@@ -324,3 +381,397 @@ with open('../test.txt', 'w') as f:
     assert response.status_code == 200
 
     print(f"Jailbreak Status (Is sandbox enabled): {not Path('/tmp/test.txt').exists()}")
+
+
+@pytest.mark.parametrize("type", ["judge", "run"])
+@pytest.mark.parametrize("language", ["python", "cpp"])
+@pytest.mark.parametrize("stop_on_failure", [False, True])
+def test_multi_case(test_client, type, language, stop_on_failure):
+    solution = {
+        "python": "print(input())",
+        "cpp": """#include <iostream>
+#include <string>
+int main(){std::string s;std::cin>>s;std::cout<<s;return 0;}
+""",
+    }[language]
+    data = {
+        "type": "multi_case",
+        "language": language,
+        "solution": solution,
+        "cases": [
+            {"input": "a", "expected_output": "a"},
+            {"input": "b", "expected_output": "c"},
+            {"input": "c", "expected_output": "c"},
+        ],
+        "stop_on_failure": stop_on_failure,
+    }
+    response = test_client.post(f'/{type}/multi-case', json=data)
+    print(response.json())
+    assert response.status_code == 200
+    result = response.json()
+    assert not result['success']
+    results = result['results']
+    assert len(results) == 3
+    assert results[0]['success']
+    assert not results[1]['success']
+    assert results[1]['run_success']
+    if stop_on_failure:
+        assert results[2]['reason'] == 'skipped'
+        assert not result['run_success']
+    else:
+        assert results[2]['success']
+        assert result['run_success']
+
+
+def test_multi_case_compile_error(test_client):
+    data = {
+        "type": "multi_case",
+        "language": "cpp",
+        "solution": "int main(){return 0}",
+        "cases": [{"expected_output": ""}, {"expected_output": ""}],
+    }
+    response = test_client.post('/run/multi-case', json=data)
+    print(response.json())
+    assert response.status_code == 200
+    results = response.json()['results']
+    assert len(results) == 2
+    assert all(not r['run_success'] and r['stderr'] for r in results)
+
+
+@pytest.fixture
+def verdict_cache_enabled(monkeypatch):
+    import app.config as app_config
+    monkeypatch.setattr(app_config, 'VERDICT_CACHE_EXPIRE', 3600)
+
+
+def test_verdict_cache_disabled(test_client):
+    data = {
+        "type": "python",
+        "solution": f"# {uuid.uuid4()}\nprint(input())",
+        "input": "a",
+        "expected_output": "a"
+    }
+    first = test_client.post('/run', json=data).json()
+    second = test_client.post('/run', json=data).json()
+    assert first['success'] and second['success']
+    assert first['exit_code'] == 0
+    # both are run
+    assert first['timings'] is not None and second['timings'] is not None
+
+
+def test_verdict_cache_killed(test_client, verdict_cache_enabled):
+    data = {
+        "type": "python",
+        "solution": f"# {uuid.uuid4()}\nimport os, signal\nos.kill(os.getpid(), signal.SIGKILL)",
+    }
+    first = test_client.post('/run', json=data).json()
+    second = test_client.post('/run', json=data).json()
+    assert first['exit_code'] == -9
+    # the killed run is not cached
+    assert second['timings'] is not None
+
+
+def test_verdict_cache(test_client, verdict_cache_enabled):
+    data = {
+        "type": "python",
+        "solution": f"# {uuid.uuid4()}\nprint(input())",
+        "input": "a",
+        "expected_output": "a"
+    }
+    before = test_client.get('/status').json()['verdict_cache']
+    first = test_client.post('/run', json=data).json()
+    second = test_client.post('/run', json={**data, "sub_id": "second"}).json()
+    print(first, second)
+    assert first['success'] and second['success']
+    assert second['sub_id'] == 'second'
+    assert second['cost'] == first['cost']
+    assert first['timings'] is not None
+    # nothing is run for the cached result
+    assert second['timings'] is None
+    after = test_client.get('/status').json()['verdict_cache']
+    assert after['hit'] - before['hit'] == 1
+    assert after['miss'] - before['miss'] == 1
+
+
+@pytest.mark.parametrize("batch_type", ["batch", "long-batch"])
+def test_batch_duplicates(test_client, batch_type, verdict_cache_enabled):
+    sub = {
+        "type": "python",
+        "solution": f"# {uuid.uuid4()}\nprint(input())",
+        "input": "a",
+        "expected_output": "a"
+    }
+    data = {
+        'type': 'batch',
+        'submissions': [{**sub, "sub_id": str(i)} for i in range(4)] + [{**sub, "input": "b", "sub_id": "4"}]
+    }
+    before = test_client.get('/status').json()['verdict_cache']
+    response = test_client.post(f'/run/{batch_type}', json=data)
+    print(response.json())
+    results = response.json()['results']
+    assert [r['sub_id'] for r in results] == ['0', '1', '2', '3', '4']
+    assert all(r['success'] for r in results[:4])
+    assert not results[4]['success']
+    after = test_client.get('/status').json()['verdict_cache']
+    assert after['hit'] - before['hit'] == 3
+    assert after['miss'] - before['miss'] == 2
+
+
+def test_timings(test_client):
+    data = {
+        'type': 'batch',
+        'submissions': [
+            {"type": "cpp", "solution": f"#include <cstdio>\nint main(){{printf(\"{uuid.uuid4()}\");return 0;}}"},
+            {"type": "python", "solution": f"# {uuid.uuid4()}\nprint(1)"},
+        ]
+    }
+    response = test_client.post('/run/batch', json=data)
+    print(response.json())
+    cpp_timings, python_timings = [r['timings'] for r in response.json()['results']]
+    for timings in [cpp_timings, python_timings]:
+        for phase in ['queue_wait', 'setup', 'run', 'publish', 'collect']:
+            assert timings[phase] >= 0
+    assert cpp_timings['compile'] > 0
+    assert python_timings['compile'] is None
+
+    data = {
+        "type": "multi_case",
+        "language": "cpp",
+        "solution": f"#include <cstdio>\nint main(){{printf(\"{uuid.uuid4()}\");return 0;}}",
+        "cases": [{}, {}],
+    }
+    response = test_client.post('/run/multi-case', json=data)
+    print(response.json())
+    result = response.json()
+    assert result['timings']['compile'] > 0
+    assert result['timings']['run'] == pytest.approx(sum(r['timings']['run'] for r in result['results']))
+    assert result['results'][0]['timings']['compile'] == result['timings']['compile']
+    assert result['results'][1]['timings']['compile'] is None
+
+
+@pytest.mark.parametrize("type", ["judge", "run"])
+def test_long_batch_stream(test_client, type):
+    data = {
+        'type': 'batch',
+        'submissions': [{
+            "type": "python",
+            "solution": f"# {uuid.uuid4()}\nimport time\ntime.sleep(2)\nprint(input())",
+            "input": "a",
+            "expected_output": "a"
+        }, {
+            "type": "python",
+            "solution": f"# {uuid.uuid4()}\nprint(input())",
+            "input": "a",
+            "expected_output": "b"
+        }]
+    }
+    with test_client.stream('POST', f'/{type}/long-batch/stream', json=data) as response:
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/x-ndjson'
+        records = [json.loads(line) for line in response.iter_lines() if line]
+    print(records)
+    *results, summary = records
+    # the fast submission is finished first
+    assert [r['index'] for r in results] == [1, 0]
+    assert all(r['type'] == 'result' for r in results)
+    assert results[0]['sub_id'] == results[0]['result']['sub_id']
+    assert not results[0]['result']['success']
+    assert results[1]['result']['success']
+    assert ('stdout' in results[0]['result']) == (type == 'run')
+    assert summary['type'] == 'summary'
+    assert (summary['total'], summary['success'], summary['reasons']) == (2, 1, {'none': 1})
+
+
+def test_jobs(test_client):
+    data = {
+        'type': 'batch',
+        'submissions': [{
+            "type": "python",
+            "solution": f"# {uuid.uuid4()}\nprint(input())",
+            "input": str(i),
+            "expected_output": "0"
+        } for i in range(3)]
+    }
+    job = test_client.post('/jobs', json=data).json()
+    print(job)
+    assert (job['status'], job['total']) == ('running', 3)
+    for _ in range(100):
+        job = test_client.get(f'/jobs/{job["job_id"]}', params={'limit': 2}).json()
+        if job['status'] != 'running':
+            break
+        sleep(0.1)
+    print(job)
+    assert (job['status'], job['finished'], job['next_offset']) == ('done', 3, 2)
+    assert [r['index'] for r in job['results']] == [0, 1]
+    assert job['results'][0]['result']['success']
+    assert not job['results'][1]['result']['success']
+    assert job['results'][1]['sub_id'] == job['results'][1]['result']['sub_id']
+
+    page = test_client.get(f'/jobs/{job["job_id"]}', params={'offset': 2, 'limit': 2}).json()
+    assert [r['index'] for r in page['results']] == [2]
+    assert page['next_offset'] is None
+
+    assert test_client.get('/jobs/not-exist').status_code == 404
+    assert test_client.delete('/jobs/not-exist').status_code == 404
+
+
+def test_job_cancel(test_client):
+    data = {
+        'type': 'batch',
+        'submissions': [{
+            "type": "python",
+            "solution": f"# {uuid.uuid4()}\nimport time\ntime.sleep(1)",
+        } for _ in range(12)]
+    }
+    job = test_client.post('/jobs', json=data).json()
+    sleep(0.5)
+    job = test_client.delete(f'/jobs/{job["job_id"]}').json()
+    print(job)
+    assert (job['status'], job['finished']) == ('cancelled', 12)
+    job = test_client.get(f'/jobs/{job["job_id"]}').json()
+    assert job['status'] == 'cancelled'
+    reasons = [r['result']['reason'] for r in job['results']]
+    # the running ones may be finished before they are skipped
+    assert reasons.count('skipped') >= 4
+    # cancelling again is a no-op
+    assert test_client.delete(f'/jobs/{job["job_id"]}').json()['status'] == 'cancelled'
+
+
+def test_priority(test_client):
+    import threading
+
+    long_batch = {
+        'type': 'batch',
+        'submissions': [{
+            "type": "python",
+            "solution": f"# {uuid.uuid4()}\nimport time\ntime.sleep(1)",
+        } for _ in range(16)]
+    }
+    thread = threading.Thread(target=test_client.post, args=('/run/long-batch',), kwargs={'json': long_batch})
+    thread.start()
+    sleep(0.5)
+    # the interactive submission only waits for a running work of the long batch
+    response = test_client.post('/run', json={"type": "python", "solution": f"# {uuid.uuid4()}\nprint(1)"})
+    print(response.json())
+    assert response.json()['success']
+    assert response.json()['timings']['queue_wait'] < 2
+    thread.join()
+
+
+def test_admission(test_client, monkeypatch):
+    from time import time
+    import app.admission as admission
+    from app.model import WorkPriority
+
+    async def _overloaded(_):
+        # 1 work per second, and 100 interactive works in the queue
+        return admission.Snapshot(
+            loaded_at=time(), lengths={p: 100 if p == WorkPriority.INTERACTIVE else 0 for p in WorkPriority}, capacity=1
+        )
+    monkeypatch.setattr(admission, '_snapshot', None)
+    monkeypatch.setattr(admission, '_load_snapshot', _overloaded)
+
+    response = test_client.post('/run', json={"type": "python", "solution": "print(1)"})
+    assert response.status_code == 429
+    import app.config as app_config
+    assert int(response.headers['Retry-After']) == 100 - app_config.MAX_QUEUE_WORK_LIFE_TIME
+    # the lower lanes are rejected too, as the interactive works are ahead of them
+    response = test_client.post('/run/batch', json={'type': 'batch', 'submissions': [{"type": "python", "solution": "print(1)"}]})
+    assert response.status_code == 429
+    # but long batches can wait for them
+    response = test_client.post('/run/long-batch', json={'type': 'batch', 'submissions': [{"type": "python", "solution": "print(1)"}]})
+    assert response.status_code == 200
+    assert 'code_judge_rejected_total{priority="interactive"} 1' in test_client.get('/metrics').text
+
+    monkeypatch.undo()
+    response = test_client.post('/run', json={"type": "python", "solution": "print(1)"})
+    assert response.status_code == 200
+
+
+def test_batch_pacing(test_client, monkeypatch):
+    from time import time
+    import app.admission as admission
+    from app.model import WorkPriority
+
+    pushed = []
+    orig_push = admission.work_queue.push
+
+    async def _push(redis_queue, payload_timestamps, *args, **kwargs):
+        pushed.append(len(payload_timestamps))
+        return await orig_push(redis_queue, payload_timestamps, *args, **kwargs)
+
+    async def _no_room(_):
+        # no room for any work, but the batch still makes progress one by one
+        return admission.Snapshot(loaded_at=time(), lengths={p: 0 for p in WorkPriority}, capacity=0.01)
+    monkeypatch.setattr(admission, '_snapshot', None)
+    monkeypatch.setattr(admission, '_load_snapshot', _no_room)
+    monkeypatch.setattr(admission.work_queue, 'push', _push)
+    # admission control is not what is tested here
+    monkeypatch.setattr(admission.app_config, 'ADMISSION_CONTROL', 0)
+
+    batch = {
+        'type': 'batch',
+        'submissions': [{"type": "python", "solution": f"# {uuid.uuid4()}\nprint({i})"} for i in range(3)]
+    }
+    response = test_client.post('/run/batch', json=batch)
+    assert response.status_code == 200
+    results = response.json()['results']
+    assert [r['stdout'] for r in results] == ['0\n', '1\n', '2\n']
+    assert pushed == [1, 1, 1]
+    monkeypatch.undo()
+
+
+def test_blobs(test_client):
+    import app.config as app_config
+    # the solution and the inputs are stored as blobs, and the solution is shared by all submissions
+    padding = '#' * app_config.BLOB_MIN_SIZE
+    solution = f"# {uuid.uuid4()}\n{padding}\nprint(len(input()))"
+    batch = {
+        'type': 'batch',
+        'submissions': [
+            {"type": "python", "solution": solution, "input": 'x' * (100000 + i), "expected_output": str(100000 + i)}
+            for i in range(3)
+        ] + [{"type": "python", "solution": solution, "input": 'short', "expected_output": '5'}]
+    }
+    response = test_client.post('/run/batch', json=batch)
+    assert response.status_code == 200
+    assert all(r['success'] for r in response.json()['results'])
+
+    data = {
+        "type": "multi_case",
+        "language": "python",
+        "solution": solution,
+        "cases": [{"input": 'y' * 5000, "expected_output": '5000'}, {"input": 'z', "expected_output": '1'}],
+    }
+    response = test_client.post('/run/multi-case', json=data)
+    assert response.status_code == 200
+    assert response.json()['success']
+
+
+def test_compare_options(test_client):
+    data = {
+        "type": "python",
+        "solution": f"# {uuid.uuid4()}\nprint('0.3333334  1')",
+        "expected_output": "0.3333333 1.0",
+    }
+    assert not test_client.post('/judge', json=data).json()['success']
+    assert test_client.post('/judge', json={**data, 'options': {'compare': 'float'}}).json()['success']
+    result = test_client.post('/run', json={**data, 'options': {'compare': 'float', 'float_tolerance': '1e-9'}}).json()
+    assert not result['success']
+    assert result['run_success']
+    assert result['stdout'] == '0.3333334  1\n'
+    assert test_client.post('/judge', json={**data, 'options': {'compare': 'fuzzy'}}).status_code == 422
+
+
+def test_output_limit(test_client):
+    data = {
+        "type": "python",
+        "solution": f"# {uuid.uuid4()}\nwhile True: print('x' * 1000)",
+    }
+    result = test_client.post('/run', json=data).json()
+    print(result)
+    assert not result['success']
+    assert not result['run_success']
+    assert result['reason'] == 'output_limit_exceeded'
+    assert result['cost'] < 5
+    assert len(result['stdout']) <= 1000
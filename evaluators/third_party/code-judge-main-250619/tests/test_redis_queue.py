@@ -0,0 +1,108 @@
+from time import sleep
+
+import fakeredis
+
+from app.libs.redis_queue import RedisQueue
+
+
+STREAM = 'test-stream'
+GROUP = 'test-group'
+
+
+def _stream_queue():
+    redis_queue = RedisQueue('redis://localhost:6388/7', socket_timeout=10)
+    redis_queue.redis = fakeredis.FakeRedis()
+    redis_queue.squeue.create_group(STREAM, GROUP)
+    # idempotent
+    redis_queue.squeue.create_group(STREAM, GROUP)
+    return redis_queue
+
+
+def test_stream_queue():
+    redis_queue = _stream_queue()
+    redis_queue.squeue.push(STREAM, {'a': 1.0, 'b': 2.0})
+    assert redis_queue.squeue.peak(STREAM, GROUP) == (b'a', 1.0)
+    [(stream_name, entry_id, payload, timestamp)] = redis_queue.squeue.block_pop_first([STREAM], GROUP, 'c1', timeout=1)
+    assert stream_name == STREAM
+    assert (payload, timestamp) == (b'a', 1.0)
+    # the delivered entry is not visible to peak any more
+    assert redis_queue.squeue.peak(STREAM, GROUP) == (b'b', 2.0)
+    assert redis_queue.squeue.len(STREAM) == 2
+    redis_queue.squeue.ack(STREAM, GROUP, entry_id)
+    assert redis_queue.squeue.len(STREAM) == 1
+
+
+def test_stream_queue_redelivery():
+    redis_queue = _stream_queue()
+    redis_queue.squeue.push(STREAM, {'a': 1.0})
+    [(_, entry_id, _, _)] = redis_queue.squeue.block_pop_first([STREAM], GROUP, 'c1', timeout=1)
+    assert redis_queue.squeue.block_pop_first([STREAM], GROUP, 'c2', timeout=1) == []
+    # the lease is not expired yet
+    assert redis_queue.squeue.claim_stale(STREAM, GROUP, 'c2', 10) == []
+
+    sleep(0.2)
+    redis_queue.squeue.renew(STREAM, GROUP, 'c1', entry_id)
+    assert redis_queue.squeue.claim_stale(STREAM, GROUP, 'c2', 0.15) == []
+
+    sleep(0.2)
+    [((claimed_id, payload, _), times_delivered)] = redis_queue.squeue.claim_stale(STREAM, GROUP, 'c2', 0.15)
+    assert (claimed_id, payload, times_delivered) == (entry_id, b'a', 1)
+    redis_queue.squeue.ack(STREAM, GROUP, claimed_id)
+    sleep(0.2)
+    assert redis_queue.squeue.claim_stale(STREAM, GROUP, 'c3', 0.15) == []
+    assert redis_queue.squeue.len(STREAM) == 0
+
+
+def test_stream_queue_claim_many():
+    redis_queue = _stream_queue()
+    redis_queue.squeue.push(STREAM, {'a': 1.0, 'b': 2.0, 'c': 3.0})
+    assert len(redis_queue.squeue.block_pop_first([STREAM], GROUP, 'c1', count=3, timeout=1)) == 3
+    sleep(0.2)
+    # all the stale entries of a dead consumer are claimed at once, the oldest first
+    claimed = redis_queue.squeue.claim_stale(STREAM, GROUP, 'c2', 0.15, count=2)
+    assert [payload for (_, payload, _), _ in claimed] == [b'a', b'b']
+    claimed = redis_queue.squeue.claim_stale(STREAM, GROUP, 'c2', 0.15, count=10)
+    assert [(payload, times_delivered) for (_, payload, _), times_delivered in claimed] == [(b'c', 1)]
+
+
+def _priority_queue():
+    redis_queue = RedisQueue('redis://localhost:6388/7', socket_timeout=10)
+    redis_queue.redis = fakeredis.FakeRedis()
+    return redis_queue
+
+
+def test_fair_queue():
+    redis_queue = _priority_queue()
+    pqueue = redis_queue.pqueue
+    pqueue.push_fair('q', 'clock', 'a', 1, [f'a{i}' for i in range(4)], 60)
+    # b has a double weight, and it is not blocked by the works of a submitted before
+    pqueue.push_fair('q', 'clock', 'b', 2, [f'b{i}' for i in range(4)], 60)
+    popped = [value.decode() for value, _ in pqueue.pop('q', 8)]
+    assert popped == ['a0', 'b0', 'b1', 'a1', 'b2', 'b3', 'a2', 'a3']
+
+    # the clocks of idle tenants catch up with the others
+    pqueue.push_fair('q', 'clock', 'a', 1, ['a4', 'a5'], 60)
+    pqueue.push_fair('q', 'clock', 'c', 1, ['c0'], 60)
+    assert [value.decode() for value, _ in pqueue.pop('q', 3)] == ['a4', 'c0', 'a5']
+
+
+def test_pop_first():
+    redis_queue = _priority_queue()
+    pqueue = redis_queue.pqueue
+    pqueue.push('low', {'l0': 0, 'l1': 1})
+    pqueue.push('high', {'h0': 2})
+    items = pqueue.pop_first(['high', 'low'], 2)
+    assert [(name, value) for name, value, _ in items] == [('high', b'h0'), ('low', b'l0')]
+    assert pqueue.pop_first(['high', 'low'], 2) == [('low', b'l1', 1)]
+    assert pqueue.pop_first(['high', 'low'], 2) == []
+
+
+def test_stream_pop_first():
+    redis_queue = _stream_queue()
+    redis_queue.squeue.create_group('high', GROUP)
+    redis_queue.squeue.push(STREAM, {'l0': 0, 'l1': 1})
+    redis_queue.squeue.push('high', {'h0': 2})
+    items = redis_queue.squeue.block_pop_first(['high', STREAM], GROUP, 'c1', 2, timeout=1)
+    assert [(name, payload) for name, _, payload, _ in items] == [('high', b'h0'), (STREAM, b'l0')]
+    items = redis_queue.squeue.block_pop_first(['high', STREAM], GROUP, 'c1', 2, timeout=1)
+    assert [(name, payload) for name, _, payload, _ in items] == [(STREAM, b'l1')]
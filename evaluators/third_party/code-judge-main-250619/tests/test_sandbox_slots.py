@@ -0,0 +1,42 @@
+import multiprocessing
+import threading
+from time import sleep
+
+from app.libs.sandbox_slots import SandboxSlots
+
+
+def _hold_slot(slot_dir, started):
+    with SandboxSlots(slot_dir, 1).acquire():
+        started.set()
+        sleep(60)
+
+
+def test_sandbox_slots(tmp_path):
+    slots = SandboxSlots(tmp_path, 2)
+    acquired = threading.Event()
+
+    def _acquire_third():
+        with slots.acquire():
+            acquired.set()
+
+    with slots.acquire():
+        with slots.acquire():
+            thread = threading.Thread(target=_acquire_third)
+            thread.start()
+            sleep(0.2)
+            assert not acquired.is_set()
+        thread.join(timeout=1)
+        assert acquired.is_set()
+
+
+def test_sandbox_slots_released_when_killed(tmp_path):
+    started = multiprocessing.Event()
+    p = multiprocessing.Process(target=_hold_slot, args=(tmp_path, started))
+    p.start()
+    assert started.wait(timeout=10)
+    slots = SandboxSlots(tmp_path, 1)
+    assert slots._try_acquire() is None
+    p.kill()
+    p.join()
+    with slots.acquire():
+        pass